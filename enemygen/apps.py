@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class EnemygenConfig(AppConfig):
+    name = 'enemygen'
+
+    def ready(self):
+        from . import counters, template_cache
+        counters.connect_signals()
+        template_cache.connect_signals()
@@ -0,0 +1,140 @@
+"""
+Encounter balancing of parties.
+
+Searches the amounts of the templates of a party for a setting whose share of won battles against an opponent
+party falls within a target band, e.g. 40-60 %. A setting is evaluated with duel.battle() in batches of BATCH
+battles, and the evaluation stops as soon as the 95 % Wilson interval of the win rate lies below, within or
+above the band, so that clear cases cost only a batch or two. The amounts are searched one template at a time
+with a binary search, relying on the win rate growing with the amounts. Each setting is simulated with its
+own stream derived from the seed, so the same seed always gives the same result.
+"""
+import math
+
+import numpy
+
+from . import duel
+from .dice import mean
+from .rng import current_rng, derive_seed
+
+DEFAULT_TARGET = (0.4, 0.6)
+DEFAULT_MAX_AMOUNT = 10
+BATCH = 200                 # Battles simulated at a time for a setting
+MAX_BATTLES = 2000          # Battles after which a setting is judged by the point estimate alone
+Z = 1.96                    # 95 % confidence
+BELOW, WITHIN, ABOVE = -1, 0, 1
+
+
+def balance(party, opponent, target=DEFAULT_TARGET, max_amount=DEFAULT_MAX_AMOUNT, seed=None):
+    """ Finds amounts of the templates of party that make it win between target[0] and target[1] of the
+        battles against opponent, a Party. The search starts from the expected amounts of the party.
+        Returns a dict with the amounts found, their win rate and its interval, whether the win rate is within
+        target, and the amount of settings evaluated and battles simulated. If no setting is within target,
+        the one closest to it is returned.
+    """
+    low, high = target
+    if not 0 <= low <= high <= 1:
+        raise duel.DuelError('Invalid target %s-%s' % (low, high))
+    if seed is None:
+        seed = current_rng().getrandbits(64)
+    template_specs = list(party.template_specs.select_related('template__race'))
+    if not template_specs:
+        raise duel.DuelError('%s has no enemies' % party.name)
+    search = _Search(template_specs, duel.party_team(opponent), target, seed)
+    amounts = [min(max(int(round(mean(ttp.amount))), 0), max_amount) for ttp in template_specs]
+    best = search.evaluate(amounts)
+    for i in range(len(template_specs)):
+        if best.verdict == WITHIN:
+            break
+        best = search.coordinate(best, i, max_amount)
+    return {'party': party.name, 'opponent': opponent.name, 'target': [low, high],
+            'amounts': [{'template_id': ttp.template.id, 'template': ttp.template.name, 'amount': amount}
+                        for ttp, amount in zip(template_specs, best.amounts)],
+            'win_rate': best.win_rate, 'interval': [best.low, best.high], 'within_target': best.verdict == WITHIN,
+            'evaluations': len(search.results), 'battles': search.battles}
+
+
+def apply(party, result):
+    """ Sets the amounts of a result of balance() to the party """
+    for item in result['amounts']:
+        party.set_amount(item['template_id'], str(item['amount']))
+
+
+def wilson(wins, total, z=Z):
+    """ Returns the Wilson score interval of the share of wins """
+    if not total:
+        return 0.0, 1.0
+    share = float(wins) / total
+    centre = share + z * z / (2 * total)
+    margin = z * math.sqrt(share * (1 - share) / total + z * z / (4 * total * total))
+    divisor = 1 + z * z / total
+    return max((centre - margin) / divisor, 0.0), min((centre + margin) / divisor, 1.0)
+
+
+class _Result(object):
+    def __init__(self, amounts, wins, total, verdict):
+        self.amounts = amounts
+        self.win_rate = round(float(wins) / total, 4) if total else 0.0
+        self.low, self.high = [round(value, 4) for value in wilson(wins, total)]
+        self.verdict = verdict
+
+
+class _Search(object):
+    def __init__(self, template_specs, opponent, target, seed):
+        self.templates = [ttp.template for ttp in template_specs]
+        self.opponent = opponent
+        self.target = target
+        self.seed = seed
+        self.results = {}   # amounts: _Result
+        self.battles = 0
+
+    def coordinate(self, best, i, max_amount):
+        """ Binary searches the amount of the ith template with the other amounts of best fixed. Returns the
+            best result seen.
+        """
+        lowest, highest = 0, max_amount
+        while lowest <= highest:
+            amounts = list(best.amounts)
+            amounts[i] = (lowest + highest) // 2
+            result = self.evaluate(amounts)
+            if self._distance(result) < self._distance(best):
+                best = result
+            if result.verdict == WITHIN:
+                break
+            elif result.verdict == BELOW:
+                lowest = amounts[i] + 1
+            else:
+                highest = amounts[i] - 1
+        return best
+
+    def evaluate(self, amounts):
+        """ Simulates battles with the amounts until the verdict is clear. The results are memoized. """
+        amounts = tuple(amounts)
+        if amounts not in self.results:
+            self.results[amounts] = self._simulate(amounts)
+        return self.results[amounts]
+
+    def _simulate(self, amounts):
+        if not sum(amounts):
+            return _Result(amounts, 0, 0, BELOW)
+        team = [(template, amount) for template, amount in zip(self.templates, amounts) if amount]
+        low, high = self.target
+        wins = total = 0
+        while total < MAX_BATTLES:
+            generator = numpy.random.default_rng(derive_seed(self.seed, amounts, total))
+            result = duel.battle(team, self.opponent, BATCH, generator)
+            wins += int(round(result['a_wins'] * BATCH))
+            total += BATCH
+            self.battles += BATCH
+            interval_low, interval_high = wilson(wins, total)
+            if interval_high < low:
+                return _Result(amounts, wins, total, BELOW)
+            if interval_low > high:
+                return _Result(amounts, wins, total, ABOVE)
+            if low <= interval_low and interval_high <= high:
+                return _Result(amounts, wins, total, WITHIN)
+        share = float(wins) / total
+        return _Result(amounts, wins, total, BELOW if share < low else ABOVE if share > high else WITHIN)
+
+    def _distance(self, result):
+        low, high = self.target
+        return max(low - result.win_rate, result.win_rate - high, 0)
@@ -0,0 +1,73 @@
+"""
+Bulk generation of enemies in a pool of worker processes.
+
+The templates are compiled once in the calling process and the CompiledTemplates are shipped to each worker
+when it starts, after which generating is pure CPU. The requested enemies are split into chunks of CHUNK_SIZE.
+Each chunk is generated with its own random stream, seeded from the master seed, the position of the request
+and the index of the chunk (see rng.derive_seed), and the chunks are merged back in order. The output depends
+only on the templates, the amounts and the seed, never on the amount of workers.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from . import counters, template_cache
+from .rng import current_rng, derive_seed
+
+CHUNK_SIZE = 500    # Amount of enemies generated by a worker at a time
+
+_templates = {}     # The CompiledTemplates of a worker process, template id: CompiledTemplate
+
+
+def generate(requests, seed=None, workers=None, increment=False):
+    """ Generates the enemies for requests, a list of (EnemyTemplate, amount) pairs, and returns them in a list
+        in the order of requests. See iter_generate.
+    """
+    return list(iter_generate(requests, seed, workers, increment))
+
+
+def iter_generate(requests, seed=None, workers=None, increment=False):
+    """ Yields the enemies for requests, a list of (EnemyTemplate, amount) pairs, in the order of requests.
+        The enemies of each request are numbered from 1. workers is the amount of worker processes, defaulting
+        to the amount of CPUs. With one worker, or only one chunk to generate, no processes are started.
+    """
+    requests = [(et, amount) for et, amount in requests if amount > 0]
+    if seed is None:
+        seed = current_rng().getrandbits(64)
+    compiled = template_cache.load(et for et, _ in requests)
+    templates = dict((template.id, template) for template in compiled)
+    if increment:
+        for et, amount in requests:
+            counters.increment(et.id, generated=amount)
+    chunks = list(_chunks(requests, seed))
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        for chunk in chunks:
+            for enemy in _generate_chunk(chunk, templates):
+                yield enemy
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(templates, )) as executor:
+        for enemies in executor.map(_generate_chunk, chunks):
+            for enemy in enemies:
+                yield enemy
+
+
+def _chunks(requests, seed):
+    """ Yields (template id, first, amount, seed) of each chunk """
+    for i, (et, amount) in enumerate(requests):
+        for j, start in enumerate(range(0, amount, CHUNK_SIZE)):
+            yield et.id, start + 1, min(CHUNK_SIZE, amount - start), derive_seed(seed, i, j)
+
+
+def _init_worker(templates):
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()  # Processes that are spawned instead of forked start without Django
+    _templates.clear()
+    _templates.update(templates)
+
+
+def _generate_chunk(chunk, templates=None):
+    template_id, first, amount, seed = chunk
+    template = (templates or _templates)[template_id]
+    return list(template.iter_generate(amount, seed, first=first))
@@ -0,0 +1,82 @@
+"""
+Write-behind buffer for the generated/used counters of EnemyTemplates.
+
+The increments are aggregated in memory per template and written with atomic F() updates when a request
+finishes, at most once in FLUSH_INTERVAL seconds, and when the process exits. A failed flush puts the
+increments back to the buffer. Increments still in the buffer are lost if the process crashes, which is
+acceptable for statistics.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.core.signals import request_finished
+from django.db.models import F
+
+FLUSH_INTERVAL = 10  # seconds
+
+_pending = defaultdict(lambda: [0, 0])  # template id: [generated, used]
+_lock = threading.Lock()
+_last_flush = [time.time()]
+
+
+def increment(template_id, generated=0, used=0):
+    with _lock:
+        counts = _pending[template_id]
+        counts[0] += generated
+        counts[1] += used
+
+
+def pending_generated(template_id=None):
+    """ Returns the amount of generated enemies not yet written to the database, for the given template or
+        all of them
+    """
+    with _lock:
+        if template_id is not None:
+            return _pending[template_id][0] if template_id in _pending else 0
+        return sum(generated for generated, _ in _pending.values())
+
+
+def flush():
+    """ Writes the buffered increments to the database """
+    from .models import EnemyTemplate
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    items = list(pending.items())
+    for i, (template_id, (generated, used)) in enumerate(items):
+        try:
+            EnemyTemplate.objects.filter(id=template_id).update(generated=F('generated') + generated,
+                                                                 used=F('used') + used)
+        except Exception:
+            for template_id, (generated, used) in items[i:]:
+                increment(template_id, generated, used)
+            raise
+
+
+def flush_if_due():
+    if time.time() - _last_flush[0] >= FLUSH_INTERVAL:
+        flush()
+
+
+def _request_finished(sender, **kwargs):
+    try:
+        flush_if_due()
+    except Exception:
+        # The request has already finished. The increments are back in the buffer for the next flush.
+        logging.getLogger(__name__).exception('Flushing the template counters failed')
+
+
+def _exit():
+    try:
+        flush()
+    except Exception:
+        pass    # The database may not be available anymore at exit
+
+
+def connect_signals():
+    request_finished.connect(_request_finished, dispatch_uid='counters_flush')
+    atexit.register(_exit)
@@ -2,98 +2,384 @@
 Handles dice.
 """
 
-import random
 import re
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+import numpy
+
+from .rng import current_rng
+
+COMPILE_CACHE_SIZE = 2048  # Max amount of distinct die sets kept compiled in memory
+DISTRIBUTION_CACHE_SIZE = 1024
+MAX_SUPPORT = 200000    # Max amount of values of an exact distribution, enough for any stat that validate() accepts
+FFT_SIZE = 64           # Distributions at least this long are added with FFT convolution
+# Limits for die sets entered by users. See validate()
+MAX_LENGTH = 200
+MAX_DICE = 100
+MAX_FACES = 1000
+STATS = ('STR', 'SIZ', 'CON', 'INT', 'DEX', 'POW', 'CHA')
 
 
 class Dice:
     def __init__(self, dice_set):
         self.dice_set = dice_set.upper()
-        self.components = self._dissect()
+        self.compiled = compile_dice(self.dice_set)
+        if self.compiled.stats:
+            raise ValueError('%s refers to stats' % dice_set)
+        self.components = list(self.compiled.components)
     
     def roll(self):
-        output = 0
-        for comp in self.components:
-            if isinstance(comp, int):
-                output += comp
-            elif isinstance(comp, tuple):
-                for i in range(comp[2]):
-                    output += random.randint(comp[0], comp[1])
-        return output
+        return self.compiled.roll()
+
+    def roll_many(self, n):
+        return self.compiled.roll_many(n)
         
     def max_roll(self):
-        output = 0
-        for comp in self.components:
-            if isinstance(comp, int):
-                output += comp
-            elif isinstance(comp, tuple):
-                for i in range(comp[2]):
-                    output += comp[1]
-        return output
+        return self.compiled.max_roll()
 
     def _dissect(self):
-        """ Analyses the input string and splits it into dice roll components.
-            Simple ints's will stay simple int's, dice are split into tuples of 
-            three int's. For excample 10+D6 should result in [10, (1,6,1)]
+        """ Returns the dice roll components of the die set. See _parse() """
+        return list(self.compiled.components)
+
+
+class CompiledDice(namedtuple('CompiledDice', ('components', 'static', 'dice', 'stats'))):
+    """ Immutable, parsed form of a die set.
+        components: The components in the order they appear in the die set, e.g. (10, (1, 6, 1), '-DEX')
+        static: Sum of the static int components
+        dice: The die tuples of the die set. See _die_to_tuple()
+        stats: Tuples of (stat name, multiplier), e.g. STR+DEX+DEX gives (('STR', 1), ('DEX', 2))
+    """
+    __slots__ = ()
+
+    def roll(self, stats=None, rng=None):
+        """ Rolls the die set. Stat values are looked up from the given dict like {'STR': 12, 'SIZ': 16}.
+            Stats missing from the dict count as 0.
+            rng: random.Random to roll with. Defaults to the current rng (see rng.current_rng).
         """
-        raw_components = re.findall(r"[\+\-]?[\w']+", self.dice_set)
-        fin_components = []
-        for comp in raw_components:
-            try:
-                comp = int(comp)
-            except ValueError:
+        rng = rng or current_rng()
+        output = self.static + self.stat_total(stats)
+        for start, end, times in self.dice:
+            for i in range(times):
+                output += rng.randint(start, end)
+        return output
+
+    def roll_many(self, n, stats=None, rng=None):
+        """ Rolls the die set n times in one go. Returns a numpy array of n ints.
+            Stat values in the stats dict can be either ints or arrays of n ints.
+            rng: random.Random or numpy Generator to roll with. Defaults to the current rng.
+        """
+        generator = numpy_rng(rng)
+        output = numpy.full(n, self.static, dtype=numpy.int64)
+        if stats:
+            stats = dict((name, numpy.asarray(value)) for name, value in stats.items())
+        output += self.stat_total(stats)
+        for start, end, times in self.dice:
+            if times:
+                output += generator.integers(start, end + 1, size=(n, times)).sum(axis=1)
+        return output
+
+    def max_roll(self, stats=None):
+        output = self.static + self.stat_total(stats)
+        for start, end, times in self.dice:
+            output += end * times
+        return output
+
+    def stat_total(self, stats):
+        if not self.stats:
+            return 0
+        if stats is None:
+            raise ValueError('Stat values are needed for rolling %s' % (self.components, ))
+        return sum(stats.get(name, 0) * multiplier for name, multiplier in self.stats)
+
+
+def compile_dice(dice_set):
+    """ Returns the CompiledDice of the given die set. Compiled die sets are cached, so each distinct
+        die set is parsed only once.
+    """
+    return _compile(dice_set.upper())
+
+
+def cache_info():
+    """ Returns the hit/miss statistics of the compiled die set cache """
+    return _compile.cache_info()
+
+
+def clear_cache():
+    _compile.cache_clear()
+    _clean.cache_clear()
+    _canonical.cache_clear()
+
+
+def validate(dice_set, stats=False):
+    """ Checks that the die set is valid and within the limits without rolling it. Raises ValueError if
+        it's not. Stat references (e.g. STR+DEX) are accepted only if stats is True.
+        Returns the CompiledDice.
+    """
+    if len(dice_set) > MAX_LENGTH:
+        raise ValueError('Die set is too long')
+    compiled = compile_dice(dice_set)
+    if compiled.stats and not stats:
+        raise ValueError('%s refers to stats' % dice_set)
+    amount = 0
+    for start, end, times in compiled.dice:
+        faces = end - start + 1
+        if not 1 <= faces <= MAX_FACES:
+            raise ValueError('Dice must have 1-%s faces' % MAX_FACES)
+        amount += times
+    if amount > MAX_DICE:
+        raise ValueError('Die set can have at most %s dice' % MAX_DICE)
+    return compiled
+
+
+def numpy_rng(rng=None):
+    """ Returns a numpy Generator for the given random.Random. The Generator is seeded from rng (or from the
+        current rng), so seeding the rng makes also the batch rolls repeatable.
+    """
+    if isinstance(rng, numpy.random.Generator):
+        return rng
+    return numpy.random.default_rng((rng or current_rng()).getrandbits(64))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile(dice_set):
+    return _parse(dice_set)
+
+
+def _parse(dice_set):
+    """ Analyses the input string and splits it into dice roll components.
+        Simple ints's will stay simple int's, dice are split into tuples of 
+        three int's and stats stay as strings prefixed with '-' if they are subtracted.
+        For excample 10+D6-DEX should result in [10, (1,6,1), '-DEX']
+    """
+    raw_components = re.findall(r"[\+\-]?[\w']+", dice_set)
+    components = []
+    stats = OrderedDict()
+    for comp in raw_components:
+        try:
+            comp = int(comp)
+        except ValueError:
+            name = comp.lstrip('+-')
+            if name in STATS:
+                comp = '-' + name if comp[0] == '-' else name
+                stats[name] = stats.get(name, 0) + (-1 if comp[0] == '-' else 1)
+            else:
                 comp = _die_to_tuple(comp)
-            fin_components.append(comp)
-        return fin_components
+        components.append(comp)
+    static = sum(comp for comp in components if isinstance(comp, int))
+    dice = tuple(comp for comp in components if isinstance(comp, tuple))
+    stats = tuple((name, multiplier) for name, multiplier in stats.items() if multiplier)
+    return CompiledDice(tuple(components), static, dice, stats)
+
+
+class Distribution(object):
+    """ Exact probability distribution of a die set.
+        probabilities[i] is the probability of rolling offset + i.
+    """
+    def __init__(self, offset, probabilities):
+        self.offset = offset
+        self.probabilities = numpy.asarray(probabilities, dtype=float)
+        self.probabilities.flags.writeable = False
+
+    @classmethod
+    def constant(cls, value):
+        return cls(value, [1.0])
+
+    @classmethod
+    def die(cls, start, end):
+        return cls(start, numpy.full(end - start + 1, 1.0 / (end - start + 1)))
+
+    @property
+    def min(self):
+        return self.offset
+
+    @property
+    def max(self):
+        return self.offset + len(self.probabilities) - 1
+
+    @property
+    def values(self):
+        return numpy.arange(self.min, self.max + 1)
+
+    @property
+    def mean(self):
+        return float((self.values * self.probabilities).sum())
+
+    @property
+    def variance(self):
+        return float((((self.values - self.mean) ** 2) * self.probabilities).sum())
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    def pmf(self):
+        """ Returns the distribution as an OrderedDict of value: probability. Impossible values are left out """
+        return OrderedDict((int(value), float(prob)) for value, prob in zip(self.values, self.probabilities) if prob > 0)
+
+    def cdf(self, value):
+        """ Returns the probability of rolling value or less """
+        index = int(value) - self.offset
+        if index < 0:
+            return 0.0
+        return float(min(self.probabilities[:index + 1].sum(), 1.0))
+
+    def percentile(self, percent):
+        """ Returns the smallest value, that is rolled with the given percent probability or less """
+        cumulative = numpy.cumsum(self.probabilities)
+        index = int(numpy.searchsorted(cumulative, percent / 100.0 - 1e-9))
+        return self.offset + min(index, len(self.probabilities) - 1)
+
+    def sample(self, rng=None, at_most=None):
+        """ Returns a random value of the distribution. With at_most, the value is drawn from the distribution
+            truncated to at_most, which is the same as rerolling until the value is at most at_most.
+            Raises ValueError if no value can be at most at_most.
+        """
+        cumulative = numpy.cumsum(self.probabilities)
+        if at_most is not None:
+            cumulative = cumulative[:max(int(at_most) - self.offset + 1, 0)]
+        if not len(cumulative) or cumulative[-1] <= 0:
+            raise ValueError("The distribution has no values up to %s" % at_most)
+        index = int(numpy.searchsorted(cumulative, (rng or current_rng()).random() * cumulative[-1], side='right'))
+        return self.offset + min(index, len(cumulative) - 1)
+
+    def __add__(self, other):
+        return Distribution(self.offset + other.offset, _convolve(self.probabilities, other.probabilities))
+
+    def times(self, n):
+        """ Distribution of the sum of n independent rolls """
+        output = Distribution.constant(0)
+        power = self
+        while n:
+            if n & 1:
+                output = output + power
+            n >>= 1
+            if n:
+                power = power + power
+        return output
+
+    def scale(self, multiplier):
+        """ Distribution of a single roll multiplied by multiplier, e.g. POW+POW """
+        if multiplier == 0:
+            return Distribution.constant(0)
+        probabilities = numpy.zeros((len(self.probabilities) - 1) * abs(multiplier) + 1)
+        probabilities[::abs(multiplier)] = self.probabilities
+        if multiplier > 0:
+            return Distribution(self.offset * multiplier, probabilities)
+        return Distribution(self.max * multiplier, probabilities[::-1])
+
+
+def distribution(dice_set, stats=None):
+    """ Returns the exact Distribution of the given die set. Stats referred to by the die set are given as
+        a dict of stat name: die set (e.g. EnemyTemplate.stat_dict) or stat name: int.
+        Missing stats count as 0. Results are memoized. Raises ValueError if the distribution would have more
+        than MAX_SUPPORT values.
+    """
+    stats_key = tuple(sorted((name, str(value).upper()) for name, value in stats.items())) if stats else ()
+    return _distribution(dice_set.upper(), stats_key)
+
+
+def mean(dice_set, stats=None):
+    """ Returns the average roll of the die set, computed without its distribution. Stats as in distribution(). """
+    compiled = compile_dice(dice_set)
+    total = compiled.static + sum(times * (start + end) / 2.0 for start, end, times in compiled.dice)
+    for name, multiplier in compiled.stats:
+        if stats and name in stats:
+            total += multiplier * mean(str(stats[name]))
+    return float(total)
+
+
+def _support(compiled, stats):
+    """ Amount of values the distribution of the compiled die set has """
+    size = 1 + sum((end - start) * times for start, end, times in compiled.dice)
+    for name, multiplier in compiled.stats:
+        if name in stats:
+            size += (_support(compile_dice(stats[name]), {}) - 1) * abs(multiplier)
+    return size
+
+
+def _convolve(first, second):
+    if min(len(first), len(second)) < FFT_SIZE:
+        return numpy.convolve(first, second)
+    size = len(first) + len(second) - 1
+    n = 1 << (size - 1).bit_length()
+    output = numpy.fft.irfft(numpy.fft.rfft(first, n) * numpy.fft.rfft(second, n), n)[:size]
+    output[output < 1e-15] = 0.0    # Rounding noise of the transforms
+    return output
+
+
+@lru_cache(maxsize=DISTRIBUTION_CACHE_SIZE)
+def _distribution(dice_set, stats_key):
+    compiled = compile_dice(dice_set)
+    if _support(compiled, dict(stats_key)) > MAX_SUPPORT:
+        raise ValueError('%s has too many values for an exact distribution' % dice_set)
+    output = Distribution.constant(compiled.static)
+    for start, end, times in compiled.dice:
+        output = output + Distribution.die(start, end).times(times)
+    stats = dict(stats_key)
+    for name, multiplier in compiled.stats:
+        if name in stats:
+            output = output + _distribution(stats[name], ()).scale(multiplier)
+    return output
 
 
 def clean(dieset):
-    """ Cleans the given dieset combining simila components. eg. STR+D10+1d10 bcomes STR+2d10 """
-    dieset = dieset.replace('+-', '-')
-    dieset = dieset.replace('-+', '-')
-    dieset = dieset.upper()
-    dieset = re.sub('D(\d)', r'd\1', dieset)    # Change Upper case D to lower case if it's part of a die (not DEX)
-    components = re.findall(r"[\+\-]?[\w']+", dieset)
-    if components[0][0] not in '+-':    # Prefix with plus if no prefix
-        components[0] = '+' + components[0]
-    new_components = OrderedDict()
-    # Add the components to a dict, counting (dict value) each different component type
-    static_int = 0  # Holds the cumulative value of static int components
-    for comp in components:
-        if 'd' in comp:  # It's a die, not stat (STR, DEX...)
-            amount, die = comp.split('d')
-            if amount == '+' or amount == '-':  # Change '+' to '+1', as in '+D6' > '+1D6'
-                amount += '1'
-            die = 'd'+die
-            if die not in new_components:
-                new_components[die] = 0
-            new_components[die] += int(amount)
-        else:   # Stat or a static number
-            try:    # A static number
-                static_int += int(comp)
-            except ValueError:  # Stat, eg. STR, DEX
-                amount = 1 if comp[0] == '+' else -1
-                comp = comp[1:]
-                if comp not in new_components:
-                    new_components[comp] = 0
-                new_components[comp] += amount
+    """ Cleans the given dieset combining similar components. eg. STR+D10+1d10 becomes STR+2d10 """
+    return _clean(dieset.upper())
+
+
+def equivalent(dieset, other):
+    """ Tells whether the two die sets always roll the same, regardless of the order of their
+        components. eg. STR+D6+2 and 2+1d6+STR
+    """
+    return _canonical(dieset.upper()) == _canonical(other.upper())
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _clean(dieset):
+    compiled = compile_dice(dieset)
     out = ''
-    for comp, amount in new_components.items():
+    for comp, amount in _count_components(compiled).items():
         if amount == 0:
             continue
-        if 'd' in comp: # It's a die
-            amount = str(amount) if amount < 0 else '+' + str(amount)
-            out += '%s%s' % (amount, comp)
+        if isinstance(comp, int):  # It's a die
+            out += '%+dd%s' % (amount, comp)
         else:  # It's a stat
             sign = '+' if amount > 0 else '-'
             out += (sign+comp)*abs(amount)
-    if static_int:
-        out += str(static_int) if static_int < 0 else '+' + str(static_int)
+    if compiled.static:
+        out += '%+d' % compiled.static
+    if not out:
+        return '0'
     if out[0] == '+':
         out = out[1:]
     return out
 
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _canonical(dieset):
+    compiled = compile_dice(dieset)
+    counts = _count_components(compiled)
+    dice = tuple(sorted((comp, amount) for comp, amount in counts.items() if isinstance(comp, int) and amount))
+    return compiled.static, dice, tuple(sorted(compiled.stats))
+
+
+def _count_components(compiled):
+    """ Counts the dice (keyed by the amount of faces) and stats of the compiled die set,
+        in the order they first appear
+    """
+    counts = OrderedDict()
+    for comp in compiled.components:
+        if isinstance(comp, int):
+            continue
+        if isinstance(comp, tuple):
+            start, end, times = comp
+            key, amount = (end, times) if end > 0 else (-start, -times)
+        else:
+            key, amount = comp.lstrip('-'), (-1 if comp[0] == '-' else 1)
+        counts[key] = counts.get(key, 0) + amount
+    return counts
+
 def _invert_comp(comp):
     """ Inverts the sign (+ or -) of the given string component """
     if comp[0] == '-':
@@ -0,0 +1,318 @@
+"""
+Duel and battle simulator.
+
+Runs thousands of simplified one-on-one duels between two sides at once with numpy, one duel per array row.
+A side is an EnemyTemplate or a Party. For a party, each duel picks one of its templates, weighted by the
+expected amount of it in the party. The templates of a side are compiled and rolled once per simulation.
+battle() does the same for teams of several combatants, e.g. two parties with all their enemies.
+
+The rules are a simplification of the combat rules:
+- The combatants act in the order of strike rank, one action point at a time, and spend every action point on
+  an attack. Parrying doesn't take action points.
+- An attack hits when d100 is at most the attacker's best combat style value and the defender fails to parry
+  with d100 against their own best combat style value. 01-05 always succeeds and 96-00 always fails.
+- A hit lands on a hit location rolled with d20 and does the damage of the weapon, plus the damage modifier
+  for weapons that add it, minus the armor of the location.
+- A combatant is out when any of their hit locations drops to 0 HP or below. A duel still going after
+  MAX_ROUNDS rounds is a draw.
+- In battles the teams take turns instead of following strike ranks. All the combatants of a team attack at
+  once, each against a random opponent up at the start of the turn.
+"""
+import numpy
+
+from . import template_cache
+from .dice import compile_dice, mean, numpy_rng, validate
+from .models import Party, _BatchRolls, _Cult, _Spirit
+from .template_profile import summarize
+
+DEFAULT_DUELS = 10000
+MAX_DUELS = 100000
+MAX_TEAM_SIZE = 100     # Max amount of combatants of one template in a team
+MAX_ROUNDS = 100
+UNARMED_DAMAGE = '1d3'
+NO_LOCATION = -1
+
+
+class DuelError(Exception):
+    pass
+
+
+def simulate(side_a, side_b, duels=DEFAULT_DUELS, rng=None):
+    """ Simulates duels between side_a and side_b, which are EnemyTemplates or Parties. rng is a random.Random,
+        numpy Generator or None for the current rng.
+        Returns the shares of wins of both sides and draws, and the distribution of the rounds of the
+        decided duels.
+    """
+    duels = max(1, min(duels, MAX_DUELS))
+    generator = numpy_rng(rng)
+    a = _Side.duelist(side_a, duels, generator)
+    b = _Side.duelist(side_b, duels, generator)
+    # Ties of strike rank are broken randomly, once per duel
+    a_first = (a.strike_rank + generator.random(duels)) > (b.strike_rank + generator.random(duels))
+    b_first = ~a_first
+    ended = numpy.zeros(duels, dtype=numpy.int64)   # The round the duel was decided in, 0 if not decided
+    max_action_points = int(max(a.action_points.max(), b.action_points.max()))
+    for round_number in range(1, MAX_ROUNDS + 1):
+        for action in range(max_action_points):
+            _attack_duel(a, b, a_first & (a.action_points > action), generator)
+            _attack_duel(b, a, b_first & (b.action_points > action), generator)
+            _attack_duel(b, a, a_first & (b.action_points > action), generator)
+            _attack_duel(a, b, b_first & (a.action_points > action), generator)
+        decided = (ended == 0) & ~(a.alive & b.alive)
+        ended[decided] = round_number
+        if not (a.alive & b.alive).any():
+            break
+    a_wins = a.alive & ~b.alive
+    b_wins = b.alive & ~a.alive
+    output = {'a': a.name, 'b': b.name, 'duels': duels,
+              'a_wins': _share(a_wins.sum(), duels), 'b_wins': _share(b_wins.sum(), duels),
+              'draws': _share(duels - a_wins.sum() - b_wins.sum(), duels), 'rounds': None}
+    if (ended > 0).any():
+        output['rounds'] = summarize(ended[ended > 0])
+    return output
+
+
+def battle(team_a, team_b, battles=DEFAULT_DUELS, rng=None):
+    """ Simulates battles between two teams. A team is a list of (EnemyTemplate, amount), where amount is an
+        int or a die set rolled for each battle, or a Party. Returns the same results as simulate().
+    """
+    battles = max(1, min(battles, MAX_DUELS))
+    generator = numpy_rng(rng)
+    a = _team(team_a, battles, generator)
+    b = _team(team_b, battles, generator)
+    # Which team acts first on each action point is decided randomly, once per battle
+    a_first = generator.random(battles) < 0.5
+    b_first = ~a_first
+    everyone = numpy.ones(battles, dtype=bool)
+    ended = numpy.zeros(battles, dtype=numpy.int64)
+    max_action_points = int(max(a.action_points.max(), b.action_points.max()))
+    for round_number in range(1, MAX_ROUNDS + 1):
+        for action in range(max_action_points):
+            _attack_random(a, b, a_first, action, generator)
+            _attack_random(b, a, everyone, action, generator)
+            _attack_random(a, b, b_first, action, generator)
+        a_up, b_up = a.up(), b.up()
+        ended[(ended == 0) & ~(a_up & b_up)] = round_number
+        if not (a_up & b_up).any():
+            break
+    a_wins = a_up & ~b_up
+    b_wins = b_up & ~a_up
+    output = {'a': a.name, 'b': b.name, 'duels': battles,
+              'a_wins': _share(a_wins.sum(), battles), 'b_wins': _share(b_wins.sum(), battles),
+              'draws': _share(battles - a_wins.sum() - b_wins.sum(), battles), 'rounds': None}
+    if (ended > 0).any():
+        output['rounds'] = summarize(ended[ended > 0])
+    return output
+
+
+def _attack_duel(attacker, defender, mask, generator):
+    """ Resolves an attack of the attacker in the duels of the mask where both combatants are still up """
+    rows = numpy.nonzero(mask & attacker.alive & defender.alive)[0]
+    if len(rows):
+        _attack(attacker, defender, rows, rows, generator)
+
+
+def party_team(party):
+    """ Returns the team of the party for battle() """
+    return [(ttp.template, ttp.amount) for ttp in party.template_specs.select_related('template__race')]
+
+
+def _team(team, battles, generator):
+    """ Returns a _Side with a row for each combatant of the team in each battle. The rows of a battle are
+        consecutive, and the combatants beyond the amount rolled for the battle start it out.
+    """
+    name = _team_name(team)
+    if isinstance(team, Party):
+        team = party_team(team)
+    templates, slots, alive = [], [], []
+    for et, amount in team:
+        amounts = compile_dice(str(amount)).roll_many(battles, rng=generator)
+        size = min(int(amounts.max()), MAX_TEAM_SIZE)
+        if size > 0:
+            slots.extend([len(templates)] * size)
+            templates.append(et)
+            alive.append(amounts[:, None] > numpy.arange(size))
+    if not slots:
+        raise DuelError('%s has no combatants' % name)
+    side = _Side(name, templates, numpy.tile(slots, battles), generator)
+    side.size = len(slots)
+    side.alive = numpy.concatenate(alive, axis=1).reshape(-1)
+    return side
+
+
+def _team_name(team):
+    if isinstance(team, Party):
+        return team.name
+    return ', '.join('%s x %s' % (amount, et.name) for et, amount in team)
+
+
+def _attack_random(attacker, defender, battles, action, generator):
+    """ Makes the attacks of the given action point of the attacking team in the given battles, each against
+        a random opponent up at the start of the attacks. All the attacks are resolved at once.
+    """
+    rows = numpy.nonzero(attacker.alive & (attacker.action_points > action))[0]
+    rows = rows[battles[rows // attacker.size]]
+    if not len(rows):
+        return
+    first_rows = rows // attacker.size * defender.size
+    alive = defender.alive.reshape(-1, defender.size)[rows // attacker.size]
+    targets = numpy.argmax(generator.random(alive.shape) * alive, axis=1)
+    up = alive[numpy.arange(len(rows)), targets]
+    _attack(attacker, defender, rows[up], first_rows[up] + targets[up], generator)
+
+
+def _attack(attacker, defender, rows, defender_rows, generator):
+    """ Resolves the attacks of the given rows of the attacker against the given rows of the defender """
+    hits = _succeeds(attacker.skill[rows], generator) & ~_succeeds(defender.skill[defender_rows], generator)
+    rows, defender_rows = rows[hits], defender_rows[hits]
+    locations = defender.location_table[defender_rows, generator.integers(1, 21, size=len(rows))]
+    landed = locations != NO_LOCATION
+    rows, defender_rows, locations = rows[landed], defender_rows[landed], locations[landed]
+    if not len(rows):
+        return
+    damage = attacker.roll_damage(rows, generator) - defender.armor[defender_rows, locations]
+    # Several attackers may hit the same defender at once
+    numpy.subtract.at(defender.hit_points, (defender_rows, locations), numpy.maximum(damage, 0))
+    defender.alive[defender_rows] = defender.hit_points[defender_rows].min(axis=1) > 0
+
+
+def _succeeds(skill, generator):
+    return generator.integers(1, 101, size=len(skill)) <= numpy.clip(skill, 5, 95)
+
+
+def _share(count, total):
+    return round(float(count) / total, 4)
+
+
+def _valid_damage(damage):
+    try:
+        validate(damage)
+        return True
+    except ValueError:
+        return False
+
+
+class _Side(object):
+    """ The combatants of one side of the duels, or of a team of the battles, as columns with one row per
+        combatant. picks gives the index of the template of each row. Locations a template doesn't have are
+        padded with hit points that never run out, and no d20 roll maps to them.
+    """
+    size = 1    # Rows per duel or battle
+
+    def __init__(self, name, templates, picks, generator):
+        compiled_templates = template_cache.load(templates)
+        for template in compiled_templates:
+            if template.enemy_class in (_Cult, _Spirit) or not template.hit_locations:
+                raise DuelError("%s can't fight duels" % template.name)
+        self.name = name
+        combatants = len(picks)
+        self.weapons = []   # (damage die set, adds damage modifier)
+        self.damage_modifiers = []
+        locations = max(len(template.hit_locations) for template in compiled_templates)
+        self.skill = numpy.zeros(combatants, dtype=numpy.int64)
+        self.action_points = numpy.zeros(combatants, dtype=numpy.int64)
+        self.strike_rank = numpy.zeros(combatants, dtype=numpy.int64)
+        self.weapon = numpy.zeros(combatants, dtype=numpy.int64)
+        self.damage_modifier = numpy.zeros(combatants, dtype=numpy.int64)
+        self.hit_points = numpy.full((combatants, locations), numpy.iinfo(numpy.int64).max // 2, dtype=numpy.int64)
+        self.armor = numpy.zeros((combatants, locations), dtype=numpy.int64)
+        self.location_table = numpy.full((combatants, 21), NO_LOCATION, dtype=numpy.int64)
+        self.alive = numpy.ones(combatants, dtype=bool)
+        for i, template in enumerate(compiled_templates):
+            rows = numpy.nonzero(picks == i)[0]
+            if len(rows):
+                self._add(template, rows, generator)
+
+    @classmethod
+    def duelist(cls, side, duels, generator):
+        """ Returns the side of the duels for side, an EnemyTemplate or a Party """
+        templates, weights = cls._templates(side)
+        return cls(side.name, templates, generator.choice(len(templates), size=duels, p=weights), generator)
+
+    def up(self):
+        """ Returns whether the side has combatants up in each duel or battle """
+        return self.alive.reshape(-1, self.size).any(axis=1)
+
+    @staticmethod
+    def _templates(side):
+        """ Returns the templates of the side and their probabilities """
+        if not isinstance(side, Party):
+            return [side], [1.0]
+        template_specs = list(side.template_specs.select_related('template__race'))
+        weights = [max(mean(ttp.amount), 0) for ttp in template_specs]
+        if not template_specs or not sum(weights):
+            raise DuelError('%s has no enemies' % side.name)
+        return [ttp.template for ttp in template_specs], [weight / sum(weights) for weight in weights]
+
+    def _add(self, template, rows, generator):
+        amount = len(rows)
+        batch = _BatchRolls(template, amount, generator)
+        stats = batch.adjusted_stats
+        combat_styles = template.combat_styles
+        if combat_styles:
+            values = numpy.stack([compile_dice(cs.die_set).roll_many(amount, stats, generator)
+                                  for cs in combat_styles])
+            styles = values.argmax(axis=0)
+            self.skill[rows] = values.max(axis=0)
+        else:
+            styles = numpy.zeros(amount, dtype=numpy.int64)
+            self.skill[rows] = compile_dice('STR+DEX').roll_many(amount, stats, generator)
+        self.action_points[rows] = batch.action_points()
+        self.strike_rank[rows] = batch.strike_ranks()
+        for j in range(max(len(combat_styles), 1)):
+            style_rows = numpy.nonzero(styles == j)[0]
+            if len(style_rows):
+                options = self._weapon_options(combat_styles[j] if combat_styles else None)
+                probabilities = numpy.array([weight for _, weight in options], dtype=float)
+                chosen = generator.choice(len(options), size=len(style_rows), p=probabilities / probabilities.sum())
+                indexes = numpy.array([self._index(self.weapons, weapon) for weapon, _ in options])
+                self.weapon[rows[style_rows]] = indexes[chosen]
+        damage_modifiers = batch.damage_modifiers or ['+0'] * amount
+        self.damage_modifier[rows] = [self._index(self.damage_modifiers, dm) for dm in damage_modifiers]
+        for j, (hl, hit_points, armor) in enumerate(zip(template.hit_locations, batch.hit_point_totals(),
+                                                        batch.armor)):
+            self.hit_points[rows, j] = hit_points
+            self.armor[rows, j] = armor
+            start, end = self._range(hl.range)
+            self.location_table[rows, start:end + 1] = j
+
+    @staticmethod
+    def _weapon_options(combat_style):
+        """ Returns the melee weapons of the combat style as a list of ((damage, adds damage modifier),
+            probability). Falls back to the ranged weapons, and then to unarmed attacks. Weapons whose damage
+            is not a valid die set, e.g. a custom weapon with free text as damage, are left out.
+        """
+        for options in ((combat_style.one_h_options + combat_style.two_h_options, combat_style.ranged_options)
+                        if combat_style else ()):
+            output = [((w.damage or '0', bool(w.damage_modifier)), w.probability) for w in options
+                      if w.probability and w.probability > 0 and _valid_damage(w.damage or '0')]
+            if output:
+                return output
+        return [((UNARMED_DAMAGE, True), 1)]
+
+    @staticmethod
+    def _range(hit_location_range):
+        parts = hit_location_range.split('-')
+        return max(int(parts[0]), 1), min(int(parts[-1]), 20)
+
+    @staticmethod
+    def _index(values, value):
+        if value not in values:
+            values.append(value)
+        return values.index(value)
+
+    def roll_damage(self, rows, generator):
+        """ Rolls the damage of the attacks of the given rows, before armor """
+        output = numpy.zeros(len(rows), dtype=numpy.int64)
+        weapons = self.weapon[rows]
+        damage_modifiers = self.damage_modifier[rows]
+        for i in numpy.unique(weapons).tolist():
+            damage, adds_damage_modifier = self.weapons[i]
+            hits = weapons == i
+            output[hits] = compile_dice(damage).roll_many(int(hits.sum()), rng=generator)
+            if adds_damage_modifier:
+                for j in numpy.unique(damage_modifiers[hits]).tolist():
+                    modified = hits & (damage_modifiers == j)
+                    output[modified] += compile_dice(self.damage_modifiers[j]).roll_many(int(modified.sum()),
+                                                                                        rng=generator)
+        return output
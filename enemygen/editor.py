@@ -0,0 +1,322 @@
+"""
+Edits of single values made in the template, race and party editors.
+
+EDITS maps the object names posted by the editors to the edits. Most edits convert the posted value to a field
+of an instance looked up by id, and save only that field. The edits that create objects or touch more than one
+object are functions. The values are validated by the models, e.g. EnemyStat.clean_value.
+
+apply_edits() looks up the instances of a batch of edits with one query per model and applies the edits in order
+in one transaction. The valid field edits of an instance are saved together, before the next function edit and at
+the end, each instance in its own savepoint so that a failed save affects only the edits of that instance.
+The result of each edit is a dict with success, message, value and original_value, the value the field had
+before the edit, or with error if the edit could not be applied at all.
+"""
+from collections import OrderedDict, defaultdict
+
+from django.db import transaction
+
+from .dice import validate
+from .enemygen_lib import ValidationError, to_bool
+from .models import AdditionalFeatureList, CombatStyle, CustomSkill, CustomSpell, CustomWeapon
+from .models import EnemyAdditionalFeatureList, EnemyCult, EnemyHitLocation, EnemySkill, EnemySpell, EnemySpirit
+from .models import EnemyStat, EnemyTemplate, EnemyWeapon, HitLocation, Party, PartyAdditionalFeatureList, Race
+from .models import RaceStat, SpellAbstract, TemplateToParty, Weapon
+
+MAX_EDITS = 500     # Per batch
+INVALID_DIE_SET = '{} is not a valid die value.'
+INVALID_PROBABILITY = 'Probability must be a number.'
+
+
+def apply_edits(user, edits):
+    """ Applies the edits made by user in the order given. Each edit is a dict with object, id, value and optionally
+        parent_id. Returns the results in the order of the edits.
+    """
+    if len(edits) > MAX_EDITS:
+        raise ValueError('At most %s edits can be submitted at a time' % MAX_EDITS)
+    instances = _instances(user, edits)
+    results = [None] * len(edits)
+    pending = OrderedDict()  # instance: (names of the fields edited, indices of the results of the edits)
+    with transaction.atomic():
+        for index, edit in enumerate(edits):
+            try:
+                handler = _handler(edit)
+                if isinstance(handler, _Field):
+                    instance = instances.get(handler.model, {}).get(int(edit['id']))
+                    if instance is None:
+                        raise handler.model.DoesNotExist('%s %s does not exist' % (handler.model.__name__,
+                                                                                   edit['id']))
+                    results[index] = handler.set(instance, edit['value'])
+                    if results[index]['success']:
+                        names, indices = pending.setdefault(instance, (set(), []))
+                        names.add(handler.field)
+                        indices.append(index)
+                else:
+                    _save(pending, results)     # The function may read or write the same rows
+                    with transaction.atomic():
+                        results[index] = handler(user, int(edit['id']), edit.get('parent_id'), edit['value'])
+            except Exception as e:
+                results[index] = {'error': str(e)}
+        _save(pending, results)
+    return results
+
+
+def _save(pending, results):
+    """ Saves the edited fields of each instance in a savepoint of its own, so that a failed save affects only the
+        edits of that instance
+    """
+    for instance, (names, indices) in pending.items():
+        try:
+            with transaction.atomic():
+                instance.save(update_fields=sorted(names))
+        except Exception as e:
+            for index in indices:
+                results[index] = {'error': str(e)}
+    pending.clear()
+
+
+def _handler(edit):
+    try:
+        return EDITS[edit['object']]
+    except KeyError:
+        raise ValueError('Unknown object %s' % edit.get('object'))
+
+
+def _instances(user, edits):
+    """ Looks up the instances of the field edits with one query per model. Returns {model: {id: instance}} """
+    ids = defaultdict(set)
+    owners = {}
+    for edit in edits:
+        handler = EDITS.get(edit.get('object'))
+        if isinstance(handler, _Field):
+            try:
+                instance_id = int(edit['id'])
+            except (KeyError, TypeError, ValueError):
+                continue    # Reported when the edit is applied
+            ids[handler.model].add(instance_id)
+            owners[handler.model] = handler.owner
+    return dict((model, model.objects.filter(**{owners[model]: user}).in_bulk(model_ids))
+                for model, model_ids in ids.items())
+
+
+def _result(value, original_value=None, success=True, message=''):
+    return {'success': success, 'message': message, 'value': value, 'original_value': original_value}
+
+
+class _Field(object):
+    """ Sets the value to a field of an instance of model. convert turns the posted value to the value of the field,
+        raising ValueError with an invalid value. owner is the lookup from the model to the user owning it.
+    """
+    def __init__(self, model, field, owner, convert=None, message=''):
+        self.model = model
+        self.field = field
+        self.owner = owner
+        self.convert = convert or (lambda value: value)
+        self.message = message
+
+    def set(self, instance, value):
+        original_value = getattr(instance, self.field)
+        try:
+            converted = self.convert(value)
+        except ValueError:
+            return _result(value, original_value, False, self.message.format(value))
+        setattr(instance, self.field, converted)
+        return _result(converted, original_value)
+
+
+def _lower(value):
+    return value.lower()
+
+
+def _die_set(value):
+    validate(value)
+    return value
+
+
+def _namelist(value):
+    try:
+        return AdditionalFeatureList.objects.get(type='name', id=value).id
+    except (AdditionalFeatureList.DoesNotExist, ValueError):
+        return None
+
+
+def _enemy_spell(user, spell_id, template_id):
+    sa = SpellAbstract.objects.get(id=spell_id)
+    et = EnemyTemplate.objects.get(id=template_id, owner=user)
+    try:
+        return EnemySpell.objects.get(spell=sa, enemy_template=et)
+    except EnemySpell.DoesNotExist:
+        return EnemySpell(spell=sa, enemy_template=et, detail=sa.default_detail, probability=1)
+
+
+def _spell_probability(user, id, parent_id, value):
+    es = _enemy_spell(user, id, parent_id)
+    try:
+        probability = int(value)
+    except ValueError:
+        return _result(value, es.probability, False, INVALID_PROBABILITY)
+    original_value = es.probability
+    es.set_probability(probability)
+    return _result(probability, original_value)
+
+
+def _spell_detail(user, id, parent_id, value):
+    es = _enemy_spell(user, id, parent_id)
+    original_value = es.detail
+    es.detail = value
+    es.save()
+    return _result(value, original_value)
+
+
+def _weapon_probability(user, id, parent_id, value):
+    we = Weapon.objects.get(id=id)
+    cs = CombatStyle.objects.get(id=parent_id, enemy_template__owner=user)
+    try:
+        ew = EnemyWeapon.objects.get(weapon=we, combat_style=cs)
+    except EnemyWeapon.DoesNotExist:
+        ew = EnemyWeapon.create(cs, we, 1)
+    try:
+        probability = int(value)
+    except ValueError:
+        return _result(value, ew.probability, False, INVALID_PROBABILITY)
+    original_value = ew.probability
+    ew.set_probability(probability)
+    return _result(probability, original_value)
+
+
+def _party_template_amount(user, id, parent_id, value):
+    ttp = TemplateToParty.objects.get(template=id, party=parent_id, party__owner=user)
+    try:
+        validate(value)
+    except ValueError:
+        return _result(value, ttp.amount, False, INVALID_DIE_SET.format(value))
+    original_value = ttp.amount
+    ttp.amount = value
+    ttp.save(update_fields=['amount'])
+    return _result(value, original_value)
+
+
+def _published(model):
+    def edit(user, id, parent_id, value):
+        instance = model.objects.get(id=id, owner=user)
+        original_value = instance.published
+        try:
+            instance.set_published(to_bool(value))
+        except ValidationError:
+            return _result(value, original_value, False, 'Something is wrong with the template')
+        return _result(value, original_value)
+    return edit
+
+
+def _add_tags(model):
+    def edit(user, id, parent_id, value):
+        instance = model.objects.get(id=id, owner=user)
+        instance.tags.add(*[tag.strip().capitalize() for tag in value.split(',')])
+        return _result(value)
+    return edit
+
+
+def _remove_tag(model):
+    def edit(user, id, parent_id, value):
+        instance = model.objects.get(id=id, owner=user)
+        instance.tags.remove(value.capitalize())
+        return _result(value)
+    return edit
+
+
+_TEMPLATE = 'enemy_template__owner'
+_WEAPON = 'combat_style__enemy_template__owner'
+_RACE = 'race__owner'
+
+EDITS = {
+    # Basics
+    'et_name': _Field(EnemyTemplate, 'name', 'owner'),
+    'et_namelist': _Field(EnemyTemplate, 'namelist_id', 'owner', _namelist),
+    'et_rank': _Field(EnemyTemplate, 'rank', 'owner', int),
+    'et_cult_rank': _Field(EnemyTemplate, 'cult_rank', 'owner', int),
+    'et_published': _Field(EnemyTemplate, 'published', 'owner', to_bool),
+    'et_natural_armor': _Field(EnemyTemplate, 'natural_armor', 'owner', to_bool),
+
+    # Attributes
+    'et_stat_value': _Field(EnemyStat, 'die_set', _TEMPLATE, EnemyStat.clean_value, INVALID_DIE_SET),
+    'et_hl_armor': _Field(EnemyHitLocation, 'armor', _TEMPLATE, EnemyHitLocation.clean_armor, 'Not a valid dice set'),
+    'et_movement': _Field(EnemyTemplate, 'movement', 'owner'),
+
+    # Skills
+    'et_skill_value': _Field(EnemySkill, 'die_set', _TEMPLATE, EnemySkill.clean_value, INVALID_DIE_SET),
+    'et_skill_include': _Field(EnemySkill, 'include', _TEMPLATE, to_bool),
+    'et_custom_skill_value': _Field(CustomSkill, 'die_set', _TEMPLATE, CustomSkill.clean_value, INVALID_DIE_SET),
+    'et_custom_skill_include': _Field(CustomSkill, 'include', _TEMPLATE, to_bool),
+    'et_custom_skill_name': _Field(CustomSkill, 'name', _TEMPLATE),
+
+    # Spells, spirits and cults
+    'et_spell_prob': _spell_probability,
+    'et_spell_detail': _spell_detail,
+    'et_custom_spell_prob': _Field(CustomSpell, 'probability', _TEMPLATE, CustomSpell.clean_probability,
+                                   INVALID_PROBABILITY),
+    'et_custom_spell_name': _Field(CustomSpell, 'name', _TEMPLATE),
+    'et_folk_spell_amount': _Field(EnemyTemplate, 'folk_spell_amount', 'owner', _die_set, INVALID_DIE_SET),
+    'et_theism_spell_amount': _Field(EnemyTemplate, 'theism_spell_amount', 'owner', _die_set, INVALID_DIE_SET),
+    'et_sorcery_spell_amount': _Field(EnemyTemplate, 'sorcery_spell_amount', 'owner', _die_set, INVALID_DIE_SET),
+    'et_mysticism_spell_amount': _Field(EnemyTemplate, 'mysticism_spell_amount', 'owner', _die_set,
+                                        INVALID_DIE_SET),
+    'et_spirit_amount': _Field(EnemyTemplate, 'spirit_amount', 'owner', _die_set, INVALID_DIE_SET),
+    'et_spirit_prob': _Field(EnemySpirit, 'probability', _TEMPLATE, int, INVALID_PROBABILITY),
+    'et_cult_amount': _Field(EnemyTemplate, 'cult_amount', 'owner', _die_set, INVALID_DIE_SET),
+    'et_cult_prob': _Field(EnemyCult, 'probability', _TEMPLATE, int, INVALID_PROBABILITY),
+
+    # Weapons and Combat Styles
+    'et_combat_style_name': _Field(CombatStyle, 'name', _TEMPLATE),
+    'et_combat_style_value': _Field(CombatStyle, 'die_set', _TEMPLATE, CombatStyle.clean_value, INVALID_DIE_SET),
+    'et_one_h_amount': _Field(CombatStyle, 'one_h_amount', _TEMPLATE, CombatStyle.clean_amount, INVALID_DIE_SET),
+    'et_two_h_amount': _Field(CombatStyle, 'two_h_amount', _TEMPLATE, CombatStyle.clean_amount, INVALID_DIE_SET),
+    'et_ranged_amount': _Field(CombatStyle, 'ranged_amount', _TEMPLATE, CombatStyle.clean_amount, INVALID_DIE_SET),
+    'et_shield_amount': _Field(CombatStyle, 'shield_amount', _TEMPLATE, CombatStyle.clean_amount, INVALID_DIE_SET),
+    'et_weapon_prob': _weapon_probability,
+
+    # Custom weapon
+    'et_custom_weapon_prob': _Field(CustomWeapon, 'probability', _WEAPON, CustomWeapon.clean_probability,
+                                    INVALID_PROBABILITY),
+    'et_custom_weapon_name': _Field(CustomWeapon, 'name', _WEAPON),
+    'et_custom_weapon_damage': _Field(CustomWeapon, 'damage', _WEAPON, _lower),
+    'et_custom_weapon_ap': _Field(CustomWeapon, 'ap', _WEAPON, int, 'AP must be a number.'),
+    'et_custom_weapon_hp': _Field(CustomWeapon, 'hp', _WEAPON, int, 'HP must be a number.'),
+    'et_custom_weapon_size': _Field(CustomWeapon, 'size', _WEAPON),
+    'et_custom_weapon_reach': _Field(CustomWeapon, 'reach', _WEAPON),
+    'et_custom_weapon_range': _Field(CustomWeapon, 'range', _WEAPON),
+    'et_custom_weapon_type': _Field(CustomWeapon, 'type', _WEAPON),
+    'et_custom_weapon_damage_modifier': _Field(CustomWeapon, 'damage_modifier', _WEAPON, to_bool),
+    'et_custom_weapon_natural_weapon': _Field(CustomWeapon, 'natural_weapon', _WEAPON, to_bool),
+    'et_custom_weapon_ap_hp_as_per': _Field(CustomWeapon, 'ap_hp_as_per', _WEAPON),
+    'et_custom_weapon_special_effects': _Field(CustomWeapon, 'special_effects', _WEAPON),
+
+    # Race
+    'race_name': _Field(Race, 'name', 'owner'),
+    'race_published': _published(Race),
+    'race_movement': _Field(Race, 'movement', 'owner'),
+    'race_stat_value': _Field(RaceStat, 'default_value', _RACE, RaceStat.clean_value, '{} is not a valid die set.'),
+    'race_hl_range_start': _Field(HitLocation, 'range_start', _RACE, int, 'Range must be a number'),
+    'race_hl_range_end': _Field(HitLocation, 'range_end', _RACE, int, 'Range must be a number'),
+    'race_hl_name': _Field(HitLocation, 'name', _RACE),
+    'race_hl_hp_modifier': _Field(HitLocation, 'hp_modifier', _RACE, _die_set,
+                                  'HP Modifier must be a number or a valid die'),
+    'race_hl_armor': _Field(HitLocation, 'armor', _RACE, HitLocation.clean_armor, '{} is not a valid die set.'),
+    'race_notes': _Field(Race, 'special', 'owner'),
+    'race_discorporate': _Field(Race, 'discorporate', 'owner', to_bool),
+
+    # Party
+    'party_name': _Field(Party, 'name', 'owner'),
+    'party_template_amount': _party_template_amount,
+    'party_published': _published(Party),
+    'party_notes': _Field(Party, 'notes', 'owner'),
+    'party_newtag': _add_tags(Party),
+    'party_deltag': _remove_tag(Party),
+
+    # Misc
+    'et_notes': _Field(EnemyTemplate, 'notes', 'owner'),
+    'et_newtag': _add_tags(EnemyTemplate),
+    'et_deltag': _remove_tag(EnemyTemplate),
+    'et_feature_prob': _Field(EnemyAdditionalFeatureList, 'probability', _TEMPLATE,
+                              EnemyAdditionalFeatureList.clean_probability),
+    'party_feature_prob': _Field(PartyAdditionalFeatureList, 'probability', 'party__owner',
+                                 PartyAdditionalFeatureList.clean_probability),
+}
@@ -1,23 +1,85 @@
-import random
+from .rng import current_rng
 
 
-def select_random_items(item_list, amount):
+def select_random_items(item_list, amount, rng=None):
     """ Randomly selects the given amount of items from the given list
         Input: item_list: List of items where to pick from. The items on the list need to have the attribute
                'probability'
                amount: amount of items to be selected
+        Items are not selected twice. Selection stops early if no item with a positive probability is left.
     """
-    output = []
-    selected_items = []
-    for x in range(amount):
-        item = select_random_item(item_list, selected_items)
-        selected_items.append(item)
-        output.append(item)
+    output = WeightedSampler(item_list).sample(amount, rng)
     output.sort(key=lambda item: item.name)
     return output
 
 
-def select_random_item(items, exclude=()):
+def select_random_items_batch(item_list, amounts, rng=None):
+    """ Same as select_random_items, but makes one selection per amount in amounts from the same pool.
+        The pool is indexed only once, e.g. for the spells of all the enemies of a batch.
+    """
+    sampler = WeightedSampler(item_list)
+    output = []
+    for amount in amounts:
+        selection = sampler.sample(amount, rng)
+        selection.sort(key=lambda item: item.name)
+        output.append(selection)
+    return output
+
+
+class WeightedSampler(object):
+    """ Weighted random sampling without replacement. The weights are kept in a Fenwick tree, so that
+        drawing k items out of n costs O(n + k log n) instead of rescanning the list for every draw.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self.weights = [max(item.probability or 0, 0) for item in self.items]
+        self.tree = [0] + self.weights
+        size = len(self.tree)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+        self.selectable = [item for item, weight in zip(self.items, self.weights) if weight > 0]
+        self.top_bit = 1 << (len(self.items).bit_length() - 1) if self.items else 0
+
+    def sample(self, amount, rng=None):
+        """ Returns a list of up to amount distinct items, in the order they were drawn. When amount covers all
+            the items with a positive weight, they are returned as such without drawing.
+        """
+        if amount >= len(self.selectable):
+            return list(self.selectable)    # Everything gets selected anyway, e.g. all the spells of a cult
+        rng = rng or current_rng()
+        tree = list(self.tree)
+        total = self.total
+        output = []
+        for x in range(min(amount, len(self.items))):
+            if total <= 0:
+                break
+            index = self._find(tree, rng.randint(1, total))
+            weight = self.weights[index]
+            output.append(self.items[index])
+            total -= weight
+            i = index + 1
+            while i < len(tree):
+                tree[i] -= weight
+                i += i & -i
+        return output
+
+    def _find(self, tree, n):
+        """ Returns the index of the item, where the cumulative weight reaches n """
+        position = 0
+        bit = self.top_bit
+        while bit:
+            next_position = position + bit
+            if next_position < len(tree) and tree[next_position] < n:
+                position = next_position
+                n -= tree[next_position]
+            bit >>= 1
+        return position
+
+
+def select_random_item(items, exclude=(), rng=None):
     """ Input: List of items. The items need to have attribute 'probability' of type int 
                Optional: Items to be excluded
         Output: Randomly selected item from the list, based on the item probability
@@ -26,7 +88,7 @@ def select_random_item(items, exclude=()):
     for item in items:
         if item not in exclude:
             weight_total += item.probability
-    n = random.randint(1, weight_total)
+    n = (rng or current_rng()).randint(1, weight_total)
     for item in items:
         if item not in exclude:
             if n <= item.probability:
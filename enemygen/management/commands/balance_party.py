@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from enemygen import balancing, duel
+from enemygen.models import Party
+
+
+class Command(BaseCommand):
+    help = 'Searches the amounts of the templates of a party that make it win the target share of battles ' \
+           'against an opponent party, and writes the result as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('party_id', type=int, help='Id of the party to balance')
+        parser.add_argument('opponent_id', type=int, help='Id of the opponent party')
+        parser.add_argument('--low', type=float, default=balancing.DEFAULT_TARGET[0],
+                            help='Lowest acceptable share of battles won')
+        parser.add_argument('--high', type=float, default=balancing.DEFAULT_TARGET[1],
+                            help='Highest acceptable share of battles won')
+        parser.add_argument('--max', type=int, default=balancing.DEFAULT_MAX_AMOUNT,
+                            help='Max amount of each template')
+        parser.add_argument('--seed', type=int, help='The same seed always gives the same results')
+        parser.add_argument('--apply', action='store_true', help='Save the amounts found to the party')
+
+    def handle(self, *args, **options):
+        party = self._party(options['party_id'])
+        opponent = self._party(options['opponent_id'])
+        try:
+            result = balancing.balance(party, opponent, (options['low'], options['high']), options['max'],
+                                       options['seed'])
+        except duel.DuelError as e:
+            raise CommandError(str(e))
+        if options['apply']:
+            balancing.apply(party, result)
+        self.stdout.write(json.dumps(result, indent=2))
+
+    @staticmethod
+    def _party(party_id):
+        try:
+            return Party.objects.get(id=party_id)
+        except Party.DoesNotExist:
+            raise CommandError('Party %s does not exist' % party_id)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from enemygen import bulk
+from enemygen.models import EnemyTemplate
+from enemygen.views_lib import iter_json
+
+
+class Command(BaseCommand):
+    help = 'Generates enemies in parallel worker processes and writes them as a JSON array'
+
+    def add_arguments(self, parser):
+        parser.add_argument('requests', nargs='+', metavar='TEMPLATE_ID:AMOUNT',
+                            help='Id of the enemy template and the amount of enemies to generate from it')
+        parser.add_argument('--seed', type=int, help='Master seed. The same seed always gives the same enemies.')
+        parser.add_argument('--workers', type=int, help='Amount of worker processes. Defaults to the amount of CPUs.')
+        parser.add_argument('--output', help='File to write the JSON to. Defaults to stdout.')
+
+    def handle(self, *args, **options):
+        requests = [self._parse(request) for request in options['requests']]
+        enemies = bulk.iter_generate(requests, options['seed'], options['workers'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                for piece in iter_json(enemies):
+                    output.write(piece)
+        else:
+            for piece in iter_json(enemies):
+                self.stdout.write(piece, ending='')
+            self.stdout.write('')
+
+    @staticmethod
+    def _parse(request):
+        try:
+            template_id, amount = request.split(':')
+            template_id, amount = int(template_id), int(amount)
+        except ValueError:
+            raise CommandError('Invalid request "%s". Use TEMPLATE_ID:AMOUNT.' % request)
+        try:
+            return EnemyTemplate.objects.get(id=template_id), amount
+        except EnemyTemplate.DoesNotExist:
+            raise CommandError('Enemy template %s does not exist' % template_id)
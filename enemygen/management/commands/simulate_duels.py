@@ -0,0 +1,37 @@
+import json
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+
+from enemygen import duel
+from enemygen.models import EnemyTemplate, Party
+
+
+class Command(BaseCommand):
+    help = 'Simulates duels between two enemy templates or parties and writes the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('side_a', metavar='A', help='Id of an enemy template, or party:ID for a party')
+        parser.add_argument('side_b', metavar='B', help='Id of an enemy template, or party:ID for a party')
+        parser.add_argument('--duels', type=int, default=duel.DEFAULT_DUELS, help='Amount of duels to simulate')
+        parser.add_argument('--seed', type=int, help='The same seed always gives the same results')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed']) if options['seed'] is not None else None
+        try:
+            result = duel.simulate(self._side(options['side_a']), self._side(options['side_b']),
+                                   options['duels'], rng)
+        except duel.DuelError as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps(result, indent=2))
+
+    @staticmethod
+    def _side(side):
+        model, _, object_id = side.rpartition(':')
+        model = {'': EnemyTemplate, 'template': EnemyTemplate, 'party': Party}.get(model)
+        try:
+            return model.objects.get(id=int(object_id))
+        except (AttributeError, ValueError):
+            raise CommandError('Invalid side "%s". Use ID or party:ID.' % side)
+        except (EnemyTemplate.DoesNotExist, Party.DoesNotExist):
+            raise CommandError('%s does not exist' % side)
@@ -1,17 +1,23 @@
 # pylint: disable=no-member
 
-from django.db.models import Q
-from django.db import models
+from django.db.models import Max, Q, Value
+from django.db.models.functions import Concat
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
-from .enemygen_lib import ValidationError, replace_die_set, select_random_items
-from .dice import Dice, clean
+from . import counters
+from .enemygen_lib import ValidationError, WeightedSampler, select_random_items
+from .dice import clean, compile_dice, distribution, numpy_rng, validate
+from .rng import current_rng, spawn
 from taggit.managers import TaggableManager
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict, namedtuple
+from itertools import chain
 import random
 import math
 
+import numpy
+
 WEAPON_TYPE_CHOICES = (('1h-melee', '1-h Melee'), ('2h-melee', '2-h Melee'), ('ranged', 'Ranged'), ('shield', 'Shield'))
 WEAPON_SIZE_CHOICES = (('S', 'S'), ('M', 'M'), ('L', 'L'), ('H', 'H'), ('E', 'E'), ('C', 'C'))
 WEAPON_REACH_CHOICES = (('-', '-'), ('T', 'T'), ('S', 'S'), ('M', 'M'), ('L', 'L'), ('VL', 'VL'), ('U', 'U'))
@@ -20,6 +26,16 @@ DICE_STEPS = ('-1d8', '-1d6', '-1d4', '-1d2', '+0', '+1d2', '+1d4', '+1d6', '+1d
               '+3d10', '+3d10+1d2', '+3d10+1d4', '+3d10+1d6', '+3d10+1d8',
               '+4d10', '+4d10+1d2', '+4d10+1d4', '+4d10+1d6', '+4d10+1d8',
               '+5d10', '+5d10+1d2', '+5d10+1d4', '+5d10+1d6', '+5d10+1d8')
+SPIRIT_DAMAGE_STEPS = ('0', '1d2', '1d4', '1d6', '1d8', '1d10', '2d6', '1d8+1d6', '2d8', '1d10+1d8', '2d10',
+                       '2d10+1d2', '2d10+1d4', '2d10+1d6', '2d10+1d8', '3d10', '3d10+1d2', '3d10+1d4')
+FAN_OUT_BATCH = 500  # Rows inserted at a time when a race edit is copied to its templates
+MAX_NESTING = 5     # Max depth of the spirits and cults of an enemy, the enemy itself included
+# (name, range start, range end, hp modifier) of the hit locations of a new race
+DEFAULT_HIT_LOCATIONS = (('Right leg', 1, 3, 0), ('Left leg', 4, 6, 0), ('Abdomen', 7, 9, 1), ('Chest', 10, 12, 2),
+                         ('Right Arm', 13, 15, -1), ('Left Arm', 16, 18, -1), ('Head', 19, 20, 0))
+SPIRIT_SKILLS = ('Discorporate', 'Spectral Combat', 'Stealth', 'Willpower', 'Folk Magic', 'Devotion', 'Exhort',
+                 'Invocation', 'Shaping', 'Binding', 'Trance')
+SPIRIT_SKILL_DIE_SETS = {'Stealth': 'INT+CHA+50', 'Willpower': 'POW+POW+50'}   # Replace the defaults for spirits
 
 
 class Ruleset(models.Model):
@@ -75,18 +91,15 @@ class Race(models.Model):
         
     @classmethod
     def create(cls, owner, name="New race"):
-        race = cls(name=name, owner=owner)
-        race.save()
-        for stat in StatAbstract.objects.all():
-            rs = RaceStat(stat=stat, race=race, default_value='3D6')
-            rs.save()
-        HitLocation(name='Right leg', range_start=1, range_end=3, race=race, hp_modifier=0).save()
-        HitLocation(name='Left leg', range_start=4, range_end=6, race=race, hp_modifier=0).save()
-        HitLocation(name='Abdomen', range_start=7, range_end=9, race=race, hp_modifier=1).save()
-        HitLocation(name='Chest', range_start=10, range_end=12, race=race, hp_modifier=2).save()
-        HitLocation(name='Right Arm', range_start=13, range_end=15, race=race, hp_modifier=-1).save()
-        HitLocation(name='Left Arm', range_start=16, range_end=18, race=race, hp_modifier=-1).save()
-        HitLocation(name='Head', range_start=19, range_end=20, race=race, hp_modifier=0).save()
+        """ Creates a race with 3D6 for every stat and the humanoid hit locations """
+        with transaction.atomic():
+            race = cls(name=name, owner=owner)
+            race.save()
+            RaceStat.objects.bulk_create([RaceStat(stat_id=stat_id, race=race, default_value='3D6')
+                                          for stat_id in StatAbstract.objects.values_list('id', flat=True)])
+            HitLocation.objects.bulk_create([HitLocation(name=hl_name, range_start=start, range_end=end, race=race,
+                                                         hp_modifier=hp_modifier)
+                                             for hl_name, start, end, hp_modifier in DEFAULT_HIT_LOCATIONS])
         return race
         
     def set_published(self, published):
@@ -113,6 +126,16 @@ class Race(models.Model):
     def templates(self):
         return EnemyTemplate.objects.filter(race=self)
 
+    def apply_notes(self, owner, notes):
+        """ Appends notes to the templates of the race owned by owner that don't contain them yet, with a single
+            update. Signals are not sent, so the caller is responsible for invalidating cached templates.
+            Returns the ids of the templates updated.
+        """
+        templates = self.templates.filter(owner=owner).exclude(notes__contains=notes)
+        template_ids = list(templates.values_list('id', flat=True))
+        EnemyTemplate.objects.filter(id__in=template_ids).update(notes=Concat('notes', Value('\n' + notes)))
+        return template_ids
+
     def clone(self, owner):
         race = Race(name='Copy of %s' % self.name, owner=owner, movement=self.movement, special=self.special)
         race.save()
@@ -148,27 +171,47 @@ class HitLocation(models.Model):
             return '%02d-%02d' % (int(self.range_start), int(self.range_end))
             
     @classmethod
-    def create(cls, race_id):
-        biggest_range = 1
+    def create(cls, race_id, fan_out=True):
+        """ Creates a new hit location after the existing ones of the race. With fan_out, the hit location is
+            added also to the existing templates of the race.
+        """
         race = Race.objects.get(id=race_id)
-        for hl in HitLocation.objects.filter(race=race):
-            biggest_range = max(hl.range_end, biggest_range)
+        biggest_range = HitLocation.objects.filter(race=race).aggregate(biggest=Max('range_end'))['biggest'] or 1
         range_start = min(biggest_range+1, 20)
         range_end = min(biggest_range+3, 20)
-        hl = HitLocation(name='New hit location', range_start=range_start, range_end=range_end, race=race)
-        hl.save()
-        
-        # Add the new hitlocation also to any existing templates
-        for et in race.templates:
-            EnemyHitLocation.create(hl, et)
-        
+        with transaction.atomic():
+            hl = HitLocation(name='New hit location', range_start=range_start, range_end=range_end, race=race)
+            hl.save()
+            if fan_out:
+                hl.add_to_templates(race.templates.values_list('id', flat=True))
         return hl
-        
-    def set_armor(self, value):
+
+    def add_to_templates(self, template_ids):
+        """ Adds the hit location to the given templates with batched inserts. Returns the amount of templates. """
+        ehls = [EnemyHitLocation(hit_location=self, enemy_template_id=template_id, armor=self.armor)
+                for template_id in template_ids]
+        EnemyHitLocation.objects.bulk_create(ehls, batch_size=FAN_OUT_BATCH)
+        return len(ehls)
+
+    def remove(self):
+        """ Deletes the hit location and its copies in the templates of the race. Returns the ids of the templates
+            that had the hit location.
+        """
+        with transaction.atomic():
+            template_ids = list(EnemyHitLocation.objects.filter(hit_location=self)
+                                .values_list('enemy_template_id', flat=True))
+            self.delete()
+        return template_ids
+
+    @staticmethod
+    def clean_armor(value):
         if not value:
             value = '0'
-        Dice(value).roll()  # Test that the value is valid
-        self.armor = value.lower()
+        validate(value)
+        return value.lower()
+
+    def set_armor(self, value):
+        self.armor = self.clean_armor(value)
         self.save()
 
 
@@ -205,46 +248,45 @@ class EnemyTemplate(models.Model):
 
     @classmethod
     def create(cls, owner, ruleset, race, name="Enemy Template"):
-        enemy_template = cls(name=name, owner=owner, ruleset=ruleset, race=race)
-        enemy_template.notes = race.special
-        enemy_template.movement = race.movement
-        enemy_template.save()
-        if name == 'Enemy Template':
-            enemy_template.name = '%s Template %s' % (race.name, enemy_template.id)
+        """ Creates a template with the stats of the race and the skills, hit locations and combat style of its
+            kind. The rows are built in memory and inserted with one query per model, in one transaction.
+        """
+        with transaction.atomic():
+            enemy_template = cls(name=name, owner=owner, ruleset=ruleset, race=race)
+            enemy_template.notes = race.special
+            enemy_template.movement = race.movement
             enemy_template.save()
-        for stat in race.stats:
-            es = EnemyStat(stat=stat.stat, enemy_template=enemy_template, die_set=stat.default_value)
-            es.save()
-        if enemy_template.is_spirit:
-            enemy_template._create_spirit_template()
-        elif enemy_template.is_cult:
-            pass
-        else:
-            enemy_template._create_normal_template()
+            if name == 'Enemy Template':
+                enemy_template.name = '%s Template %s' % (race.name, enemy_template.id)
+                enemy_template.save(update_fields=['name'])
+            EnemyStat.objects.bulk_create([EnemyStat(stat_id=rs.stat_id, enemy_template=enemy_template,
+                                                     die_set=rs.default_value) for rs in race.stats])
+            if enemy_template.is_spirit:
+                enemy_template._create_spirit_template()
+            elif enemy_template.is_cult:
+                pass
+            else:
+                enemy_template._create_normal_template()
         return enemy_template
     
     def _create_normal_template(self):
-        spirit_skills = ('Spectral Combat', 'Discorporate')
-        for skill in self.ruleset.skills.all().exclude(name__in=spirit_skills):
-            es = EnemySkill(skill=skill, enemy_template=self, die_set=skill.default_value, include=skill.include)
-            es.save()
-        for hit_location in self.race.hit_locations:
-            EnemyHitLocation.create(hit_location, self)
+        skills = self.ruleset.skills.all().exclude(name__in=('Spectral Combat', 'Discorporate'))
+        self._create_skills(skills)
+        EnemyHitLocation.objects.bulk_create([EnemyHitLocation(hit_location=hit_location, enemy_template=self,
+                                                               armor=hit_location.armor)
+                                              for hit_location in self.race.hit_locations])
         cs = CombatStyle(name="Primary Combat Style", enemy_template=self)
         cs.save()
         
     def _create_spirit_template(self):
-        skill_names = ('Discorporate', 'Spectral Combat', 'Stealth', 'Willpower', 'Folk Magic', 'Devotion',
-                       'Exhort', 'Invocation', 'Shaping', 'Binding', 'Trance')
-        for skill in self.ruleset.skills.filter(name__in=skill_names):
-            es = EnemySkill(skill=skill, enemy_template=self, die_set=skill.default_value, include=skill.include)
-            es.save()
-        es = EnemySkill.objects.get(skill__name='Stealth', enemy_template=self)
-        es.die_set = 'INT+CHA+50'
-        es.save()
-        es = EnemySkill.objects.get(skill__name='Willpower', enemy_template=self)
-        es.die_set = 'POW+POW+50'
-        es.save()
+        self._create_skills(self.ruleset.skills.filter(name__in=SPIRIT_SKILLS), SPIRIT_SKILL_DIE_SETS)
+
+    def _create_skills(self, skills, die_sets=None):
+        """ Inserts EnemySkills of the SkillAbstracts, with their defaults unless given in die_sets by name """
+        die_sets = die_sets or {}
+        EnemySkill.objects.bulk_create([EnemySkill(skill=skill, enemy_template=self, include=skill.include,
+                                                   die_set=die_sets.get(skill.name, skill.default_value))
+                                        for skill in skills])
         
     @property
     def get_cult_rank(self):
@@ -299,23 +341,50 @@ class EnemyTemplate(models.Model):
         except EnemySkill.DoesNotExist:
             return False
     
-    def generate(self, suffix=None, increment=False):
+    def generate(self, suffix=None, increment=False, rolls=None):
+        """ Generates an enemy based on the template. rolls is one of the rows returned by roll_batch() """
         if increment:
-            self.generated += 1
-            self.save()
+            self.increment_generated()
+        return self.compile().generate(suffix, rolls)
+
+    def roll_batch(self, amount):
+        """ Rolls the stats, skills and hit location armor for the given amount of enemies column-wise.
+            Returns a list of rows, one for each enemy, to be passed to generate()
+        """
+        return self.compile().roll_batch(amount)
+
+    def generate_many(self, amount, seed=None, increment=False):
+        """ Generates the given amount of enemies. See CompiledTemplate.generate_many """
+        if increment:
+            self.increment_generated(amount)
+        return self.compile().generate_many(amount, seed)
+
+    def compile(self):
+        """ Returns a CompiledTemplate snapshot of the template, which generates enemies without queries.
+            Compile once and generate many times from the result when generating several enemies.
+        """
+        return CompiledTemplate.load([self])[0]
+
+    @property
+    def enemy_class(self):
         if self.is_spirit:
-            return _Spirit(self).generate(suffix)
+            return _Spirit
         elif self.is_elemental:
-            return _Elemental(self).generate(suffix)
+            return _Elemental
         elif self.is_cult:
-            return _Cult(self).generate(suffix)
+            return _Cult
         else:
-            return _Enemy(self).generate(suffix)
+            return _Enemy
 
     def increment_used(self):
-        """ Increments the used-count by one. """
+        """ Increments the used-count by one. The database is updated later, see counters. """
         self.used += 1
-        self.save()
+        counters.increment(self.id, used=1)
+
+    def increment_generated(self, amount=1):
+        """ Increments the generated-count by the given amount. The database is updated later, see counters. """
+        self.generated += amount
+        counters.increment(self.id, generated=amount)
         
     def get_tags(self):
         return sorted(list(self.tags.names()))
@@ -446,6 +515,13 @@ class EnemyTemplate(models.Model):
         EnemyNonrandomFeature.create(enemy_template=self, feature_id=feature_id)
         
     def clone(self, owner):
+        """ Copies the template and everything that belongs to it for owner. The rows of each model are copied
+            with one insert, so cloning takes the same amount of queries whatever the size of the template.
+        """
+        with transaction.atomic():
+            return self._clone(owner)
+
+    def _clone(self, owner):
         name = "Copy of %s" % self.name
         new = EnemyTemplate(owner=owner, ruleset=self.ruleset, race=self.race, name=name)
         new.movement = self.movement
@@ -461,58 +537,44 @@ class EnemyTemplate(models.Model):
         new.namelist = self.namelist
         new.natural_armor = self.natural_armor
         new.save()
-        for tag in self.tags.all():
-            new.tags.add(tag)
-        for stat in self.stats:
-            es = EnemyStat(stat=stat.stat, enemy_template=new, die_set=stat.die_set)
-            es.save()
-        for hl in self.hit_locations:
-            EnemyHitLocation.create(hl.hit_location, enemy_template=new, armor=hl.armor)
-        for skill in self.raw_skills:
-            es = EnemySkill(skill=skill.skill, enemy_template=new, die_set=skill.die_set, include=skill.include)
-            es.save()
-        for skill in self.custom_skills:
-            es = CustomSkill(name=skill.name, enemy_template=new, die_set=skill.die_set, include=skill.include)
-            es.save()
-        for combat_style in self.combat_styles:
-            combat_style.clone(new)
-        for spell in EnemySpell.objects.filter(enemy_template=self):
-            s = EnemySpell(enemy_template=new, spell=spell.spell, probability=spell.probability, detail=spell.detail)
-            s.save()
-        for spell in CustomSpell.objects.filter(enemy_template=self):
-            s = CustomSpell(enemy_template=new, name=spell.name, probability=spell.probability, type=spell.type)
-            s.save()
-        for spirit in EnemySpirit.objects.filter(enemy_template=self):
-            es = EnemySpirit(enemy_template=new, spirit=spirit.spirit, probability=spirit.probability)
-            es.save()
-        for cult in EnemyCult.objects.filter(enemy_template=self):
-            es = EnemyCult(enemy_template=new, cult=cult.cult, probability=cult.probability)
-            es.save()
-        for af in self.additional_features:
-            EnemyAdditionalFeatureList.create(new, af.feature_list.id, af.probability)
-        for nrf in self.nonrandom_features:
-            EnemyNonrandomFeature.create(new, nrf.feature.id)
+        _copy_tags(self, new)
+        # The post_save signals of the bulk inserted rows aren't sent. The template is new, so there's nothing
+        # cached for it to invalidate.
+        for model in (EnemyStat, EnemyHitLocation, EnemySkill, CustomSkill, EnemySpell, CustomSpell, EnemySpirit,
+                      EnemyCult, EnemyAdditionalFeatureList, EnemyNonrandomFeature):
+            model.objects.bulk_create(_copies(model.objects.filter(enemy_template=self), enemy_template_id=new.id))
+        CombatStyle.clone_all(self, new)
         return new
 
     def apply_skill_bonus(self, bonus):
+        """ Adds bonus to the skills, custom skills and combat styles of the template. All the new values are
+            validated before any of them is saved, and each model is saved with a single update.
+        """
+        from . import template_cache    # Not at the top, as template_cache imports this module
         if len(bonus) == 0:
             return
-        # Validate bonus
-        replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
-        temp_value = replace_die_set(bonus, replace)
-        Dice(temp_value).roll()
+        validate(bonus, stats=True)
         
         bonus = bonus.upper()
 
         if bonus[0] != '+':
             bonus = '+' + bonus
-            
-        for skill in self.raw_skills:
-            skill.set_value(skill.die_set + bonus)
-        for skill in self.custom_skills:
-            skill.set_value(skill.die_set + bonus)
-        for combat_style in self.combat_styles:
-            combat_style.set_value(combat_style.die_set + bonus)
+
+        groups = [(model, list(model.objects.filter(enemy_template=self).only('id', 'die_set')))
+                  for model in (EnemySkill, CustomSkill, CombatStyle)]
+        cleaned = {}    # value: cleaned value
+        for _, rows in groups:
+            for row in rows:
+                value = row.die_set + bonus
+                if value not in cleaned:
+                    cleaned[value] = clean(value)
+                    validate(cleaned[value], stats=True)
+                row.die_set = cleaned[value]
+        with transaction.atomic():
+            for model, rows in groups:
+                model.objects.bulk_update(rows, ['die_set'])
+            # bulk_update sends no signals
+            transaction.on_commit(lambda: template_cache.invalidate([self.id]))
 
     def is_starred(self, user):
         if user.is_authenticated:
@@ -592,7 +654,7 @@ class Party(models.Model):
             ttp.save()
             
     def set_amount(self, template, amount):
-        Dice(amount).roll()  # Test that the value is valid
+        validate(amount)
         ttp = TemplateToParty.objects.get(template=template, party=self)
         ttp.amount = amount
         ttp.save()
@@ -628,11 +690,11 @@ class Party(models.Model):
     def nonrandom_features(self):
         return PartyNonrandomFeature.objects.filter(party=self)
         
-    def get_random_additional_features(self):
+    def get_random_additional_features(self, rng=None):
         features = []
         for feature in self.additional_features:
-            if feature.random_has_feature() and len(feature.items) > 0:
-                features.append(feature.get_random_item())
+            if feature.random_has_feature(rng) and len(feature.items) > 0:
+                features.append(feature.get_random_item(rng))
         return features
 
     def add_nonrandom_feature(self, feature_id):
@@ -659,8 +721,8 @@ class TemplateToParty(models.Model):
     party = models.ForeignKey(Party, on_delete=models.CASCADE)
     amount = models.CharField(max_length=50)
     
-    def get_amount(self):
-        return Dice(self.amount).roll()
+    def get_amount(self, rng=None):
+        return compile_dice(self.amount).roll(rng=rng)
 
     def __str__(self):
         return self.party.name + ' - ' + self.template.name
@@ -676,16 +738,16 @@ class CombatStyle(models.Model):
     shield_amount = models.CharField(max_length=30, default='0')
     
     def roll_one_h_amount(self):
-        return Dice(self.one_h_amount).roll()
+        return compile_dice(self.one_h_amount).roll()
     
     def roll_two_h_amount(self):
-        return Dice(self.two_h_amount).roll()
+        return compile_dice(self.two_h_amount).roll()
     
     def roll_shield_amount(self):
-        return Dice(self.shield_amount).roll()
+        return compile_dice(self.shield_amount).roll()
     
     def roll_ranged_amount(self):
-        return Dice(self.ranged_amount).roll()
+        return compile_dice(self.ranged_amount).roll()
     
     @property
     def one_h_options(self):
@@ -716,58 +778,58 @@ class CombatStyle(models.Model):
         return CustomWeapon.objects.filter(combat_style=self)
     
     def roll(self, replace):
-        die_set = replace_die_set(self.die_set, replace)
-        dice = Dice(die_set)
-        return dice.roll()
+        return compile_dice(self.die_set).roll(replace)
         
+    @staticmethod
+    def clean_amount(value):
+        validate(value)
+        return value.lower()
+
     def set_one_h_amount(self, value):
-        Dice(value).roll()  # Test that the value is valid
-        self.one_h_amount = value.lower()
+        self.one_h_amount = self.clean_amount(value)
         self.save()
         
     def set_two_h_amount(self, value):
-        Dice(value).roll()  # Test that the value is valid
-        self.two_h_amount = value.lower()
+        self.two_h_amount = self.clean_amount(value)
         self.save()
         
     def set_ranged_amount(self, value):
-        Dice(value).roll()  # Test that the value is valid
-        self.ranged_amount = value.lower()
+        self.ranged_amount = self.clean_amount(value)
         self.save()
         
     def set_shield_amount(self, value):
-        Dice(value).roll()  # Test that the value is valid
-        self.shield_amount = value.lower()
+        self.shield_amount = self.clean_amount(value)
         self.save()
         
-    def set_value(self, value):
-        replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
+    @staticmethod
+    def clean_value(value):
         value = clean(value)
-        temp_value = replace_die_set(value, replace)
-        Dice(temp_value).roll()
-        self.die_set = value
+        validate(value, stats=True)
+        return value
+
+    def set_value(self, value):
+        self.die_set = value = self.clean_value(value)
         self.save()
         return value
         
-    def clone(self, et):
-        new = CombatStyle(name=self.name, die_set=self.die_set, enemy_template=et,
-                          one_h_amount=self.one_h_amount, two_h_amount=self.two_h_amount,
-                          ranged_amount=self.ranged_amount, shield_amount=self.shield_amount)
-        new.save()
-        for weapon in EnemyWeapon.objects.filter(combat_style=self):
-            EnemyWeapon.create(combat_style=new, weapon=weapon.weapon, probability=weapon.probability)
-        for weapon in CustomWeapon.objects.filter(combat_style=self):
-            cw = CustomWeapon.create(new.id, weapon.type, weapon.name, weapon.probability)
-            cw.damage = weapon.damage
-            cw.size = weapon.size
-            cw.reach = weapon.reach
-            cw.ap = weapon.ap
-            cw.hp = weapon.hp
-            cw.damage_modifier = weapon.damage_modifier
-            cw.special_effects = weapon.special_effects
-            cw.natural_weapon = weapon.natural_weapon
-            cw.ap_hp_as_per = weapon.ap_hp_as_per
-            cw.save()
+    @classmethod
+    def clone_all(cls, enemy_template, new_template):
+        """ Copies the combat styles of enemy_template and their weapons to new_template, which has no combat
+            styles yet, with a fixed amount of queries.
+        """
+        combat_styles = list(cls.objects.filter(enemy_template=enemy_template).order_by('id'))
+        if not combat_styles:
+            return
+        cls.objects.bulk_create(_copies(combat_styles, enemy_template_id=new_template.id))
+        # Not all databases return the ids of bulk inserted rows. The ids grow in the order of the insert.
+        new_ids = cls.objects.filter(enemy_template=new_template).order_by('id').values_list('id', flat=True)
+        new_ids = dict((cs.id, new_id) for cs, new_id in zip(combat_styles, new_ids))
+        for model in (EnemyWeapon, CustomWeapon):
+            weapons = list(model.objects.filter(combat_style__in=list(new_ids.keys())))
+            copies = _copies(weapons)
+            for weapon, copy in zip(weapons, copies):
+                copy.combat_style_id = new_ids[weapon.combat_style_id]
+            model.objects.bulk_create(copies)
 
 
 class EnemyWeapon(models.Model):
@@ -873,8 +935,12 @@ class CustomWeapon(models.Model):
     special_effects = models.CharField(max_length=300, null=True, blank=True)
     range = models.CharField(max_length=15, default='-', null=True, blank=True)
 
+    @staticmethod
+    def clean_probability(value):
+        return int(value)
+
     def set_probability(self, value):
-        self.probability = value
+        self.probability = self.clean_probability(value)
         self.save()
     
     @classmethod
@@ -914,21 +980,18 @@ class EnemySkill(models.Model):
         return self.skill.name
 
     def roll(self, replace=None):
-        # Ensure, that all valid stats are present in the dict. Some races miss some stats
-        # which will cause the generation to crash if the stat is nonetheless used in skills
-        replace_full = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
-        if replace:
-            replace_full.update(replace)
-        die_set = replace_die_set(self.die_set, replace_full)
-        dice = Dice(die_set)
-        return dice.roll()
+        # Stats missing from replace count as 0. Some races miss some stats, which would otherwise
+        # cause the generation to crash if the stat is nonetheless used in skills
+        return compile_dice(self.die_set).roll(replace or {})
         
-    def set_value(self, value):
-        replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
+    @staticmethod
+    def clean_value(value):
         value = clean(value)
-        temp_value = replace_die_set(value, replace)
-        Dice(temp_value).roll()
-        self.die_set = value
+        validate(value, stats=True)
+        return value
+
+    def set_value(self, value):
+        self.die_set = value = self.clean_value(value)
         self.save()
         return value
 
@@ -944,16 +1007,16 @@ class CustomSkill(models.Model):
         return self.name
 
     def roll(self, replace=None):
-        die_set = replace_die_set(self.die_set, replace)
-        dice = Dice(die_set)
-        return dice.roll()
+        return compile_dice(self.die_set).roll(replace or {})
         
-    def set_value(self, value):
-        replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
+    @staticmethod
+    def clean_value(value):
         value = clean(value)
-        temp_value = replace_die_set(value, replace)
-        Dice(temp_value).roll()
-        self.die_set = value
+        validate(value, stats=True)
+        return value
+
+    def set_value(self, value):
+        self.die_set = value = self.clean_value(value)
         self.save()
         return value
         
@@ -986,12 +1049,15 @@ class EnemyHitLocation(models.Model):
         return self.hit_location.hp_modifier
 
     def roll(self):
-        dice = Dice(self.armor)
-        return dice.roll()
+        return compile_dice(self.armor).roll()
         
+    @staticmethod
+    def clean_armor(value):
+        validate(value)
+        return value.lower()
+
     def set_armor(self, value):
-        Dice(value).roll()  # Test that the value is valid
-        self.armor = value.lower()
+        self.armor = self.clean_armor(value)
         self.save()
         
     @classmethod
@@ -1030,10 +1096,13 @@ class RaceStat(models.Model):
     def name(self):
         return self.stat.name
         
+    @staticmethod
+    def clean_value(value):
+        validate(value)
+        return value.lower()
+
     def set_value(self, value):
-        # Test that the value is valid
-        Dice(value).roll()
-        self.default_value = value.lower()
+        self.default_value = self.clean_value(value)
         self.save()
 
 
@@ -1050,12 +1119,15 @@ class EnemyStat(models.Model):
         return self.stat.name
         
     def roll(self):
-        dice = Dice(self.die_set)
-        return dice.roll()
+        return compile_dice(self.die_set).roll()
+
+    @staticmethod
+    def clean_value(value):
+        validate(value)
+        return value.lower()
 
     def set_value(self, value):
-        Dice(value).roll()  # Test that the value is valid
-        self.die_set = value.lower()
+        self.die_set = self.clean_value(value)
         self.save()
 
 
@@ -1130,8 +1202,12 @@ class CustomSpell(models.Model):
         cs.save()
         return cs
     
+    @staticmethod
+    def clean_probability(value):
+        return int(value)
+
     def set_probability(self, value):
-        self.probability = value
+        self.probability = self.clean_probability(value)
         self.save()
 
     class Meta:
@@ -1203,9 +1279,9 @@ class AdditionalFeatureList(models.Model):
     def items(self):
         return AdditionalFeatureItem.objects.filter(feature_list=self)
         
-    def get_random_item(self):
+    def get_random_item(self, rng=None):
         num_items = len(self.items)
-        index = random.randint(0, num_items-1)
+        index = (rng or current_rng()).randint(0, num_items-1)
         return self.items[index]
     
     def __unicode__(self):
@@ -1243,23 +1319,24 @@ class EnemyAdditionalFeatureList(models.Model):
     def name(self):
         return self.feature_list.name
         
-    def get_random_item(self):
-        return self.feature_list.get_random_item()
+    def get_random_item(self, rng=None):
+        return self.feature_list.get_random_item(rng)
         
-    def random_has_feature(self, replace=None):
+    def random_has_feature(self, replace=None, rng=None):
         """ Determines randomly whether the enemy has the additional feature or not """
-        prob = replace_die_set(self.probability, replace)
-        prob = Dice(prob).roll()
-        roll = random.randint(1, 100)
+        prob = compile_dice(self.probability).roll(replace or {}, rng)
+        roll = (rng or current_rng()).randint(1, 100)
         return roll <= prob
         
-    def set_probability(self, value):
+    @staticmethod
+    def clean_probability(value):
         if not value:
             value = '0'
-        replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
-        temp_value = replace_die_set(value, replace)
-        Dice(temp_value).roll()
-        self.probability = value.upper()
+        validate(value, stats=True)
+        return value.upper()
+
+    def set_probability(self, value):
+        self.probability = self.clean_probability(value)
         self.save()
         
     def __unicode__(self):
@@ -1323,20 +1400,24 @@ class PartyAdditionalFeatureList(models.Model):
     def name(self):
         return self.feature_list.name
         
-    def get_random_item(self):
-        return self.feature_list.get_random_item()
+    def get_random_item(self, rng=None):
+        return self.feature_list.get_random_item(rng)
         
-    def random_has_feature(self):
+    def random_has_feature(self, rng=None):
         """ Determines randomly whether the enemy has the additional feature or not """
         prob = int(self.probability)
-        roll = random.randint(1, 100)
+        roll = (rng or current_rng()).randint(1, 100)
         return roll <= prob
         
-    def set_probability(self, value):
+    @staticmethod
+    def clean_probability(value):
         if not value:
             value = '0'
         int(value)  # Test that it's an int-string.
-        self.probability = value
+        return value
+
+    def set_probability(self, value):
+        self.probability = self.clean_probability(value)
         self.save()
 
 
@@ -1349,11 +1430,361 @@ class ChangeLog(models.Model):
         ordering = ['publish_date', ]
 
 
+class _CompiledStat(namedtuple('_CompiledStat', ('name', 'die_set'))):
+    def roll(self, rng=None):
+        return compile_dice(self.die_set).roll(rng=rng)
+
+
+class _CompiledSkill(namedtuple('_CompiledSkill', ('name', 'die_set', 'include'))):
+    def roll(self, replace=None, rng=None):
+        return compile_dice(self.die_set).roll(replace or {}, rng)
+
+
+class _CompiledSpell(namedtuple('_CompiledSpell', ('name', 'type', 'detail', 'probability'))):
+    def __str__(self):
+        return self.name
+
+
+_CompiledWeapon = namedtuple('_CompiledWeapon', ('name', 'type', 'damage', 'size', 'reach', 'range', 'ap', 'hp',
+                                                 'special_effects', 'damage_modifier', 'natural_weapon',
+                                                 'ap_hp_as_per', 'probability', 'custom'))
+
+
+class _CompiledCombatStyle(namedtuple('_CompiledCombatStyle', (
+        'name', 'die_set', 'one_h_amount', 'two_h_amount', 'ranged_amount', 'shield_amount',
+        'one_h_options', 'two_h_options', 'ranged_options', 'shield_options'))):
+
+    def roll(self, replace, rng=None):
+        return compile_dice(self.die_set).roll(replace, rng)
+
+    def roll_one_h_amount(self, rng=None):
+        return compile_dice(self.one_h_amount).roll(rng=rng)
+
+    def roll_two_h_amount(self, rng=None):
+        return compile_dice(self.two_h_amount).roll(rng=rng)
+
+    def roll_shield_amount(self, rng=None):
+        return compile_dice(self.shield_amount).roll(rng=rng)
+
+    def roll_ranged_amount(self, rng=None):
+        return compile_dice(self.ranged_amount).roll(rng=rng)
+
+
+class _CompiledHitLocation(namedtuple('_CompiledHitLocation', ('name', 'range', 'hp_modifier', 'armor', 'race_armor'))):
+    def roll(self, rng=None):
+        return compile_dice(self.armor).roll(rng=rng)
+
+
+_FeatureListName = namedtuple('_FeatureListName', ('id', 'name'))
+_CompiledFeature = namedtuple('_CompiledFeature', ('name', 'feature_list', 'non_random'))
+
+
+class _CompiledFeatureList(namedtuple('_CompiledFeatureList', ('name', 'probability', 'items'))):
+    def get_random_item(self, rng=None):
+        index = (rng or current_rng()).randint(0, len(self.items)-1)
+        return self.items[index]
+
+    def random_has_feature(self, replace=None, rng=None):
+        """ Determines randomly whether the enemy has the additional feature or not """
+        prob = compile_dice(self.probability).roll(replace or {}, rng)
+        roll = (rng or current_rng()).randint(1, 100)
+        return roll <= prob
+
+
+_CompiledSpiritOption = namedtuple('_CompiledSpiritOption', ('name', 'probability', 'spirit'))
+_CompiledCultOption = namedtuple('_CompiledCultOption', ('name', 'probability', 'cult'))
+
+
+class CompiledTemplate(object):
+    """ Read-only snapshot of an EnemyTemplate: its stats, skills, spells, hit locations, combat styles,
+        features and the spirit and cult templates it refers to. Enemies are generated from the snapshot
+        without touching the database, so generating 40 enemies costs as many queries as generating one.
+        Create with CompiledTemplate.load() or EnemyTemplate.compile().
+    """
+    SPELL_TYPES = ('folk', 'theism', 'sorcery', 'mysticism')
+    BATCH_SIZE = 100    # Max amount of enemies rolled at once by iter_generate
+    _samplers = None    # spell type: WeightedSampler of the spells, built on first use
+
+    def __init__(self, enemy_template):
+        et = enemy_template
+        self.id = et.id
+        self.name = et.name
+        self.notes = et.notes
+        self.movement = et.movement
+        self.natural_armor = et.natural_armor
+        self.rank = et.rank
+        self.cult_rank = et.cult_rank
+        self.cult_rank_display = et.get_cult_rank_display()
+        self.folk_spell_amount = et.folk_spell_amount
+        self.theism_spell_amount = et.theism_spell_amount
+        self.sorcery_spell_amount = et.sorcery_spell_amount
+        self.mysticism_spell_amount = et.mysticism_spell_amount
+        self.spirit_amount = et.spirit_amount
+        self.cult_amount = et.cult_amount
+        self.is_spirit = et.is_spirit
+        self.is_elemental = et.is_elemental
+        self.is_cult = et.is_cult
+        self.namelist_id = et.namelist_id
+        self.namelist = None
+        self.stats = ()
+        self.skills = ()
+        self.included_skill_names = frozenset()    # Included EnemySkills. Custom skills don't count here
+        self.folk_spells = ()
+        self.theism_spells = ()
+        self.sorcery_spells = ()
+        self.mysticism_spells = ()
+        self.hit_locations = ()
+        self.combat_styles = ()
+        self.additional_features = ()
+        self.nonrandom_features = ()
+        self.spirits = ()
+        self.cults = ()
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def load(cls, enemy_templates):
+        """ Compiles the given EnemyTemplates and, recursively, the spirits and cults they refer to.
+            Each level of the graph is loaded with a fixed number of queries, regardless of the amount of
+            templates on the level. Returns the CompiledTemplates in the order of the input.
+        """
+        enemy_templates = list(enemy_templates)
+        compiled = {}
+        links = []
+        pending = enemy_templates
+        while pending:
+            level = OrderedDict()
+            for et in pending:
+                if et.id not in compiled and et.id not in level:
+                    level[et.id] = cls(et)
+            compiled.update(level)
+            pending = cls._load_level(level, links) if level else []
+        for template, spirits, cults in links:
+            template.spirits = tuple(_CompiledSpiritOption(es.spirit.name, es.probability, compiled[es.spirit_id])
+                                     for es in spirits)
+            template.cults = tuple(_CompiledCultOption(ec.cult.name, ec.probability, compiled[ec.cult_id])
+                                   for ec in cults)
+        return [compiled[et.id] for et in enemy_templates]
+
+    @classmethod
+    def _load_level(cls, level, links):
+        """ Fills in the given CompiledTemplates (dict of id: CompiledTemplate). The spirit and cult links are
+            added to links to be resolved once all the levels are loaded.
+            Returns the spirit and cult EnemyTemplates referred to.
+        """
+        ids = list(level.keys())
+        stats = _group_by_template(EnemyStat.objects.filter(enemy_template__in=ids).select_related('stat'))
+        skills = _group_by_template(EnemySkill.objects.filter(enemy_template__in=ids).select_related('skill'))
+        custom_skills = _group_by_template(CustomSkill.objects.filter(enemy_template__in=ids))
+        spells = _group_by_template(EnemySpell.objects.filter(enemy_template__in=ids).select_related('spell'))
+        custom_spells = _group_by_template(CustomSpell.objects.filter(enemy_template__in=ids, probability__gt=0))
+        hit_locations = _group_by_template(EnemyHitLocation.objects.filter(enemy_template__in=ids)
+                                           .select_related('hit_location'))
+        combat_styles = _group_by_template(CombatStyle.objects.filter(enemy_template__in=ids))
+        weapons = cls._load_weapons([cs.id for rows in combat_styles.values() for cs in rows])
+        feature_lists = _group_by_template(EnemyAdditionalFeatureList.objects.filter(enemy_template__in=ids)
+                                           .select_related('feature_list'))
+        list_ids = set(fl.feature_list_id for rows in feature_lists.values() for fl in rows)
+        list_ids.update(template.namelist_id for template in level.values() if template.namelist_id)
+        features = cls._load_features(list_ids)
+        nonrandom_features = _group_by_template(EnemyNonrandomFeature.objects.filter(enemy_template__in=ids)
+                                                .select_related('feature__feature_list'))
+        spirits = _group_by_template(EnemySpirit.objects.filter(enemy_template__in=ids).select_related('spirit__race'))
+        cults = _group_by_template(EnemyCult.objects.filter(enemy_template__in=ids).select_related('cult__race'))
+
+        referred = []
+        for template_id, template in level.items():
+            template.stats = tuple(_CompiledStat(stat.name, stat.die_set) for stat in stats[template_id])
+            skill_list = [_CompiledSkill(skill.name, skill.die_set, skill.include) for skill in skills[template_id]]
+            skill_list.extend(_CompiledSkill(skill.name, skill.die_set, skill.include)
+                              for skill in custom_skills[template_id])
+            template.skills = tuple(sorted(skill_list, key=lambda k: k.name))
+            template.included_skill_names = frozenset(skill.name for skill in skills[template_id] if skill.include)
+            for spell_type in cls.SPELL_TYPES:
+                spell_list = [_CompiledSpell(spell.name, spell.type, spell.detail, spell.probability)
+                              for spell in spells[template_id] if spell.type == spell_type]
+                spell_list.extend(_CompiledSpell(spell.name, spell.type, None, spell.probability)
+                                  for spell in custom_spells[template_id] if spell.type == spell_type)
+                setattr(template, '%s_spells' % spell_type, tuple(spell_list))
+            template.hit_locations = tuple(_CompiledHitLocation(hl.name, hl.range, hl.hp_modifier, hl.armor,
+                                                                hl.hit_location.armor)
+                                           for hl in hit_locations[template_id])
+            template.combat_styles = tuple(cls._compile_combat_style(cs, weapons[cs.id])
+                                           for cs in combat_styles[template_id])
+            template.additional_features = tuple(_CompiledFeatureList(fl.name, fl.probability,
+                                                                      features[fl.feature_list_id])
+                                                 for fl in feature_lists[template_id])
+            template.nonrandom_features = tuple(
+                _CompiledFeature(nf.feature.name, _FeatureListName(nf.feature.feature_list_id,
+                                                                   nf.feature.feature_list.name), True)
+                for nf in nonrandom_features[template_id])
+            if template.namelist_id:
+                template.namelist = _CompiledFeatureList(None, None, features[template.namelist_id])
+            links.append((template, spirits[template_id], cults[template_id]))
+            referred.extend(es.spirit for es in spirits[template_id])
+            referred.extend(ec.cult for ec in cults[template_id])
+        return referred
+
+    @staticmethod
+    def _load_weapons(combat_style_ids):
+        """ Returns a dict of combat style id: list of _CompiledWeapons. EnemyWeapons come before CustomWeapons. """
+        weapons = defaultdict(list)
+        if not combat_style_ids:
+            return weapons
+        for ew in EnemyWeapon.objects.filter(combat_style__in=combat_style_ids).select_related('weapon'):
+            weapons[ew.combat_style_id].append(_CompiledWeapon(
+                ew.name, ew.type, ew.damage, ew.size, ew.reach, ew.range, ew.ap, ew.hp, ew.special_effects,
+                ew.damage_modifier, False, '', ew.probability, False))
+        for cw in CustomWeapon.objects.filter(combat_style__in=combat_style_ids):
+            weapons[cw.combat_style_id].append(_CompiledWeapon(
+                cw.name, cw.type, cw.damage, cw.size, cw.reach, cw.range, cw.ap, cw.hp, cw.special_effects,
+                cw.damage_modifier, cw.natural_weapon, cw.ap_hp_as_per, cw.probability, True))
+        return weapons
+
+    @staticmethod
+    def _load_features(feature_list_ids):
+        """ Returns a dict of feature list id: tuple of _CompiledFeatures """
+        features = defaultdict(tuple)
+        if not feature_list_ids:
+            return features
+        names = dict((fl.id, fl.name) for fl in AdditionalFeatureList.objects.filter(id__in=feature_list_ids))
+        items = defaultdict(list)
+        for item in AdditionalFeatureItem.objects.filter(feature_list__in=feature_list_ids):
+            feature_list = _FeatureListName(item.feature_list_id, names[item.feature_list_id])
+            items[item.feature_list_id].append(_CompiledFeature(item.name, feature_list, False))
+        features.update((list_id, tuple(feature_items)) for list_id, feature_items in items.items())
+        return features
+
+    @staticmethod
+    def _compile_combat_style(cs, weapons):
+        def options(weapon_type):
+            return tuple(weapon for weapon in weapons if weapon.type == weapon_type)
+        return _CompiledCombatStyle(cs.name, cs.die_set, cs.one_h_amount, cs.two_h_amount, cs.ranged_amount,
+                                    cs.shield_amount, options('1h-melee'), options('2h-melee'), options('ranged'),
+                                    options('shield'))
+
+    @property
+    def stat_dict(self):
+        return dict((stat.name, stat.die_set) for stat in self.stats)
+
+    def spell_sampler(self, spell_type):
+        """ Returns the WeightedSampler of the spells of the given type. It's built once per snapshot and shared
+            by all the enemies generated from it, also when the template is a cult of many enemies.
+        """
+        if self._samplers is None:
+            self._samplers = {}
+        sampler = self._samplers.get(spell_type)
+        if sampler is None:
+            sampler = self._samplers[spell_type] = WeightedSampler(getattr(self, '%s_spells' % spell_type))
+        return sampler
+
+    @property
+    def is_theist(self):
+        return self.is_cult or 'Devotion' in self.included_skill_names
+
+    @property
+    def is_folk_magician(self):
+        return self.is_cult or 'Folk Magic' in self.included_skill_names
+
+    @property
+    def is_sorcerer(self):
+        return self.is_cult or 'Shaping' in self.included_skill_names
+
+    @property
+    def is_mystic(self):
+        return self.is_cult or 'Mysticism' in self.included_skill_names
+
+    @property
+    def is_animist(self):
+        return self.is_cult or 'Binding' in self.included_skill_names
+
+    @property
+    def get_cult_rank(self):
+        theist_ranks = ('None', 'Lay Member', 'Initiate', 'Acolyte', 'Priest', 'High priest')
+        if self.is_theist:
+            return theist_ranks[int(self.cult_rank)]
+        else:
+            return self.cult_rank_display
+
+    @property
+    def enemy_class(self):
+        if self.is_spirit:
+            return _Spirit
+        elif self.is_elemental:
+            return _Elemental
+        elif self.is_cult:
+            return _Cult
+        else:
+            return _Enemy
+
+    def generate(self, suffix=None, rolls=None, rng=None, parents=(), max_stats=None):
+        """ Generates an enemy. rolls is one of the rows returned by roll_batch(). parents are the ids of the
+            templates the enemy is generated within, as a spirit or a cult. max_stats limits the stats, e.g.
+            {'POW': 12}.
+        """
+        return self.enemy_class(self, rng, parents, max_stats).generate(suffix, rolls)
+
+    def generate_many(self, amount, seed=None, rng=None):
+        """ Generates the given amount of enemies, numbered from 1. The stats, skills, hit points, armor and
+            damage modifiers of all the enemies are rolled at once column-wise, before building the enemies.
+            The same seed always gives the same enemies.
+        """
+        return list(self.iter_generate(amount, seed, rng))
+
+    def iter_generate(self, amount, seed=None, rng=None, first=1):
+        """ Same as generate_many, but yields the enemies one at a time. The rolls are made for BATCH_SIZE
+            enemies at a time, so memory use doesn't grow with the amount. The enemies are numbered from first.
+            Each enemy is built with a stream of its own, spawned from rng.
+        """
+        if rng is None:
+            rng = random.Random(seed) if seed is not None else current_rng()
+        for start in range(0, amount, self.BATCH_SIZE):
+            rows = _BatchRolls(self, min(self.BATCH_SIZE, amount - start), rng).rows()
+            for i, rolls in enumerate(rows):
+                yield self.generate(first + start + i, rolls, spawn(rng))
+
+    def roll_batch(self, amount, rng=None):
+        """ See EnemyTemplate.roll_batch """
+        return _BatchRolls(self, amount, rng).rows()
+
+
+def _copies(rows, **values):
+    """ Returns unsaved copies of the model instances, with the fields given as attname=value replaced """
+    output = []
+    for row in rows:
+        fields = dict((field.attname, getattr(row, field.attname)) for field in row._meta.concrete_fields
+                      if not field.primary_key)
+        fields.update(values)
+        output.append(type(row)(**fields))
+    return output
+
+
+def _copy_tags(instance, new):
+    """ Copies the tags of instance to new with one insert """
+    through = type(instance).tags.through
+    tagged_items = through.objects.filter(**through.lookup_kwargs(instance))
+    through.objects.bulk_create(_copies(tagged_items, object_id=new.pk))
+
+
+def _group_by_template(queryset):
+    """ Returns a dict of enemy template id: list of the rows of the queryset """
+    output = defaultdict(list)
+    for row in queryset:
+        output[row.enemy_template_id].append(row)
+    return output
+
+
 class _Enemy(object):
     """ Enemy instance created based on an EnemyTemplate. This is the stuff that gets printed
         for the user when Generate is clicked.
     """
-    def __init__(self, enemy_template):
+    def __init__(self, enemy_template, rng=None, parents=(), max_stats=None):
+        if isinstance(enemy_template, EnemyTemplate):
+            enemy_template = enemy_template.compile()
+        self.rng = rng or current_rng()    # All the random choices of the enemy are made with this
+        self.parents = tuple(parents)   # Ids of the templates the enemy is generated within
+        self.max_stats = max_stats or {}
         self.name = ''
         self.et = enemy_template
         self.cult_rank = self.et.get_cult_rank
@@ -1378,8 +1809,20 @@ class _Enemy(object):
         self.is_animist = False
         self.is_mystic = False
         self.is_spirit = self.et.is_spirit
+        self.rolls = None
 
-    def generate(self, suffix=None):
+    def __getstate__(self):
+        # The random module can't be pickled, and a generated enemy doesn't need its rng anymore
+        state = self.__dict__.copy()
+        state['rng'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = random
+
+    def generate(self, suffix=None, rolls=None):
+        self.rolls = rolls
         self._generate_name(suffix)
         self._add_stats()
         self._add_skills()
@@ -1404,37 +1847,53 @@ class _Enemy(object):
         if suffix:
             self.name += ' %s' % suffix
         if self.et.namelist:
-            self.name = '%s (%s)' % (self.et.namelist.get_random_item().name, self.name)
+            self.name = '%s (%s)' % (self.et.namelist.get_random_item(self.rng).name, self.name)
         
     def _add_stats(self):
-        for stat in self.et.stats:
-            self.stats[stat.name] = stat.roll()
+        for i, stat in enumerate(self.et.stats):
+            self.stats[stat.name] = self.rolls.stats[i] if self.rolls else stat.roll(self.rng)
+            if self.stats[stat.name] > self.max_stats.get(stat.name, self.stats[stat.name]):
+                # Same as rerolling until the stat is low enough, without generating the rest again
+                self.stats[stat.name] = distribution(stat.die_set).sample(self.rng, self.max_stats[stat.name])
             self.stats_list.append({'name': stat.name, 'value': self.stats[stat.name]})
+        self._adjust_stats(self.stats)
+
+    @staticmethod
+    def _adjust_stats(stats):
+        """ Derives stats from other stats for enemy types that need it. Works both for single enemies
+            and for the stat columns of _BatchRolls.
+        """
+        return stats
+
+    @staticmethod
+    def _hit_point_die_set(hit_location):
+        """ The die set rolled for the hit points of the hit location on top of the base hit points """
+        return hit_location.hp_modifier
     
     def _add_skills(self):
-        for skill in self.et.skills:
+        for i, skill in enumerate(self.et.skills):
             if skill.include:
-                value = skill.roll(self.stats)
+                value = self.rolls.skills[i] if self.rolls else skill.roll(self.stats, self.rng)
                 self.skills.append({'name': skill.name, 'value': value})
                 self.skills_dict[skill.name] = value
     
     def _add_combat_styles(self):
         for cs in self.et.combat_styles:
-            combat_style = {'value': cs.roll(self.stats), 'name': cs.name, 'weapons': self._add_weapons(cs)}
+            combat_style = {'value': cs.roll(self.stats, self.rng), 'name': cs.name, 'weapons': self._add_weapons(cs)}
             self.combat_styles.append(combat_style)
             
     def _add_weapons(self, cs):
         """ Returns a list of weapons based on the given CombatStyle's weapon selections and probabilities
         """
         output = []
-        one_h_amount = min(cs.roll_one_h_amount(), len(cs.one_h_options))
-        two_h_amount = min(cs.roll_two_h_amount(), len(cs.two_h_options))
-        ranged_amount = min(cs.roll_ranged_amount(), len(cs.ranged_options))
-        shield_amount = min(cs.roll_shield_amount(), len(cs.shield_options))
-        output.extend(select_random_items(cs.one_h_options, one_h_amount))
-        output.extend(select_random_items(cs.two_h_options, two_h_amount))
-        output.extend(select_random_items(cs.ranged_options, ranged_amount))
-        output.extend(select_random_items(cs.shield_options, shield_amount))
+        one_h_amount = min(cs.roll_one_h_amount(self.rng), len(cs.one_h_options))
+        two_h_amount = min(cs.roll_two_h_amount(self.rng), len(cs.two_h_options))
+        ranged_amount = min(cs.roll_ranged_amount(self.rng), len(cs.ranged_options))
+        shield_amount = min(cs.roll_shield_amount(self.rng), len(cs.shield_options))
+        output.extend(select_random_items(cs.one_h_options, one_h_amount, self.rng))
+        output.extend(select_random_items(cs.two_h_options, two_h_amount, self.rng))
+        output.extend(select_random_items(cs.ranged_options, ranged_amount, self.rng))
+        output.extend(select_random_items(cs.shield_options, shield_amount, self.rng))
         output = self._adjust_size_and_reach(output)
         return output
         
@@ -1445,105 +1904,115 @@ class _Enemy(object):
             return weapons
         sizes = [value for value, _ in WEAPON_SIZE_CHOICES]
         reaches = [value for value, _ in WEAPON_REACH_CHOICES]
+        output = []
         for item in weapons:
-            if item.__class__.__name__ == 'EnemyWeapon':
-                index = sizes.index(item.weapon.size) + step
+            if not item.custom:
+                index = sizes.index(item.size) + step
                 if index < 0:
-                    item.weapon.size = 'S'
+                    size = 'S'
                 else:
                     try:
-                        item.weapon.size = sizes[index]
+                        size = sizes[index]
                     except IndexError:
-                        item.weapon.size = 'C'
+                        size = 'C'
 
-                index = reaches.index(item.weapon.reach) + step
+                index = reaches.index(item.reach) + step
                 if index < 1:
-                    item.weapon.reach = 'T'
+                    reach = 'T'
                 else:
                     try:
-                        item.weapon.reach = reaches[index]
+                        reach = reaches[index]
                     except IndexError:
-                        item.weapon.reach = 'U'
-        return weapons
+                        reach = 'U'
+                # The weapons are shared by all the enemies of the CompiledTemplate, so don't modify them in place
+                item = item._replace(size=size, reach=reach)
+            output.append(item)
+        return output
     
     def _add_hit_locations(self):
         con_siz = self.stats['CON'] + self.stats['SIZ']
         base_hp = ((con_siz-1) // 5) + 1  # used by Head and Legs
-        for hl in self.et.hit_locations:
-            hp = max(base_hp + Dice(hl.hp_modifier).roll(), 1)
-            ap = hl.roll()
+        for i, hl in enumerate(self.et.hit_locations):
+            if self.rolls:
+                modifier = self.rolls.hit_points[i]
+            else:
+                modifier = compile_dice(self._hit_point_die_set(hl)).roll(rng=self.rng)
+            hp = max(base_hp + modifier, 1)
+            ap = self.rolls.armor[i] if self.rolls else hl.roll(self.rng)
             enemy_hl = {'name': hl.name, 'range': hl.range, 'hp': hp, 'ap': ap, 'parent': hl}
             self.hit_locations.append(enemy_hl)
         
     def _add_spells(self):
-        amount = min(Dice(self.et.folk_spell_amount).roll(), len(self.et.folk_spells))
-        self.folk_spells = sorted(select_random_items(self.et.folk_spells, amount), key=lambda s: s.name)
-        amount = min(Dice(self.et.theism_spell_amount).roll(), len(self.et.theism_spells))
-        self.theism_spells = sorted(select_random_items(self.et.theism_spells, amount), key=lambda s: s.name)
-        amount = min(Dice(self.et.sorcery_spell_amount).roll(), len(self.et.sorcery_spells))
-        self.sorcery_spells = sorted(select_random_items(self.et.sorcery_spells, amount), key=lambda s: s.name)
-        amount = min(Dice(self.et.mysticism_spell_amount).roll(), len(self.et.mysticism_spells))
-        self.mysticism_spells = sorted(select_random_items(self.et.mysticism_spells, amount), key=lambda s: s.name)
+        for spell_type in self.et.SPELL_TYPES:
+            die_set = getattr(self.et, '%s_spell_amount' % spell_type)
+            amount = min(compile_dice(die_set).roll(rng=self.rng), len(getattr(self.et, '%s_spells' % spell_type)))
+            spells = self.et.spell_sampler(spell_type).sample(amount, self.rng)
+            spells.sort(key=lambda s: s.name)
+            setattr(self, '%s_spells' % spell_type, spells)
         
     def _add_spirits(self):
-        spirit_options = self.et.spirits.filter(probability__gt=0).exclude(spirit__race__name='Cult')
-        amount = min(Dice(self.et.spirit_amount).roll(), len(spirit_options))
-        spirit_templates = select_random_items(spirit_options, amount)
-        retries = 5
+        spirit_options = [st for st in self.et.spirits
+                          if st.probability > 0 and not st.spirit.is_cult and self._can_nest(st.spirit)]
+        amount = min(compile_dice(self.et.spirit_amount).roll(rng=self.rng), len(spirit_options))
+        spirit_templates = select_random_items(spirit_options, amount, self.rng)
+        max_stats = {'POW': self.attributes['max_pow']}
         for st in spirit_templates:
-            i = 0
-            spirit = None
-            while spirit is None or (spirit.stats['POW'] > self.attributes['max_pow'] and i < retries):
-                i += 1
-                spirit = st.spirit.generate()
-            if spirit.stats['POW'] <= self.attributes['max_pow']:
-                self.spirits.append(spirit)
-        
+            # Spirits, whose POW can never be low enough for the animist, are left out
+            pow_die_set = st.spirit.stat_dict.get('POW')
+            if pow_die_set and distribution(pow_die_set).cdf(self.attributes['max_pow']) == 0:
+                continue
+            self.spirits.append(st.spirit.generate(rng=spawn(self.rng), parents=self.lineage, max_stats=max_stats))
+
+    @property
+    def lineage(self):
+        return self.parents + (self.et.id, )
+
+    def _can_nest(self, enemy_template):
+        """ Whether a spirit or cult of the template can be generated within the enemy. A template is never
+            generated within itself, and the nesting stops at MAX_NESTING levels.
+        """
+        return enemy_template.id not in self.lineage and len(self.lineage) < MAX_NESTING
+
     def _add_cults(self):
-        amount = min(Dice(self.et.cult_amount).roll(), len(self.et.cults.filter(probability__gt=0)))
-        cult_templates = select_random_items(self.et.cults.filter(probability__gt=0), amount)
+        cult_options = [ct for ct in self.et.cults if ct.probability > 0 and self._can_nest(ct.cult)]
+        amount = min(compile_dice(self.et.cult_amount).roll(rng=self.rng), len(cult_options))
+        cult_templates = select_random_items(cult_options, amount, self.rng)
         for ct in cult_templates:
             self.cult = ct.cult
-            cult = ct.cult.generate()
-            self.folk_spells += cult.folk_spells
-            self.theism_spells += cult.theism_spells
-            self.sorcery_spells += cult.sorcery_spells
-            self.mysticism_spells += cult.mysticism_spells
+            cult = ct.cult.generate(rng=spawn(self.rng), parents=self.lineage)
             self.spirits += cult.spirits
             self.cults.append(cult)
-            
-        seen = set()
-        self.folk_spells = [x for x in self.folk_spells if x.name not in seen and not seen.add(x.name)]
-        seen = set()
-        self.theism_spells = [x for x in self.theism_spells if x.name not in seen and not seen.add(x.name)]
-        seen = set()
-        self.sorcery_spells = [x for x in self.sorcery_spells if x.name not in seen and not seen.add(x.name)]
-        seen = set()
-        self.mysticism_spells = [x for x in self.mysticism_spells if x.name not in seen and not seen.add(x.name)]
-            
-        self.folk_spells.sort(key=lambda item: item.name)
-        self.theism_spells.sort(key=lambda item: item.name)
-        self.sorcery_spells.sort(key=lambda item: item.name)
-        self.mysticism_spells.sort(key=lambda item: item.name)
+        # The spells of the cults are merged to the own spells of the enemy, keeping the first spell of each name
+        for spell_type in self.et.SPELL_TYPES:
+            attribute = '%s_spells' % spell_type
+            spells = []
+            names = set()
+            for spell in chain(getattr(self, attribute), *(getattr(cult, attribute) for cult in self.cults)):
+                if spell.name not in names:
+                    names.add(spell.name)
+                    spells.append(spell)
+            spells.sort(key=lambda item: item.name)
+            setattr(self, attribute, spells)
         self.spirits.sort(key=lambda item: item.name)
         
     def _add_additional_features(self):
         for feature_list in self.et.additional_features:
-            if feature_list.random_has_feature(self.stats) and len(feature_list.items) > 0:
-                feature = feature_list.get_random_item()
+            if feature_list.random_has_feature(self.stats, self.rng) and len(feature_list.items) > 0:
+                feature = feature_list.get_random_item(self.rng)
                 self.additional_features.append(feature)
-        for feature in self.et.nonrandom_features:
-            fture = feature.feature
-            # Used in the html template to show the non-random features only once if there's only one type of enemies
-            fture.non_random = True
-            self.additional_features.append(fture)
+        # The non-random features have non_random set. It's used in the html template to show them only once
+        # if there's only one type of enemies
+        self.additional_features.extend(self.et.nonrandom_features)
         self.additional_features.sort(key=lambda item: item.feature_list.name)
         
     def _calculate_attributes(self):
         sr_natural = (self.stats['INT'] + self.stats['DEX']) // 2
         sr = sr_natural - self._sr_penalty()
         self._calculate_action_points()
-        self._calculate_damage_modifier(self.stats['STR'], self.stats['SIZ'])
+        if self.rolls and self.rolls.damage_modifier is not None:
+            self.attributes['damage_modifier'] = self.rolls.damage_modifier
+        else:
+            self._calculate_damage_modifier(self.stats['STR'], self.stats['SIZ'])
         self.attributes['magic_points'] = self.stats['POW']
         self.attributes['strike_rank'] = '%s(%s-%s)' % (sr, sr_natural, self._sr_penalty())
         self.attributes['movement'] = self.et.movement
@@ -1583,7 +2052,7 @@ class _Enemy(object):
         for hl in self.hit_locations:
             ap = hl['ap']
             # Disregard armor of the race, which is assumed to be natural
-            ap -= int(hl['parent'].hit_location.armor)
+            ap -= int(hl['parent'].race_armor)
             if ap == 1:
                 enc += 2
             elif ap > 1:
@@ -1609,26 +2078,28 @@ class _Enemy(object):
 
 
 class _Cult(_Enemy):
-    def __init__(self, enemy_template):
-        super(_Cult, self).__init__(enemy_template)
+    def __init__(self, enemy_template, rng=None, parents=(), max_stats=None):
+        super(_Cult, self).__init__(enemy_template, rng, parents, max_stats)
         
-    def generate(self, suffix=None):
+    def generate(self, suffix=None, rolls=None):
         self._generate_name(suffix)
         self._add_spells()
         self._add_spirits()
         return self
         
     def _add_spirits(self):
-        amount = min(Dice(self.et.spirit_amount).roll(), len(self.et.spirits.filter(probability__gt=0)))
-        spirit_templates = select_random_items(self.et.spirits.filter(probability__gt=0), amount)
+        spirit_options = [st for st in self.et.spirits if st.probability > 0 and self._can_nest(st.spirit)]
+        amount = min(compile_dice(self.et.spirit_amount).roll(rng=self.rng), len(spirit_options))
+        spirit_templates = select_random_items(spirit_options, amount, self.rng)
         for st in spirit_templates:
-            spirit = st.spirit.generate()
+            spirit = st.spirit.generate(rng=spawn(self.rng), parents=self.lineage)
             self.spirits.append(spirit)
 
 
 class _Spirit(_Enemy):
     """ Spirit type of Enemy """
-    def generate(self, suffix=None):
+    def generate(self, suffix=None, rolls=None):
+        self.rolls = rolls
         self._generate_name(suffix)
         self._add_stats()
         self._add_skills()
@@ -1641,14 +2112,13 @@ class _Spirit(_Enemy):
             self._add_cults()
         return self
 
-    def _add_stats(self):
-        for stat in self.et.stats:
-            self.stats[stat.name] = stat.roll()
-            self.stats_list.append({'name': stat.name, 'value': self.stats[stat.name]})
-        self.stats['CON'] = self.stats['POW']
-        self.stats['STR'] = self.stats['POW']
-        self.stats['SIZ'] = self.stats['POW']
-        self.stats['DEX'] = self.stats['INT']
+    @staticmethod
+    def _adjust_stats(stats):
+        stats['CON'] = stats['POW']
+        stats['STR'] = stats['POW']
+        stats['SIZ'] = stats['POW']
+        stats['DEX'] = stats['INT']
+        return stats
         
     def _calculate_attributes(self):
         sr = (self.stats['INT'] + self.stats['CHA']) // 2
@@ -1688,12 +2158,10 @@ class _Spirit(_Enemy):
             self.attributes['action_points'] = 5
         
     def _calculate_spirit_damage(self):
-        damage_table = ['0', '1d2', '1d4', '1d6', '1d8', '1d10', '2d6', '1d8+1d6', '2d8', '1d10+1d8', '2d10',
-                        '2d10+1d2', '2d10+1d4', '2d10+1d6', '2d10+1d8', '3d10', '3d10+1d2', '3d10+1d4']
         skill = self.skills_dict.get('Spectral combat', 0)
         index = _divide_round_up(skill, 20)
         try:
-            spirit_damage = damage_table[index]
+            spirit_damage = SPIRIT_DAMAGE_STEPS[index]
         except IndexError:
             spirit_damage = '3d10+1d6'
         self.attributes['spirit_damage'] = spirit_damage
@@ -1702,12 +2170,10 @@ class _Spirit(_Enemy):
 class _Elemental(_Enemy):
     """ Elemental type of enemy """
 
-    def generate(self, suffix=None):
+    def generate(self, suffix=None, rolls=None):
+        self.rolls = rolls
         self._generate_name(suffix)
         self._add_stats()
-        self.stats['SIZ'] = self.stats['STR']
-        self.stats['CON'] = self.stats['STR']
-        self.stats['CHA'] = self.stats['POW']
         self._add_skills()
         self._add_spells()
         self._add_additional_features()
@@ -1717,6 +2183,17 @@ class _Elemental(_Enemy):
             self._add_cults()
         self._add_combat_styles()
         return self
+
+    @staticmethod
+    def _adjust_stats(stats):
+        stats['SIZ'] = stats['STR']
+        stats['CON'] = stats['STR']
+        stats['CHA'] = stats['POW']
+        return stats
+
+    @staticmethod
+    def _hit_point_die_set(hit_location):
+        return '1d6'
         
     def _add_hit_locations(self):
         # Elementals have only one hit location
@@ -1729,13 +2206,119 @@ class _Elemental(_Enemy):
             modifier = 2 * int(power.split('+')[1])
         except (IndexError, TypeError):
             modifier = 0
-        for hl in self.et.hit_locations:
-            hp = max(Dice('1d6').roll() + modifier, 1)
-            ap = hl.roll()
+        for i, hl in enumerate(self.et.hit_locations):
+            if self.rolls:
+                roll = self.rolls.hit_points[i]
+            else:
+                roll = compile_dice(self._hit_point_die_set(hl)).roll(rng=self.rng)
+            hp = max(roll + modifier, 1)
+            ap = self.rolls.armor[i] if self.rolls else hl.roll(self.rng)
             enemy_hl = {'name': hl.name, 'range': hl.range, 'hp': hp, 'ap': ap, 'parent': hl}
             self.hit_locations.append(enemy_hl)
 
 
+_Rolls = namedtuple('_Rolls', ('stats', 'skills', 'armor', 'hit_points', 'damage_modifier'))
+
+
+class _BatchRolls(object):
+    """ Rolls the stats, skills, hit location armor and hit points for a batch of enemies of the same template
+        column-wise, i.e. each die set is rolled once for the whole batch with Dice.roll_many. Damage modifiers
+        are derived from the STR and SIZ columns.
+        The columns are in the same order as CompiledTemplate.stats, .skills and .hit_locations.
+    """
+    def __init__(self, enemy_template, amount, rng=None):
+        self.amount = amount
+        self.enemy_template = enemy_template
+        enemy_class = enemy_template.enemy_class
+        generator = numpy_rng(rng)
+        self.stats = [compile_dice(stat.die_set).roll_many(amount, rng=generator) for stat in enemy_template.stats]
+        stats = OrderedDict((stat.name, column) for stat, column in zip(enemy_template.stats, self.stats))
+        stats = enemy_class._adjust_stats(stats) if stats else stats
+        self.adjusted_stats = stats     # Stat name: column, after enemy_class._adjust_stats
+        self.skills = []
+        for skill in enemy_template.skills:
+            column = compile_dice(skill.die_set).roll_many(amount, stats, generator) if skill.include else None
+            self.skills.append(column)
+        self.armor = [compile_dice(hl.armor).roll_many(amount, rng=generator) for hl in enemy_template.hit_locations]
+        self.hit_points = [compile_dice(enemy_class._hit_point_die_set(hl)).roll_many(amount, rng=generator)
+                           for hl in enemy_template.hit_locations]
+        self.damage_modifiers = None
+        if 'STR' in stats and 'SIZ' in stats:
+            self.damage_modifiers = self._damage_modifiers(stats['STR'], stats['SIZ'])
+
+    @staticmethod
+    def _damage_modifiers(strength, siz):
+        """ Column-wise version of _Enemy._calculate_damage_modifier """
+        str_siz = strength + siz
+        indexes = numpy.where(str_siz <= 50, (str_siz-1) // 5, ((str_siz - 1 - 50) // 10) + 10)
+        zero = (strength == 0) | (siz == 0)
+        output = []
+        for index, is_zero in zip(indexes.tolist(), zero.tolist()):
+            if is_zero:
+                output.append('+0')
+            elif index < len(DICE_STEPS):
+                output.append(DICE_STEPS[index])
+            else:
+                output.append('+6d10')
+        return output
+
+    def action_points(self):
+        """ Column-wise version of _Enemy._calculate_action_points and _Spirit._calculate_action_points """
+        stats = self.adjusted_stats
+        if self.enemy_template.enemy_class is _Spirit:
+            return numpy.clip((stats['POW'] + stats['INT'] - 1) // 12 + 1, 1, 5)
+        return -(-(stats['DEX'] + stats['INT']) // 12)
+
+    def strike_ranks(self):
+        """ Column-wise version of the strike rank of _Enemy._calculate_attributes and
+            _Spirit._calculate_attributes
+        """
+        stats = self.adjusted_stats
+        if self.enemy_template.enemy_class is _Spirit:
+            return (stats['INT'] + stats['CHA']) // 2
+        return (stats['INT'] + stats['DEX']) // 2 - self._sr_penalties()
+
+    def _sr_penalties(self):
+        """ Column-wise version of _Enemy._sr_penalty """
+        enc = numpy.zeros(self.amount, dtype=numpy.int64)
+        if self.enemy_template.natural_armor:
+            return enc
+        for hl, armor in zip(self.enemy_template.hit_locations, self.armor):
+            ap = armor - int(hl.race_armor)
+            enc += numpy.where(ap == 1, 2, numpy.where(ap > 1, ap - 1, 0))
+        return -(-enc // 5)
+
+    def hit_point_totals(self):
+        """ Column-wise version of _Enemy._add_hit_locations and _Elemental._add_hit_locations. Returns the
+            hit point columns of the hit locations.
+        """
+        et = self.enemy_template
+        stats = self.adjusted_stats
+        if et.enemy_class is _Elemental:
+            power = next((stat.die_set for stat in et.stats if stat.name == 'POW'), '')
+            try:
+                base_hp = 2 * int(power.split('+')[1])
+            except (IndexError, TypeError):
+                base_hp = 0
+        else:
+            base_hp = ((stats['CON'] + stats['SIZ'] - 1) // 5) + 1
+        return [numpy.maximum(base_hp + modifier, 1) for modifier in self.hit_points]
+
+    def rows(self):
+        stats = [column.tolist() for column in self.stats]
+        skills = [column.tolist() if column is not None else None for column in self.skills]
+        armor = [column.tolist() for column in self.armor]
+        hit_points = [column.tolist() for column in self.hit_points]
+        output = []
+        for i in range(self.amount):
+            output.append(_Rolls(stats=[column[i] for column in stats],
+                                 skills=[column[i] if column is not None else None for column in skills],
+                                 armor=[column[i] for column in armor],
+                                 hit_points=[column[i] for column in hit_points],
+                                 damage_modifier=self.damage_modifiers[i] if self.damage_modifiers else None))
+        return output
+
+
 class Star(models.Model):
     """ Functionality for starring templates (marking as favourite) """
     user = models.ForeignKey(User, on_delete=models.CASCADE)
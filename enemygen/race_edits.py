@@ -0,0 +1,43 @@
+"""
+Race-level edits that are copied to the templates of the race.
+
+The edits are written with set-based, batched queries instead of a query per template, and the cached templates
+are invalidated once, when the transaction commits, instead of once per row changed.
+"""
+from django.db import transaction
+
+from . import template_cache
+from .models import HitLocation
+
+
+def add_hit_location(race_id):
+    """ Adds a new hit location to the race and its templates. Returns the hit location and the amount of
+        templates updated.
+    """
+    with transaction.atomic():
+        hit_location = HitLocation.create(race_id, fan_out=False)
+        template_ids = list(hit_location.race.templates.values_list('id', flat=True))
+        hit_location.add_to_templates(template_ids)
+        _invalidate_on_commit(template_ids)
+    return hit_location, len(template_ids)
+
+
+def remove_hit_location(hit_location):
+    """ Removes the hit location from the race and its templates. Returns the amount of templates updated. """
+    with transaction.atomic(), template_cache.signals_suspended():
+        template_ids = hit_location.remove()
+        _invalidate_on_commit(template_ids)
+    return len(template_ids)
+
+
+def apply_notes(race, owner, notes):
+    """ Appends notes to the templates of the race owned by owner. Returns the amount of templates updated. """
+    with transaction.atomic():
+        template_ids = race.apply_notes(owner, notes)
+        _invalidate_on_commit(template_ids)
+    return len(template_ids)
+
+
+def _invalidate_on_commit(template_ids):
+    if template_ids:
+        transaction.on_commit(lambda: template_cache.invalidate(template_ids))
@@ -0,0 +1,49 @@
+"""
+Cache of the seeded JSON responses.
+
+A request with a seed always generates the same output from the same content, so its serialized response is
+cached under (kind, template or party id, revision, seed, amount). The revision comes from template_cache and
+changes whenever anything the generation depends on is edited, so a stale response is never served. The key
+also gives the ETag of the response. The entries live in the shared Django cache, which bounds their amount,
+and remember the counter increments of the generation, which are repeated on every hit, and on every 304 Not
+Modified answer, to keep the statistics right.
+"""
+import hashlib
+from collections import namedtuple
+
+from django.core.cache import cache as shared_cache
+
+from . import counters
+
+TIMEOUT = 60 * 60
+MAX_AMOUNT = 200    # Responses with more enemies than this are streamed instead of cached
+
+Entry = namedtuple('Entry', ('body', 'increments'))    # increments: ((template id, generated), ...)
+
+
+def key(kind, object_id, revision, seed, amount=None):
+    data = repr((kind, object_id, revision, seed, amount)).encode('utf-8')
+    return 'enemygen:response:%s' % hashlib.sha1(data).hexdigest()
+
+
+def etag(cache_key):
+    return '"%s"' % cache_key.rsplit(':', 1)[1]
+
+
+def get(cache_key):
+    """ Returns the cached body, or None. A hit increments the counters like the generation did. """
+    entry = shared_cache.get(cache_key)
+    if entry is None:
+        return None
+    increment(entry.increments)
+    return entry.body
+
+
+def store(cache_key, body, increments):
+    shared_cache.set(cache_key, Entry(body, tuple(increments)), TIMEOUT)
+
+
+def increment(increments):
+    """ Increments the counters like a generation with the given (template id, generated) increments did """
+    for template_id, generated in increments:
+        counters.increment(template_id, generated=generated, used=1)
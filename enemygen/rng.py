@@ -0,0 +1,61 @@
+"""
+Random number streams.
+
+All the random choices of the generator are made with a random.Random passed around as rng. Where no rng is
+given, the current rng of the context is used. It's the random module, unless a seeded stream is activated
+with use(), e.g. for the duration of a request.
+
+Seeded streams are split into independent sub-streams with stream() and spawn(), so that every enemy, spirit
+and cult has a stream of its own. What one of them rolls doesn't change the rolls of the others, so the same
+seed gives the same enemies however the generation is split or ordered.
+"""
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar('enemygen_rng', default=None)
+
+
+def current_rng():
+    """ Returns the rng of the current context """
+    return _current.get() or random
+
+
+@contextmanager
+def use(rng):
+    """ Makes rng the current rng within the with block. rng can also be a seed, or None for the random
+        module. Yields the rng.
+    """
+    if rng is not None and not isinstance(rng, random.Random):
+        rng = random.Random(rng)
+    token = _current.set(rng)
+    try:
+        yield current_rng()
+    finally:
+        _current.reset(token)
+
+
+def derive_seed(master_seed, *path):
+    """ Returns a 64 bit seed derived from master_seed and path. The seeds of different paths are independent
+        of each other, and the same master_seed and path always give the same seed.
+    """
+    data = repr((master_seed, ) + path).encode('utf-8')
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], 'big')
+
+
+def stream(seed, *path):
+    """ Returns the sub-stream of seed identified by path, or the current rng if seed is None """
+    if seed is None:
+        return current_rng()
+    return random.Random(derive_seed(seed, *path))
+
+
+def spawn(rng=None):
+    """ Returns a new stream seeded from rng, which advances rng only by one draw. The random module isn't
+        reproducible anyway, so it's returned as such.
+    """
+    rng = rng or current_rng()
+    if rng is random:
+        return rng
+    return random.Random(rng.getrandbits(64))
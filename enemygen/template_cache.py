@@ -0,0 +1,283 @@
+"""
+Cross-request cache of CompiledTemplates.
+
+The compiled templates are kept in a bounded in-process LRU and in the shared Django cache. Each template has
+a revision in the shared cache, which is replaced when a transaction that saved or deleted the template or
+anything it depends on commits (see connect_signals). An entry remembers the revisions of all the templates it was compiled from,
+including its spirits and cults, and is only used while all of them are still current. Parties have revisions
+too (see party_key), which the response cache uses.
+"""
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+from django.core.cache import cache as shared_cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from .models import CompiledTemplate, EnemyTemplate, Race, HitLocation, CombatStyle
+from .models import EnemyStat, EnemySkill, CustomSkill, EnemySpell, CustomSpell, EnemyWeapon, CustomWeapon
+from .models import EnemyHitLocation, EnemySpirit, EnemyCult, EnemyAdditionalFeatureList, EnemyNonrandomFeature
+from .models import AdditionalFeatureList, AdditionalFeatureItem, Weapon, SkillAbstract, SpellAbstract, StatAbstract
+from .models import Party, TemplateToParty, PartyAdditionalFeatureList, PartyNonrandomFeature
+
+CACHE_SIZE = 256    # Max amount of compiled templates kept in the memory of each process
+SHARED_TIMEOUT = 24 * 60 * 60
+GLOBAL = 'global'   # Revision shared by all templates. Changed when e.g. a Weapon or a SkillAbstract changes.
+COUNTER_FIELDS = frozenset(('generated', 'used'))
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'currsize', 'maxsize'))
+
+_local = OrderedDict()  # template id: (revisions, CompiledTemplate)
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+_suspended = threading.local()
+
+
+def load(enemy_templates):
+    """ Same as CompiledTemplate.load, but uses the cached CompiledTemplates where they are up to date """
+    enemy_templates = list(enemy_templates)
+    compiled = {}
+    missing = []
+    for et in enemy_templates:
+        if et.id in compiled:
+            continue
+        template = _get(et.id)
+        if template is None:
+            missing.append(et)
+        else:
+            compiled[et.id] = template
+    if missing:
+        # Read the revisions before loading, so that changes made during the load invalidate the entries
+        revisions = _revisions([GLOBAL] + [et.id for et in missing])
+        for template in CompiledTemplate.load(missing):
+            _set(template, revisions)
+            compiled[template.id] = template
+    return [compiled[et.id] for et in enemy_templates]
+
+
+def get(enemy_template):
+    return load([enemy_template])[0]
+
+
+def revision(compiled_templates, keys=()):
+    """ Returns a token that changes whenever any of the given CompiledTemplates, the spirits and cults they
+        refer to, or the other given revision keys (e.g. party_key()) change
+    """
+    template_ids = set(keys)
+    template_ids.add(GLOBAL)
+    for template in compiled_templates:
+        template_ids.update(_graph_ids(template))
+    revisions = sorted(_revisions(template_ids).items(), key=lambda item: str(item[0]))
+    return hashlib.sha1(repr(revisions).encode('utf-8')).hexdigest()
+
+
+def party_key(party_id):
+    """ Returns the revision key of the party. It changes when the party or its features change. """
+    return 'party-%s' % party_id
+
+
+def invalidate(template_ids):
+    """ Makes the cached entries depending on the given templates (ids or GLOBAL) stale """
+    shared_cache.set_many(dict((_revision_key(template_id), _new_revision()) for template_id in set(template_ids)),
+                          SHARED_TIMEOUT)
+
+
+@contextmanager
+def signals_suspended():
+    """ Makes the signal handlers do nothing in the current thread, e.g. during a bulk edit that invalidates the
+        templates it changes itself, once
+    """
+    _suspended.depth = getattr(_suspended, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _suspended.depth -= 1
+
+
+def cache_info():
+    """ Returns the hit/miss statistics of the cache """
+    return CacheInfo(_stats['hits'], _stats['misses'], len(_local), CACHE_SIZE)
+
+
+def clear():
+    with _lock:
+        _local.clear()
+        _stats['hits'] = 0
+        _stats['misses'] = 0
+    invalidate([GLOBAL])
+
+
+def _get(template_id):
+    with _lock:
+        entry = _local.get(template_id)
+        if entry is not None:
+            _local.move_to_end(template_id)
+    if entry is None:
+        entry = shared_cache.get(_entry_key(template_id))
+    if entry is not None:
+        revisions, template = entry
+        if _revisions(revisions.keys()) == revisions:
+            _count('hits')
+            _remember(template_id, entry)
+            return template
+    _count('misses')
+    return None
+
+
+def _set(template, revisions):
+    """ Caches the template. revisions holds the revisions read before loading the template. The revisions of
+        the spirits and cults loaded along with it are added here.
+    """
+    graph_ids = _graph_ids(template)
+    revisions = dict((key, value) for key, value in revisions.items() if key == GLOBAL or key in graph_ids)
+    revisions.update(_revisions(template_id for template_id in graph_ids if template_id not in revisions))
+    entry = (revisions, template)
+    _remember(template.id, entry)
+    shared_cache.set(_entry_key(template.id), entry, SHARED_TIMEOUT)
+
+
+def _remember(template_id, entry):
+    with _lock:
+        _local[template_id] = entry
+        _local.move_to_end(template_id)
+        while len(_local) > CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _graph_ids(template):
+    """ Returns the ids of the template and all the spirit and cult templates reachable from it """
+    seen = set()
+    pending = [template]
+    while pending:
+        current = pending.pop()
+        if current.id in seen:
+            continue
+        seen.add(current.id)
+        pending.extend(option.spirit for option in current.spirits)
+        pending.extend(option.cult for option in current.cults)
+    return seen
+
+
+def _revisions(template_ids):
+    """ Returns a dict of template id: current revision. Missing revisions are created. """
+    template_ids = list(template_ids)
+    keys = dict((_revision_key(template_id), template_id) for template_id in template_ids)
+    found = shared_cache.get_many(list(keys.keys()))
+    output = {}
+    for key, template_id in keys.items():
+        revision = found.get(key)
+        if revision is None:
+            shared_cache.add(key, _new_revision(), SHARED_TIMEOUT)
+            revision = shared_cache.get(key)
+        output[template_id] = revision
+    return output
+
+
+def _new_revision():
+    # Random instead of incremented, so that a revision lost from the shared cache never comes back
+    return uuid.uuid4().hex
+
+
+def _revision_key(template_id):
+    return 'enemygen:template_revision:%s' % template_id
+
+
+def _entry_key(template_id):
+    return 'enemygen:compiled_template:%s' % template_id
+
+
+# Signal handlers. Each of them invalidates the templates affected by the saved or deleted instance.
+
+def _template_changed(sender, instance, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if update_fields and COUNTER_FIELDS.issuperset(update_fields):
+        return  # Only the statistics changed
+    _invalidate_on_commit([instance.id])
+
+
+def _template_part_changed(sender, instance, **kwargs):
+    _invalidate_on_commit([instance.enemy_template_id])
+
+
+def _weapon_changed(sender, instance, **kwargs):
+    try:
+        _invalidate_on_commit([CombatStyle.objects.get(id=instance.combat_style_id).enemy_template_id])
+    except CombatStyle.DoesNotExist:
+        pass    # The whole combat style was deleted, which invalidates the template
+
+
+def _race_part_changed(sender, instance, **kwargs):
+    race_id = instance.id if isinstance(instance, Race) else instance.race_id
+    _invalidate_on_commit(EnemyTemplate.objects.filter(race=race_id).values_list('id', flat=True))
+
+
+def _feature_list_changed(sender, instance, **kwargs):
+    if isinstance(instance, AdditionalFeatureItem):
+        feature_list_id = instance.feature_list_id
+        nonrandom = EnemyNonrandomFeature.objects.filter(feature=instance.id)
+        party_nonrandom = PartyNonrandomFeature.objects.filter(feature=instance.id)
+    else:
+        feature_list_id = instance.id
+        nonrandom = EnemyNonrandomFeature.objects.filter(feature__feature_list=feature_list_id)
+        party_nonrandom = PartyNonrandomFeature.objects.filter(feature__feature_list=feature_list_id)
+    template_ids = set(EnemyTemplate.objects.filter(namelist=feature_list_id).values_list('id', flat=True))
+    template_ids.update(EnemyAdditionalFeatureList.objects.filter(feature_list=feature_list_id)
+                        .values_list('enemy_template', flat=True))
+    template_ids.update(nonrandom.values_list('enemy_template', flat=True))
+    party_ids = set(PartyAdditionalFeatureList.objects.filter(feature_list=feature_list_id)
+                    .values_list('party', flat=True))
+    party_ids.update(party_nonrandom.values_list('party', flat=True))
+    _invalidate_on_commit(template_ids | set(party_key(party_id) for party_id in party_ids))
+
+
+def _party_changed(sender, instance, **kwargs):
+    _invalidate_on_commit([party_key(instance.id if isinstance(instance, Party) else instance.party_id)])
+
+
+def _global_changed(sender, instance, **kwargs):
+    _invalidate_on_commit([GLOBAL])
+
+
+_HANDLERS = (
+    ((EnemyTemplate, ), _template_changed),
+    ((EnemyStat, EnemySkill, CustomSkill, EnemySpell, CustomSpell, CombatStyle, EnemyHitLocation, EnemySpirit,
+      EnemyCult, EnemyAdditionalFeatureList, EnemyNonrandomFeature), _template_part_changed),
+    ((EnemyWeapon, CustomWeapon), _weapon_changed),
+    ((Race, HitLocation), _race_part_changed),
+    ((AdditionalFeatureList, AdditionalFeatureItem), _feature_list_changed),
+    ((Party, TemplateToParty, PartyAdditionalFeatureList, PartyNonrandomFeature), _party_changed),
+    ((Weapon, SkillAbstract, SpellAbstract, StatAbstract), _global_changed),
+)
+
+
+def connect_signals():
+    for senders, handler in _HANDLERS:
+        receiver = _unless_suspended(handler)
+        for sender in senders:
+            post_save.connect(receiver, sender=sender, weak=False,
+                              dispatch_uid='template_cache_%s' % sender.__name__)
+            post_delete.connect(receiver, sender=sender, weak=False,
+                                dispatch_uid='template_cache_%s' % sender.__name__)
+
+
+def _invalidate_on_commit(keys):
+    """ Invalidates the keys when the transaction of the change commits. Invalidating before the commit would let
+        a concurrent load() cache the old rows under the new revisions.
+    """
+    keys = list(keys)
+    transaction.on_commit(lambda: invalidate(keys))
+
+
+def _unless_suspended(handler):
+    def receiver(sender, instance, **kwargs):
+        if not getattr(_suspended, 'depth', 0):
+            handler(sender, instance, **kwargs)
+    return receiver
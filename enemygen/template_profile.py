@@ -0,0 +1,150 @@
+"""
+Monte Carlo profile of an EnemyTemplate.
+
+Rolls a large amount of samples of the template column-wise and summarizes the distributions of the stats,
+skills, combat styles, hit location HP and AP, attributes, spell counts and features. Nothing is built enemy
+by enemy: the rolls and the derived values come from the column-wise methods of _BatchRolls. The profiles are
+cached per template revision, and each revision is always profiled with the same seed.
+"""
+import hashlib
+from collections import Counter
+
+import numpy
+from django.core.cache import cache as shared_cache
+
+from . import template_cache
+from .dice import compile_dice, numpy_rng
+from .models import _BatchRolls, _Cult, _Elemental, _Spirit, SPIRIT_DAMAGE_STEPS
+from .rng import derive_seed
+
+DEFAULT_SAMPLES = 10000
+MAX_SAMPLES = 100000
+TIMEOUT = 24 * 60 * 60
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def get(enemy_template, samples=DEFAULT_SAMPLES):
+    """ Returns the profile of the template as a dict. See profile(). """
+    samples = max(1, min(samples, MAX_SAMPLES))
+    compiled = template_cache.get(enemy_template)
+    revision = template_cache.revision([compiled])
+    key = 'enemygen:profile:%s' % hashlib.sha1(repr((compiled.id, revision, samples)).encode('utf-8')).hexdigest()
+    output = shared_cache.get(key)
+    if output is None:
+        output = profile(compiled, samples, numpy.random.default_rng(derive_seed(revision, samples)))
+        shared_cache.set(key, output, TIMEOUT)
+    return output
+
+
+def profile(compiled, samples, rng=None):
+    """ Profiles the CompiledTemplate with the given amount of samples. Numeric values are summarized with
+        summarize(), and categorical ones as lists of {'value': value, 'share': share of the samples}.
+    """
+    enemy_class = compiled.enemy_class
+    generator = numpy_rng(rng)
+    batch = _BatchRolls(compiled, samples, generator)
+    stats = batch.adjusted_stats
+    output = {'id': compiled.id, 'name': compiled.name, 'samples': samples,
+              'stats': [], 'skills': [], 'combat_styles': [], 'hit_locations': [], 'attributes': {},
+              'spells': [], 'features': []}
+    if enemy_class is not _Cult:
+        output['stats'] = [dict(summarize(column), name=stat.name)
+                           for stat, column in zip(compiled.stats, batch.stats)]
+        output['skills'] = [dict(summarize(column), name=skill.name)
+                            for skill, column in zip(compiled.skills, batch.skills) if column is not None]
+        output['attributes'] = _attributes(compiled, batch, stats)
+        output['features'] = _features(compiled, samples, stats, generator)
+    if enemy_class not in (_Cult, _Spirit):
+        output['combat_styles'] = [dict(summarize(compile_dice(cs.die_set).roll_many(samples, stats, generator)),
+                                        name=cs.name) for cs in compiled.combat_styles]
+        output['hit_locations'] = [{'name': hl.name, 'range': hl.range, 'hp': summarize(hp), 'ap': summarize(ap)}
+                                   for hl, hp, ap in zip(compiled.hit_locations, _hit_points(compiled, batch, stats),
+                                                         batch.armor)]
+    for spell_type in compiled.SPELL_TYPES:
+        spells = getattr(compiled, '%s_spells' % spell_type)
+        amount = compile_dice(getattr(compiled, '%s_spell_amount' % spell_type)).roll_many(samples, rng=generator)
+        output['spells'].append(dict(summarize(numpy.minimum(amount, len(spells))), type=spell_type))
+    return output
+
+
+def summarize(column):
+    """ Returns the mean, standard deviation, min, max and percentiles of the numpy array, and the share of
+        the samples of each value as a list of [value, share]
+    """
+    values, counts = numpy.unique(column, return_counts=True)
+    percentiles = numpy.percentile(column, PERCENTILES, method='nearest')
+    output = {'mean': round(float(column.mean()), 2), 'std': round(float(column.std()), 2),
+              'min': int(values[0]), 'max': int(values[-1]),
+              'histogram': [[int(value), _share(count, len(column))] for value, count in zip(values, counts)]}
+    for percentile, value in zip(PERCENTILES, percentiles):
+        output['p%s' % percentile] = int(value)
+    return output
+
+
+def _categories(values, samples):
+    """ Returns the shares of the values, most common first """
+    return [{'value': value, 'share': _share(count, samples)} for value, count in Counter(values).most_common()]
+
+
+def _share(count, samples):
+    return round(float(count) / samples, 4)
+
+
+def _attributes(compiled, batch, stats):
+    """ Column-wise version of _Enemy._calculate_attributes and _Spirit._calculate_attributes """
+    output = {}
+    if compiled.enemy_class is _Spirit:
+        if _has(stats, 'POW', 'INT', 'CHA'):
+            output['action_points'] = summarize(batch.action_points())
+            output['strike_rank'] = summarize(batch.strike_ranks())
+        skills = dict((skill.name, column) for skill, column in zip(compiled.skills, batch.skills)
+                      if column is not None)
+        spectral_combat = skills.get('Spectral combat', numpy.zeros(batch.amount, dtype=numpy.int64))
+        indexes = -(-spectral_combat // 20)
+        output['spirit_damage'] = _categories(_steps(SPIRIT_DAMAGE_STEPS, indexes, '3d10+1d6'), batch.amount)
+    else:
+        if _has(stats, 'DEX', 'INT'):
+            output['action_points'] = summarize(batch.action_points())
+            output['strike_rank'] = summarize(batch.strike_ranks())
+        if batch.damage_modifiers is not None:
+            output['damage_modifier'] = _categories(batch.damage_modifiers, batch.amount)
+    return output
+
+
+def _hit_points(compiled, batch, stats):
+    if compiled.enemy_class is _Elemental or _has(stats, 'CON', 'SIZ'):
+        return batch.hit_point_totals()
+    return [numpy.maximum(modifier, 1) for modifier in batch.hit_points]
+
+
+def _features(compiled, samples, stats, generator):
+    """ Column-wise version of _Enemy._add_additional_features. Returns the share of the samples having a
+        feature from each feature list, and the shares of the items of the list.
+    """
+    output = []
+    for feature_list in compiled.additional_features:
+        if not feature_list.items:
+            output.append({'name': feature_list.name, 'share': 0.0, 'items': []})
+            continue
+        probability = compile_dice(feature_list.probability).roll_many(samples, stats, generator)
+        has_feature = generator.integers(1, 101, size=samples) <= probability
+        picks = generator.integers(0, len(feature_list.items), size=int(has_feature.sum()))
+        items = [feature_list.items[i].name for i in picks.tolist()]
+        output.append({'name': feature_list.name, 'share': _share(len(items), samples),
+                       'items': _categories(items, samples)})
+    return output
+
+
+def _steps(steps, indexes, default):
+    """ Looks up the indexes from steps like the scalar code does, with default past the end """
+    lookup = {}
+    for index in numpy.unique(indexes).tolist():
+        try:
+            lookup[index] = steps[index]
+        except IndexError:
+            lookup[index] = default
+    return [lookup[index] for index in indexes.tolist()]
+
+
+def _has(stats, *names):
+    return all(name in stats for name in names)
@@ -0,0 +1,14 @@
+from django.template import Library
+
+from enemygen.dice import mean
+
+register = Library()
+
+
+@register.filter
+def expected(die_set, stats=None):
+    """ Shows the average roll of the die set, e.g. (avg. 54). Stats are given as a dict of stat name: die set """
+    try:
+        return '(avg. %d)' % round(mean(die_set, stats))
+    except (ValueError, AttributeError):
+        return ''
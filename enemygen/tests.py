@@ -4,19 +4,27 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
-from django.test import TestCase
+from django.test import TestCase, Client
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import json
+import random
+import time
 
-from .dice import Dice, _die_to_tuple, clean
+from .dice import Dice, _die_to_tuple, clean, compile_dice, cache_info, distribution, equivalent, mean, validate
+from .templatetags.expected import expected
 
 from .models import EnemyTemplate, _Enemy, Ruleset, StatAbstract, Race, SpellAbstract
-from .models import EnemyStat, EnemySkill, SkillAbstract, EnemySpell
-from .models import CombatStyle, Weapon
-from .enemygen_lib import select_random_item, replace_die_set
-from .views_lib import as_json
+from .models import EnemyStat, EnemySkill, SkillAbstract, EnemySpell, CustomSkill
+from .models import CombatStyle, Weapon, Party, EnemyCult, EnemySpirit, EnemyWeapon, CustomWeapon
+from .enemygen_lib import select_random_item, select_random_items, select_random_items_batch, replace_die_set, \
+    WeightedSampler
+from .views_lib import as_json, get_enemies
+from . import balancing, bulk, counters, duel, editor, race_edits, template_cache, template_profile
+from .rng import current_rng, spawn, stream, use
 
 class TestDice(TestCase):
     def test_1_die_to_tuple(self):
@@ -96,11 +104,90 @@ class TestDice(TestCase):
         self.assertEqual(clean('DEX+10+d10-20'), 'DEX+1d10-10')
         self.assertEqual(clean('DEX+10+d10-5-5'), 'DEX+1d10')
         self.assertEqual(clean('STR+DEX+20+5D10+-4D10+2D10+-4D10+2D10'), 'STR+DEX+1d10+20')
+        self.assertEqual(clean('0'), '0')
+        self.assertEqual(clean('D6-D6'), '0')
+        self.assertEqual(clean('1d6+-2'), '1d6-2')
+        self.assertTrue(equivalent('STR+D6+2', '2+1d6+STR'))
+        self.assertTrue(equivalent('D6+D6', '2D6'))
+        self.assertFalse(equivalent('STR+D6', 'DEX+D6'))
+        self.assertFalse(equivalent('2D6', 'D12'))
+
+    def test_6_compiled_cache(self):
+        self.assertTrue(compile_dice('3d6+2') is compile_dice('3D6+2'))
+        self.assertTrue(Dice('3d6+2').compiled is compile_dice('3D6+2'))
+        self.assertEquals(compile_dice('50-d6+4').static, 54)
+        self.assertEquals(compile_dice('50-d6+4').dice, ((-6, -1, 1), ))
+        hits = cache_info().hits
+        Dice('3D6+2').roll()
+        self.assertEquals(cache_info().hits, hits + 1)
+        self.assertRaises(ValueError, compile_dice, 'invalid')
+
+    def test_7_stat_dice(self):
+        compiled = compile_dice('STR+DEX+DEX-POW+10')
+        self.assertEquals(compiled.stats, (('STR', 1), ('DEX', 2), ('POW', -1)))
+        self.assertEquals(compiled.roll({'STR': 10, 'DEX': 12, 'POW': 4}), 40)
+        self.assertEquals(compiled.roll({'STR': 10}), 20)
+        self.assertTrue(16 <= compile_dice('str+2d6').roll({'STR': 14}) <= 26)
+        self.assertRaises(ValueError, compiled.roll)
+        self.assertRaises(ValueError, Dice, 'STR+D6')
+
+    def test_8_roll_many(self):
+        rolls = Dice('10+2D4').roll_many(500)
+        self.assertEquals(len(rolls), 500)
+        self.assertTrue(12 <= rolls.min() and rolls.max() <= 18)
+        rolls = compile_dice('STR+DEX+1d6').roll_many(3, {'STR': [1, 2, 3], 'DEX': 10})
+        self.assertTrue(all(12 + i <= roll <= 17 + i for i, roll in enumerate(rolls)))
+
+    def test_9_distribution(self):
+        dist = distribution('2D6+1')
+        self.assertEquals((dist.min, dist.max), (3, 13))
+        self.assertAlmostEqual(dist.mean, 8)
+        self.assertAlmostEqual(dist.variance, 35 / 6.0)
+        self.assertAlmostEqual(dist.pmf()[8], 6 / 36.0)
+        self.assertAlmostEqual(dist.cdf(4), 3 / 36.0)
+        self.assertEquals(dist.percentile(50), 8)
+        self.assertEquals(distribution('50-D6').max, 49)
+        dist = distribution('POW+POW+10', {'POW': '1d6'})
+        self.assertEquals((dist.min, dist.max), (12, 22))
+        self.assertAlmostEqual(dist.pmf()[14], 1 / 6.0)
+        self.assertTrue(distribution('3d6') is distribution('3D6'))
+        rng = random.Random(1)
+        self.assertTrue(all(3 <= distribution('3d6').sample(rng, 6) <= 6 for _ in range(100)))
+        self.assertEquals(distribution('3d6').sample(rng, 3), 3)
+        self.assertRaises(ValueError, distribution('3d6').sample, rng, 2)
+
+    def test_11_large_distribution(self):
+        start = time.time()
+        dist = distribution('100D1000')
+        self.assertAlmostEqual(dist.mean, 50050, places=3)
+        self.assertEquals((dist.min, dist.max), (100, 100000))
+        self.assertAlmostEqual(distribution('50D1000+50D999').mean, 50025, places=3)
+        stats = {'STR': '100d1000', 'DEX': '50d999'}
+        self.assertEquals(mean('STR+STR+STR+STR+STR+DEX', stats), 275250)
+        self.assertRaises(ValueError, distribution, 'STR+STR+STR+STR+STR+DEX', stats)
+        self.assertEquals(expected('STR+STR+STR+STR+STR+DEX', stats), '(avg. 275250)')
+        self.assertTrue(time.time() - start < 1)
+        # Long distributions are added with FFT, which gives the same result as the direct convolution
+        combinations = sum(1 for a in range(1, 101) for b in range(1, 101) if 1 <= 60 - a - b <= 80)
+        self.assertAlmostEqual(distribution('2D100+1D80').pmf()[60], combinations / 800000.0)
+
+    def test_10_validate(self):
+        self.assertEquals(validate('3D6+2').max_roll(), 20)
+        self.assertEquals(validate('STR+DEX+2d10', stats=True).stats, (('STR', 1), ('DEX', 1)))
+        self.assertRaises(ValueError, validate, 'STR+DEX')
+        self.assertRaises(ValueError, validate, '10000d100')
+        self.assertRaises(ValueError, validate, '2d100000')
+        self.assertRaises(ValueError, validate, 'D0')
+        self.assertRaises(ValueError, validate, '1' * 5000)
+        self.assertRaises(ValueError, validate, 'invalid')
 
 
 class TestEnemyTemplate(TestCase):
     fixtures = ('enemygen_testdata.json',)
 
+    def setUp(self):
+        template_cache.clear()  # The ids of the rolled back templates of earlier tests are reused
+
     def test_01_create(self):
         user = User(username='username')
         user.save()
@@ -118,6 +205,27 @@ class TestEnemyTemplate(TestCase):
         self.assertEquals(et.skills[0].die_set, 'STR+DEX')
         self.assertTrue(et.combat_styles[0].name, "Primary Combat Style")
 
+    def test_02_create_queries(self):
+        user = User.objects.create(username='username')
+        ruleset = Ruleset.objects.get(id=1)
+        with CaptureQueriesContext(connection) as queries:
+            race = Race.create(user, 'Spirit')
+        self.assertTrue(len(queries.captured_queries) <= 8)
+        self.assertEquals([hl.name for hl in race.hit_locations][-1], 'Head')
+        self.assertEquals(race.stats.count(), StatAbstract.objects.count())
+        with CaptureQueriesContext(connection) as queries:
+            et = EnemyTemplate.create(user, ruleset, Race.objects.get(id=1))
+        self.assertTrue(len(queries.captured_queries) <= 12)
+        self.assertEquals(et.name, 'Human Template %s' % et.id)
+        self.assertEquals(len(et.hit_locations), Race.objects.get(id=1).hit_locations.count())
+        race.discorporate = True
+        race.save()
+        spirit = EnemyTemplate.create(user, ruleset, race, 'Spirit')
+        skills = dict((skill.name, skill.die_set) for skill in spirit.skills)
+        self.assertEquals(skills['Stealth'], 'INT+CHA+50')
+        self.assertEquals(skills['Willpower'], 'POW+POW+50')
+        self.assertFalse(spirit.combat_styles.exists())
+
     def test_12_generate(self):
         et = get_enemy_template()
         enemy = et.generate()
@@ -192,6 +300,394 @@ class TestEnemyTemplate(TestCase):
         sr = '%s(%s-0)' % (sr, sr)
         self.assertEquals(enemy.attributes['strike_rank'], sr)
         
+    def test_16_generate_batch(self):
+        et = get_enemy_template()
+        evade = EnemySkill.objects.get(skill__name='Evade', enemy_template=et)
+        evade.set_value('DEX+DEX')
+        rows = et.roll_batch(10)
+        self.assertEquals(len(rows), 10)
+        for i, rolls in enumerate(rows):
+            enemy = et.generate(i+1, rolls=rolls)
+            self.assertEquals([s['value'] for s in enemy.stats_list], rolls.stats)
+            self.assertEquals(enemy.skills_dict['Evade'], 2 * enemy.stats['DEX'])
+            self.assertEquals(enemy.name, 'Test Template %s' % (i+1))
+
+    def test_17_compiled_template(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        compiled = et.compile()
+        self.assertEquals(compiled.stat_dict, et.stat_dict)
+        self.assertEquals([skill.name for skill in compiled.skills], [skill.name for skill in et.skills])
+        self.assertEquals([spell.name for spell in compiled.folk_spells], ['Bladesharp', 'Calm'])
+        self.assertTrue(compiled.is_folk_magician)
+        with self.assertNumQueries(0):
+            for i, rolls in enumerate(compiled.roll_batch(40)):
+                enemy = compiled.generate(i+1, rolls)
+                self.assertEquals(len(enemy.folk_spells), 2)
+
+    def test_18_generate_query_count(self):
+        et = get_enemy_template()
+        template_cache.clear()
+        with CaptureQueriesContext(connection) as one:
+            get_enemies(((et, 1), ), True)
+        template_cache.clear()
+        with CaptureQueriesContext(connection) as many:
+            get_enemies(((et, 40), ), True)
+        self.assertEquals(len(one.captured_queries), len(many.captured_queries))
+        self.assertEquals(EnemyTemplate.objects.get(id=et.id).generated + counters.pending_generated(et.id), 41)
+        counters.flush()
+        self.assertEquals(counters.pending_generated(et.id), 0)
+        et = EnemyTemplate.objects.get(id=et.id)
+        self.assertEquals((et.generated, et.used), (41, 2))
+
+        # A failing flush at the end of a request is logged and retried later instead of raised
+        counters.increment('invalid id', generated=1)
+        counters._last_flush[0] = 0
+        with self.assertLogs('enemygen.counters', 'ERROR'):
+            counters._request_finished(None)
+        self.assertEquals(counters.pending_generated('invalid id'), 1)
+        counters._pending.pop('invalid id')
+
+    def test_19_template_cache(self):
+        et = get_enemy_template()
+        template_cache.clear()
+        compiled = template_cache.get(et)
+        self.assertTrue(template_cache.get(et) is compiled)
+        self.assertEquals(template_cache.cache_info().hits, 1)
+        # Counter updates don't invalidate the cache
+        et.increment_generated()
+        self.assertTrue(template_cache.get(et) is compiled)
+        stat = et.stats[0]
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            stat.set_value('2d6+6')
+            # Until the change commits, other processes see the old rows, so the cache stays valid
+            self.assertTrue(template_cache.get(et) is compiled)
+        self.assertEquals(len(callbacks), 1)
+        recompiled = template_cache.get(et)
+        self.assertFalse(recompiled is compiled)
+        self.assertEquals(recompiled.stats[0].die_set, '2d6+6')
+        hl = et.hit_locations[0].hit_location
+        hl.armor = '3'
+        with self.captureOnCommitCallbacks(execute=True):
+            hl.save()
+        self.assertEquals(template_cache.get(et).hit_locations[0].race_armor, '3')
+        info = template_cache.cache_info()
+        self.assertEquals((info.hits, info.misses), (3, 3))
+
+    def test_20_generate_many(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        enemies = et.generate_many(20, seed=3)
+        self.assertEquals([enemy.name for enemy in enemies], ['Test Template %s' % (i+1) for i in range(20)])
+        self.assertEquals(as_json(enemies), as_json(et.generate_many(20, seed=3)))
+        self.assertNotEquals(as_json(enemies), as_json(et.generate_many(20, seed=4)))
+        for enemy in enemies:
+            base_hp = ((enemy.stats['CON'] + enemy.stats['SIZ'] - 1) // 5) + 1
+            self.assertEquals(enemy.hit_locations[0]['hp'], max(base_hp, 1))   # Leg, hp_modifier 0
+            strength, siz = enemy.stats['STR'], enemy.stats['SIZ']
+            enemy._calculate_damage_modifier(strength, siz)
+            self.assertEquals(enemy.attributes['damage_modifier'], enemy.rolls.damage_modifier)
+            self.assertEquals(len(enemy.folk_spells), 2)
+
+    def test_21_bulk_generate(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        chunk_size = bulk.CHUNK_SIZE
+        bulk.CHUNK_SIZE = 3
+        try:
+            enemies = bulk.generate([(et, 7), (et, 2)], seed=5, workers=1)
+            self.assertEquals([enemy.name for enemy in enemies],
+                              ['Test Template %s' % (i+1) for i in list(range(7)) + list(range(2))])
+            self.assertEquals(as_json(enemies), as_json(bulk.generate([(et, 7), (et, 2)], seed=5, workers=2)))
+            self.assertNotEquals(as_json(enemies), as_json(bulk.generate([(et, 7), (et, 2)], seed=6, workers=1)))
+        finally:
+            bulk.CHUNK_SIZE = chunk_size
+        self.assertEquals(bulk.derive_seed(5, 0, 1), bulk.derive_seed(5, 0, 1))
+        self.assertNotEquals(bulk.derive_seed(5, 0, 1), bulk.derive_seed(5, 1, 0))
+
+    def test_22_profile(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        profile = template_profile.get(et, 2000)
+        self.assertEquals(profile['samples'], 2000)
+        self.assertEquals([stat['name'] for stat in profile['stats']], [stat.name for stat in et.stats])
+        for stat in profile['stats']:
+            self.assertTrue(3 <= stat['min'] <= stat['p5'] <= stat['p50'] <= stat['p95'] <= stat['max'] <= 18)
+            self.assertAlmostEqual(sum(share for _, share in stat['histogram']), 1, places=2)
+        folk = profile['spells'][0]
+        self.assertEquals((folk['type'], folk['min'], folk['max']), ('folk', 2, 2))
+        self.assertEquals(len(profile['hit_locations']), len(et.hit_locations))
+        self.assertAlmostEqual(sum(c['share'] for c in profile['attributes']['damage_modifier']), 1, places=2)
+        self.assertEquals(template_profile.get(et, 2000), profile)    # Same revision, same seed
+        response = Client().get('/enemy_template_profile_json/', {'id': et.id, 'samples': 2000})
+        self.assertEquals(json.loads(response.content), json.loads(json.dumps(profile)))
+        self.assertEquals(Client().get('/enemy_template/%s/profile/' % et.id).status_code, 200)
+
+    def test_23_duel(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        opponent = EnemyTemplate.objects.exclude(id=et.id).filter(race=et.race).first()
+        result = duel.simulate(et, opponent, 2000, random.Random(1))
+        self.assertEquals(result['duels'], 2000)
+        self.assertAlmostEqual(result['a_wins'] + result['b_wins'] + result['draws'], 1, places=3)
+        self.assertTrue(1 <= result['rounds']['min'] <= result['rounds']['max'] <= duel.MAX_ROUNDS)
+        self.assertEquals(duel.simulate(et, opponent, 2000, random.Random(1)), result)
+        mirrored = duel.simulate(opponent, et, 2000, random.Random(2))
+        self.assertTrue(abs(mirrored['b_wins'] - result['a_wins']) < 0.1)
+        party = Party.objects.filter(templatetoparty__isnull=False).first()
+        result = duel.simulate(party, et, 500)
+        self.assertEquals(result['a'], party.name)
+
+        # A custom weapon with invalid damage is left out, and the enemy fights unarmed
+        cw = CustomWeapon.create(et.combat_styles[0].id, '1h-melee', 'Odd sword')
+        with self.captureOnCommitCallbacks(execute=True):
+            cw.damage = '1d8+sword'
+            cw.save()
+        compiled = template_cache.get(et)
+        self.assertEquals(duel._Side._weapon_options(compiled.combat_styles[0]), [((duel.UNARMED_DAMAGE, True), 1)])
+        self.assertEquals(duel.simulate(et, opponent, 200)['duels'], 200)
+
+    def test_24_battle(self):
+        party = Party.objects.filter(templatetoparty__isnull=False).first()
+        result = duel.battle(party, party, 1000, random.Random(1))
+        self.assertEquals(result['a'], party.name)
+        self.assertAlmostEqual(result['a_wins'] + result['b_wins'] + result['draws'], 1, places=3)
+        self.assertTrue(abs(result['a_wins'] - result['b_wins']) < 0.1)
+        self.assertEquals(duel.battle(party, party, 1000, random.Random(1)), result)
+        et = party.template_specs[0].template
+        self.assertTrue(duel.battle([(et, 3)], [(et, 1)], 500, random.Random(1))['a_wins'] > 0.8)
+        self.assertRaises(duel.DuelError, duel.battle, [(et, 0)], party, 10)
+
+    def test_25_balance(self):
+        party = Party.objects.filter(templatetoparty__isnull=False).first()
+        result = balancing.balance(party, party, (0.7, 0.8), seed=1)
+        self.assertTrue(result['within_target'])
+        self.assertTrue(0.7 <= result['win_rate'] <= 0.8)
+        self.assertTrue(result['interval'][0] <= result['win_rate'] <= result['interval'][1])
+        self.assertEquals(len(result['amounts']), party.template_specs.count())
+        self.assertEquals(balancing.balance(party, party, (0.7, 0.8), seed=1), result)
+        balancing.apply(party, result)
+        self.assertEquals([ttp.amount for ttp in party.template_specs],
+                          [str(item['amount']) for item in result['amounts']])
+        low, high = balancing.wilson(50, 100)
+        self.assertTrue(low < 0.5 < high)
+        self.assertAlmostEqual(0.5 - low, high - 0.5)
+
+    def test_26_spirits_and_cults(self):
+        et = get_enemy_template()
+        spirit_race = Race.create(et.owner, 'Spirit')
+        spirit_race.discorporate = True
+        spirit_race.save()
+        spirit = EnemyTemplate.create(et.owner, et.ruleset, spirit_race, 'Spirit')
+        cult = EnemyTemplate.create(et.owner, et.ruleset, Race.create(et.owner, 'Cult'), 'Cult')
+        # The spirit belongs to a cult, which has the same spirit
+        spirit.cult_amount = '1'
+        spirit.save()
+        cult.spirit_amount = '1'
+        cult.save()
+        EnemyCult(enemy_template=spirit, cult=cult, probability=1).save()
+        EnemySpirit(enemy_template=cult, spirit=spirit, probability=1).save()
+        enemy = spirit.generate()
+        self.assertEquals([c.name for c in enemy.cults], ['Cult'])
+        self.assertEquals(enemy.cults[0].spirits, [])
+        # The POW of the spirits of an animist with Binding 20 is at most 6
+        binding = EnemySkill.objects.get(skill__name='Binding', enemy_template=et)
+        binding.die_set = '20'
+        binding.include = True
+        binding.save()
+        et.spirit_amount = '1'
+        et.save()
+        EnemySpirit(enemy_template=et, spirit=spirit, probability=1).save()
+        EnemyStat.objects.filter(enemy_template=spirit, stat__name='POW').update(die_set='3d6')
+        for enemy in et.generate_many(20, seed=1):
+            self.assertEquals(len(enemy.spirits), 1)
+            self.assertTrue(3 <= enemy.spirits[0].stats['POW'] <= 6)
+            self.assertEquals(enemy.spirits[0].cults[0].spirits, [])
+
+    def test_27_cult_spells(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        cult = EnemyTemplate.create(et.owner, et.ruleset, Race.create(et.owner, 'Cult'), 'Cult')
+        cult.folk_spell_amount = '10'
+        cult.save()
+        for name in ('Bladesharp', 'Heal'):
+            sa = SpellAbstract.objects.get(name=name)
+            EnemySpell(spell=sa, enemy_template=cult, detail=sa.default_detail, probability=1).save()
+        EnemyCult(enemy_template=et, cult=cult, probability=1).save()
+        et.cult_amount = '1'
+        et.save()
+        compiled = et.compile()
+        self.assertTrue(compiled.spell_sampler('folk') is compiled.spell_sampler('folk'))
+        for enemy in compiled.generate_many(5, seed=1):
+            self.assertEquals([c.name for c in enemy.cults], ['Cult'])
+            self.assertEquals([s.name for s in enemy.folk_spells], ['Bladesharp', 'Calm', 'Heal'])
+
+    def test_28_clone(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        et.tags.add('undead', 'boss')
+        cs = et.combat_styles[0]
+        EnemyWeapon.create(cs, Weapon.objects.get(name="Broadsword"), 1)
+        for name in ('Claw', 'Bite'):
+            cw = CustomWeapon.create(cs.id, '1h-melee', name)
+            cw.range = '10m'
+            cw.save()
+        with CaptureQueriesContext(connection) as smaller:
+            et.clone(et.owner)
+        CombatStyle(name='Secondary', enemy_template=et, die_set='STR+DEX+10').save()
+        CustomWeapon.create(cs.id, '1h-melee', 'Tail')
+        sa = SpellAbstract.objects.get(name='Heal')
+        EnemySpell(spell=sa, enemy_template=et, detail=sa.default_detail, probability=1).save()
+        with CaptureQueriesContext(connection) as bigger:
+            new = et.clone(et.owner)
+        self.assertEquals(len(bigger.captured_queries), len(smaller.captured_queries))
+        self.assertEquals(new.name, 'Copy of Test Template')
+        self.assertEquals(new.get_tags(), ['boss', 'undead'])
+        self.assertEquals([(s.name, s.die_set) for s in new.stats], [(s.name, s.die_set) for s in et.stats])
+        self.assertEquals([(s.name, s.die_set, s.include) for s in new.skills],
+                          [(s.name, s.die_set, s.include) for s in et.skills])
+        self.assertEquals(sorted(s.spell.name for s in EnemySpell.objects.filter(enemy_template=new)),
+                          ['Bladesharp', 'Calm', 'Heal'])
+        self.assertEquals(len(new.hit_locations), len(et.hit_locations))
+        self.assertEquals([c.name for c in new.combat_styles.order_by('id')], ['Primary Combat Style', 'Secondary'])
+        new_cs = new.combat_styles.order_by('id')[0]
+        self.assertEquals([w.name for w in EnemyWeapon.objects.filter(combat_style=new_cs)], ['Broadsword'])
+        self.assertEquals(sorted((w.name, w.range) for w in CustomWeapon.objects.filter(combat_style=new_cs)),
+                          [('Bite', '10m'), ('Claw', '10m'), ('Tail', '-')])
+        self.assertEquals(CustomWeapon.objects.filter(combat_style=cs).count(), 3)
+
+    def test_29_race_edits(self):
+        et = get_enemy_template()
+        race = et.race
+        other = EnemyTemplate.create(et.owner, et.ruleset, race, 'Other Template')
+        template_cache.get(et)
+        hit_locations = len(et.hit_locations)
+        templates = race.templates.count()
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                hl, updated = race_edits.add_hit_location(race.id)
+        self.assertEquals(updated, templates)
+        self.assertTrue(len(queries.captured_queries) <= 10)
+        self.assertEquals(len(template_cache.get(et).hit_locations), hit_locations + 1)
+        self.assertEquals(len(other.hit_locations), hit_locations + 1)
+        revision = template_cache.revision([template_cache.get(et)])
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEquals(race_edits.remove_hit_location(hl), templates)
+        # The signals of the deleted rows are suspended, and the templates are invalidated once on commit
+        self.assertEquals(template_cache.revision([template_cache.get(et)]), revision)
+        self.assertEquals(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEquals(len(template_cache.get(et).hit_locations), hit_locations)
+        self.assertEquals(len(other.hit_locations), hit_locations)
+
+        EnemyTemplate.objects.filter(id=et.id).update(notes='Lives in caves')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEquals(race_edits.apply_notes(race, et.owner, 'Lives in caves'), 1)
+        self.assertEquals(EnemyTemplate.objects.get(id=et.id).notes, 'Lives in caves')
+        other = EnemyTemplate.objects.get(id=other.id)
+        self.assertTrue(other.notes.endswith('\nLives in caves'))
+        self.assertEquals(template_cache.get(other).notes, other.notes)
+
+    def test_30_skill_bonus(self):
+        et = get_enemy_template()
+        CustomSkill.create(et.id).set_value('INT+10')
+        before = dict((s.id, s.die_set) for s in et.raw_skills)
+        template_cache.get(et)
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                et.apply_skill_bonus('10+1d4')
+        writes = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(len(writes), 3)
+        for skill in et.raw_skills:
+            self.assertEquals(skill.die_set, clean(before[skill.id] + '+1D4+10'))
+        self.assertEquals([s.die_set for s in et.custom_skills], ['INT+1d4+20'])
+        self.assertEquals([c.die_set for c in et.combat_styles], ['STR+DEX+1d4+10'])
+        self.assertEquals(template_cache.get(et).combat_styles[0].die_set, 'STR+DEX+1d4+10')
+        self.assertRaises(ValueError, et.apply_skill_bonus, '+100d6')
+        self.assertEquals([s.die_set for s in et.custom_skills], ['INT+1d4+20'])
+
+    def test_31_submit_batch(self):
+        et = get_enemy_template()
+        client = Client()
+        client.force_login(et.owner)
+        skills = list(et.raw_skills[:2])
+        stat = et.stats[0]
+        cs = et.combat_styles[0]
+        edits = [{'object': 'et_name', 'id': et.id, 'value': 'Renamed'},
+                 {'object': 'et_notes', 'id': et.id, 'value': 'Batch notes'},
+                 {'object': 'et_skill_value', 'id': skills[0].id, 'value': 'str+dex+d6+d6'},
+                 {'object': 'et_skill_value', 'id': skills[1].id, 'value': 'invalid'},
+                 {'object': 'et_stat_value', 'id': stat.id, 'value': '2D6+6'},
+                 {'object': 'et_weapon_prob', 'id': Weapon.objects.get(name='Broadsword').id, 'parent_id': cs.id,
+                  'value': '3'},
+                 {'object': 'et_name', 'id': 0, 'value': 'Missing'},
+                 {'object': 'unknown', 'id': et.id, 'value': ''}]
+        response = client.post('/rest/submit_batch/', json.dumps({'edits': edits}), content_type='application/json')
+        results = json.loads(response.content)['results']
+        self.assertEquals([r.get('success') for r in results], [True, True, True, False, True, True, None, None])
+        self.assertEquals(results[2]['value'], 'STR+DEX+2d6')
+        self.assertEquals(results[3]['original_value'], skills[1].die_set)
+        self.assertTrue('error' in results[6] and 'error' in results[7])
+        et = EnemyTemplate.objects.get(id=et.id)
+        self.assertEquals((et.name, et.notes), ('Renamed', 'Batch notes'))
+        self.assertEquals(EnemySkill.objects.get(id=skills[0].id).die_set, 'STR+DEX+2d6')
+        self.assertEquals(EnemySkill.objects.get(id=skills[1].id).die_set, skills[1].die_set)
+        self.assertEquals(EnemyStat.objects.get(id=stat.id).die_set, '2d6+6')
+        self.assertEquals(EnemyWeapon.objects.get(combat_style=cs).probability, 3)
+
+        # A bad id fails only its own edit
+        edits = [{'object': 'et_name', 'id': 'abc', 'value': 'x'},
+                 {'object': 'et_notes', 'id': et.id, 'value': 'Still saved'}]
+        results = editor.apply_edits(et.owner, edits)
+        self.assertTrue('error' in results[0])
+        self.assertEquals(results[1]['success'], True)
+        self.assertEquals(EnemyTemplate.objects.get(id=et.id).notes, 'Still saved')
+
+        # The edits are applied in order, field edits before a function edit included
+        race = Race.create(et.owner)
+        race.hit_locations[0].delete()
+        publish = {'object': 'race_published', 'id': race.id, 'value': True}
+        discorporate = {'object': 'race_discorporate', 'id': race.id, 'value': True}
+        results = editor.apply_edits(et.owner, [publish, discorporate])
+        self.assertEquals([r['success'] for r in results], [False, True])
+        self.assertFalse(Race.objects.get(id=race.id).published)
+        results = editor.apply_edits(et.owner, [discorporate, publish])
+        self.assertEquals([r['success'] for r in results], [True, True])
+        self.assertTrue(Race.objects.get(id=race.id).published)
+
+        # A failed save affects only the edits of its instance
+        cw = CustomWeapon.create(cs.id, '1h-melee')
+        edits = [{'object': 'et_name', 'id': et.id, 'value': 'Renamed again'},
+                 {'object': 'et_custom_weapon_ap', 'id': cw.id, 'value': '9' * 30},
+                 {'object': 'et_custom_weapon_name', 'id': cw.id, 'value': 'Too big'}]
+        response = client.post('/rest/submit_batch/', json.dumps({'edits': edits}), content_type='application/json')
+        results = json.loads(response.content)['results']
+        self.assertEquals(results[0]['success'], True)
+        self.assertTrue('error' in results[1] and 'error' in results[2])
+        self.assertEquals(EnemyTemplate.objects.get(id=et.id).name, 'Renamed again')
+        self.assertEquals(CustomWeapon.objects.get(id=cw.id).name, 'Custom weapon')
+        response = client.post('/rest/submit/%s/' % cw.id, json.dumps({'object': 'et_custom_weapon_ap',
+                                                                        'value': '9' * 30}),
+                               content_type='application/json')
+        self.assertTrue('error' in json.loads(response.content))
+
+        # The single edit endpoint uses the same edits, and only the owner can edit
+        response = client.post('/rest/submit/%s/' % et.id, json.dumps({'object': 'et_rank', 'value': '4'}),
+                               content_type='application/json')
+        self.assertEquals(json.loads(response.content)['success'], True)
+        self.assertEquals(EnemyTemplate.objects.get(id=et.id).rank, 4)
+        other = User.objects.create(username='other')
+        client.force_login(other)
+        response = client.post('/rest/submit/%s/' % stat.id, json.dumps({'object': 'et_stat_value', 'value': '1'}),
+                               content_type='application/json')
+        self.assertTrue('error' in json.loads(response.content))
+        self.assertEquals(EnemyStat.objects.get(id=stat.id).die_set, '2d6+6')
+
+    def test_statistics(self):
+        get_enemy_template().generate()
+        response = Client().get('/statistics/')
+        self.assertContains(response, 'Compiled die set cache: %s hits' % cache_info().hits)
+
     def notest_16_generate_check_weapon_styles(self):
         # Fix this test!!!!!!!!!!!!!!!
         et = get_enemy_template()
@@ -361,10 +857,34 @@ class TestMisc(TestCase):
         random_spell = select_random_item(spells, exclude)
         self.assertEquals(random_spell, spells[2])
 
+    def test_select_random_items(self):
+        Item = namedtuple('Item', ('name', 'probability'))
+        items = [Item('item%02d' % i, i % 4) for i in range(40)]
+        for x in range(20):
+            selection = select_random_items(items, 25)
+            self.assertEquals(len(selection), 25)
+            self.assertEquals(len(set(selection)), 25)
+            self.assertEquals(selection, sorted(selection, key=lambda item: item.name))
+            self.assertFalse([item for item in selection if item.probability == 0])
+        # Only 30 items have a positive probability
+        self.assertEquals(len(select_random_items(items, 40)), 30)
+        self.assertEquals(select_random_items([], 3), [])
+        rng = random.Random(7)
+        batch = select_random_items_batch(items, (1, 5, 0, 40), rng)
+        self.assertEquals([len(selection) for selection in batch], [1, 5, 0, 30])
+        self.assertEquals(batch, select_random_items_batch(items, (1, 5, 0, 40), random.Random(7)))
+        # A heavy item is almost always picked first
+        heavy = [Item('heavy', 10000), Item('light', 1)]
+        picks = [WeightedSampler(heavy).sample(1)[0].name for x in range(50)]
+        self.assertTrue(picks.count('heavy') > 40)
+
 
 class TestJson(TestCase):
     fixtures = ('enemygen_testdata.json',)
 
+    def setUp(self):
+        template_cache.clear()  # The ids of the rolled back templates of earlier tests are reused
+
     def test_enemy_as_json(self):
         et = get_enemy_template()
         _add_magic(et)
@@ -376,6 +896,106 @@ class TestJson(TestCase):
         self.assertEqual(list(edict[0]['skills'][2].keys())[0], 'Endurance')
         self.assertEqual(edict[0]['skills'][2]['Endurance'], enemy.skills_dict['Endurance'])
 
+    def test_streamed_json(self):
+        et = get_enemy_template()
+        response = Client().get('/generate_enemies_json/', {'id': et.id, 'amount': 250})
+        self.assertTrue(response.streaming)
+        enemies = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(enemies), 250)
+        self.assertEqual(enemies[249]['name'], 'Test Template 250')
+
+    def test_streamed_party_json(self):
+        party = Party.objects.filter(templatetoparty__isnull=False).first()
+        response = Client().get('/generate_party_json/', {'id': party.id})
+        self.assertTrue(response.streaming)
+        out = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(out['party_name'], party.name)
+        self.assertTrue(len(out['enemies']) > 0)
+
+    def test_seeded_json(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        client = Client()
+
+        def get(url, **params):
+            return json.loads(client.get(url, params).content)
+
+        enemies = get('/generate_enemies_json/', id=et.id, amount=5, seed=7)
+        self.assertEqual(enemies, get('/generate_enemies_json/', id=et.id, amount=5, seed=7))
+        self.assertNotEqual(enemies, get('/generate_enemies_json/', id=et.id, amount=5, seed=8))
+        self.assertEqual(client.get('/generate_enemies_json/', {'id': et.id, 'seed': 'x'}).status_code, 404)
+        party = Party.objects.filter(templatetoparty__isnull=False).first()
+        self.assertEqual(get('/generate_party_json/', id=party.id, seed=7),
+                         get('/generate_party_json/', id=party.id, seed=7))
+
+    def test_response_cache(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        client = Client()
+        params = {'id': et.id, 'amount': 3, 'seed': 7}
+        counters.flush()
+        first = client.get('/generate_enemies_json/', params)
+        self.assertFalse(first.streaming)
+        with CaptureQueriesContext(connection) as queries:
+            second = client.get('/generate_enemies_json/', params)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(len(queries), 1)   # Only the template lookup
+        self.assertEqual(counters.pending_generated(et.id), 6)
+        not_modified = client.get('/generate_enemies_json/', params, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(counters.pending_generated(et.id), 9)     # Revalidations count like hits
+        self.assertNotEqual(client.get('/generate_enemies_json/', dict(params, seed=8))['ETag'], first['ETag'])
+
+        # Editing the template invalidates the cached response
+        et.notes = 'Edited'
+        with self.captureOnCommitCallbacks(execute=True):
+            et.save()
+        edited = client.get('/generate_enemies_json/', params)
+        self.assertNotEqual(edited['ETag'], first['ETag'])
+        self.assertEqual(json.loads(edited.content)[0]['notes'], 'Edited')
+
+        party = Party.objects.filter(templatetoparty__isnull=False).first()
+        first = client.get('/generate_party_json/', {'id': party.id, 'seed': 7})
+        self.assertEqual(client.get('/generate_party_json/', {'id': party.id, 'seed': 7})['ETag'], first['ETag'])
+        party.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            party.save()
+        renamed = client.get('/generate_party_json/', {'id': party.id, 'seed': 7})
+        self.assertEqual(json.loads(renamed.content)['party_name'], 'Renamed')
+
+
+class TestRng(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def test_use(self):
+        self.assertIs(current_rng(), random)
+        with use(5) as rng:
+            self.assertIs(current_rng(), rng)
+            first = Dice('3D6').roll()
+        self.assertIs(current_rng(), random)
+        with use(5):
+            self.assertEqual(Dice('3D6').roll(), first)
+
+    def test_streams(self):
+        self.assertEqual(stream(3, 'a').random(), stream(3, 'a').random())
+        self.assertNotEqual(stream(3, 'a').random(), stream(3, 'b').random())
+        self.assertIs(stream(None, 'a'), random)
+        self.assertIs(spawn(random), random)
+        rng, reference = random.Random(1), random.Random(1)
+        child = spawn(rng)
+        reference.getrandbits(64)
+        self.assertEqual(rng.random(), reference.random())   # Spawning advances the parent only by one draw
+        self.assertNotEqual(child.random(), rng.random())
+
+    def test_generate_in_context(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        with use(11):
+            first = as_json([et.generate() for _ in range(3)])
+        with use(11):
+            self.assertEqual(as_json([et.generate() for _ in range(3)]), first)
+
 
 def get_enemy_template():
     user = User(username='username')
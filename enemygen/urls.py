@@ -21,6 +21,8 @@ urlpatterns = [
     url('^' + ROOT + r'generate_party/$', views.generate_party, name='generate_party'),
     url('^' + ROOT + r'edit_index/$', views.edit_index, name='edit_index'),
     url('^' + ROOT + r'enemy_template/(?P<enemy_template_id>\d+)/$', views.enemy_template, name='enemy_template'),
+    url('^' + ROOT + r'enemy_template/(?P<enemy_template_id>\d+)/profile/$', views.enemy_template_profile,
+        name='enemy_template_profile'),
     url('^' + ROOT + r'race/(?P<race_id>\d+)/$', views.race, name='race'),
     url('^' + ROOT + r'party/(?P<party_id>\d+)/$', views.party, name='party'),
     url('^' + ROOT + r'instructions/$', views.instructions, name='instructions'),
@@ -33,6 +35,7 @@ urlpatterns = [
     url('^' + ROOT + r'feature_items/(?P<feature_id>\d+)/$', views.feature_items, name='feature_items'),
     url('^' + ROOT + r'generate_enemies_json/$', views.generate_enemies_json),
     url('^' + ROOT + r'generate_party_json/$', views.generate_party_json),
+    url('^' + ROOT + r'enemy_template_profile_json/$', views.enemy_template_profile_json),
 
     url('^' + ROOT + r'pdf_export/$', views.pdf_export, name='pdf_export'),
     url('^' + ROOT + r'png_export/$', views.png_export, name='png_export'),
@@ -52,6 +55,7 @@ urlpatterns = [
     url('^' + ROOT + r'rest/get_weapons/(?P<cs_id>\d+)/$', ajax.get_weapons, name='get_weapons'),
     url('^' + ROOT + r'rest/search/$', ajax.search, name='search'),
     url('^' + ROOT + r'rest/submit/(?P<id>\d+)/$', ajax.submit, name='submit'),
+    url('^' + ROOT + r'rest/submit_batch/$', ajax.submit_batch, name='submit_batch'),
     url('^' + ROOT + r'rest/change_template/$', ajax.change_template, name='change_template'),
     url('^' + ROOT + r'rest/add_additional_feature/(?P<parent_id>\d+)/$', ajax.add_additional_feature, name='add_additional_feature'),
     url('^' + ROOT + r'rest/get_feature_list_items/(?P<list_id>\d+)/$', ajax.get_feature_list_items, name='get_feature_list_items'),
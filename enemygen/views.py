@@ -1,17 +1,19 @@
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.conf import settings
 from django.utils.datastructures import MultiValueDictKeyError
 from django.views.decorators.http import require_GET
+from django.utils.cache import get_conditional_response
 
 from enemygen.models import EnemyTemplate, Race, Party, ChangeLog, AdditionalFeatureList
 from enemygen.views_lib import get_ruleset, get_context, get_et_context, get_enemies, get_generated_party
 from enemygen.views_lib import get_enemy_templates, is_race_admin, get_statistics, get_random_party
 from enemygen.views_lib import get_filter, get_party_templates, save_as_html
-from enemygen.views_lib import get_party_context, get_enemies_lucky, get_party_filter, determine_enemies, as_json, enemy_as_json
+from enemygen.views_lib import get_party_context, get_enemies_lucky, get_party_filter, determine_enemies
 from enemygen import views_lib as lib
+from enemygen import response_cache, template_cache, template_profile
 
 import os
 import json
@@ -110,9 +112,14 @@ def generate_enemies_json(request):
         amount = 1
     et = get_object_or_404(EnemyTemplate, id=template_id)
     enemy_index = ((et, int(amount)),)
-    enemies = get_enemies(enemy_index, True)
-    enemies_json = as_json(enemies)
-    return HttpResponse(enemies_json, content_type="application/json")
+    seed = _get_seed(request)
+    if seed is None or amount > response_cache.MAX_AMOUNT:
+        enemies = lib.iter_enemies(enemy_index, True, seed)
+        return StreamingHttpResponse(lib.iter_json(enemies), content_type="application/json")
+    revision = template_cache.revision([template_cache.get(et)])
+    cache_key = response_cache.key('enemies', et.id, revision, seed, amount)
+    return _cached_json_response(request, cache_key, lambda: lib.as_json(lib.iter_enemies(enemy_index, True, seed)),
+                                 [(et.id, amount)])
 
 
 def generate_party_json(request):
@@ -120,14 +127,45 @@ def generate_party_json(request):
         party_object = Party.objects.get(id=request.GET['id'])
     except (Party.DoesNotExist, MultiValueDictKeyError):
         raise Http404
-    party = get_generated_party(party_object)
-    out = {'enemies': [], 'party_name': party['party'].name, 'additional_features': []}
-    for enemy in party['enemies']:
-        out['enemies'].append(enemy_as_json(enemy))
-    for af in party['party_additional_features']:
-        out['additional_features'].append({'name': af.name, 'feature': af.feature_list.name})
-    out = json.dumps(out)
-    return HttpResponse(out, content_type="application/json")
+    seed = _get_seed(request)
+    if seed is None:
+        return StreamingHttpResponse(lib.iter_party_json(party_object), content_type="application/json")
+    index = lib.roll_party_index(party_object, seed)
+    compiled_templates = template_cache.load(et for et, _, _ in index)
+    revision = template_cache.revision(compiled_templates, [template_cache.party_key(party_object.id)])
+    cache_key = response_cache.key('party', party_object.id, revision, seed)
+    return _cached_json_response(request, cache_key, lambda: ''.join(lib.iter_party_json(party_object, seed, index)),
+                                 [(et.id, amount) for et, amount, _ in index])
+
+
+def _get_seed(request):
+    """ Returns the optional seed of the request. The same seed always generates the same enemies. """
+    seed = request.GET.get('seed')
+    if seed is None:
+        return None
+    try:
+        return int(seed)
+    except ValueError:
+        raise Http404
+
+
+def _cached_json_response(request, cache_key, generate, increments):
+    """ Serves the JSON from the response cache, or generates it with generate() and caches it. Answers
+        304 Not Modified if the client already has it. increments are the (template id, generated) counter
+        increments done by generate().
+    """
+    etag = response_cache.etag(cache_key)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        body = response_cache.get(cache_key)
+        if body is None:
+            body = generate()
+            response_cache.store(cache_key, body, increments)
+        response = HttpResponse(body, content_type="application/json")
+    elif response.status_code == 304:
+        response_cache.increment(increments)    # The client shows the enemies it already has
+    response['ETag'] = etag
+    return response
 
 
 def generate_party(request):
@@ -180,6 +218,30 @@ def enemy_template(request, enemy_template_id):
     return render(request, template, context)
 
 
+def enemy_template_profile(request, enemy_template_id):
+    context = get_context(request)
+    et = get_object_or_404(EnemyTemplate, id=enemy_template_id)
+    context['profile'] = template_profile.get(et, _get_samples(request))
+    return render(request, 'enemy_template_profile.html', context)
+
+
+def enemy_template_profile_json(request):
+    et = get_object_or_404(EnemyTemplate, id=_get_int(request, 'id'))
+    return HttpResponse(json.dumps(template_profile.get(et, _get_samples(request))), content_type="application/json")
+
+
+def _get_samples(request):
+    samples = request.GET.get('samples')
+    return _get_int(request, 'samples') if samples else template_profile.DEFAULT_SAMPLES
+
+
+def _get_int(request, name):
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        raise Http404
+
+
 def race(request, race_id):
     template = 'race.html'
     context = get_context(request)
@@ -3,6 +3,8 @@
 from enemygen.models import Ruleset, EnemyTemplate, Race
 from enemygen.models import SpellAbstract, EnemySpell, CustomSpell, ChangeLog
 from enemygen.models import Weapon, CombatStyle, EnemyWeapon, CustomWeapon, Party, AdditionalFeatureList
+from enemygen import counters, dice, template_cache
+from enemygen.rng import current_rng, stream
 
 from django.contrib.auth.models import User
 from django.template.loader import render_to_string
@@ -12,7 +14,6 @@ from django.conf import settings
 from bs4 import BeautifulSoup
 from tempfile import NamedTemporaryFile
 import os
-import random
 import datetime
 import json
 try:
@@ -57,6 +58,7 @@ def get_et_context(et):
                'cult_options': cult_options(),
                'additional_feature_lists': AdditionalFeatureList.objects.filter(type='enemy_feature'),
                'namelists': AdditionalFeatureList.objects.filter(type='name'),
+               'stat_dict': et.stat_dict,
             }
     return context
 
@@ -127,13 +129,18 @@ def get_enemies(index, increment):
     """ Generates the enemies.
         Input: a list of tuples of (EnemyTemplate, amount)
     """
-    enemies = []
-    for et, amount in index:
+    return list(iter_enemies(index, increment))
+
+
+def iter_enemies(index, increment, seed=None):
+    """ Same as get_enemies, but yields the enemies one at a time. The same seed always gives the same enemies. """
+    compiled_templates = template_cache.load(et for et, _ in index)
+    for i, ((et, amount), compiled) in enumerate(zip(index, compiled_templates)):
         if increment:
             et.increment_used()
-        for i in range(amount):
-            enemies.append(et.generate(i+1, increment))
-    return enemies
+            et.increment_generated(amount)
+        for enemy in compiled.iter_generate(amount, rng=stream(seed, 'enemies', i)):
+            yield enemy
 
 
 def get_enemies_lucky(request):
@@ -145,11 +152,9 @@ def get_enemies_lucky(request):
             templates = EnemyTemplate.objects.filter(published=True)
     else:
         templates = EnemyTemplate.objects.filter(published=True)
-    index = random.randint(0, len(templates)-1) 
-    enemies = []
-    for i in range(6):
-        enemies.append(templates[index].generate(i+1))
-    return enemies
+    index = current_rng().randint(0, len(templates)-1)
+    compiled = template_cache.get(templates[index])
+    return compiled.generate_many(6)
 
 
 def get_random_party(filtr=None):
@@ -157,32 +162,60 @@ def get_random_party(filtr=None):
         parties = Party.objects.filter(tags__name__in=[filtr, ], published=True)
     else:
         parties = Party.objects.filter(published=True)
-    index = random.randint(0, len(parties)-1)
+    index = current_rng().randint(0, len(parties)-1)
     return parties[index]
 
 
 def get_generated_party(party):
     context = {'party': party,
-               'enemies': _get_party_enemies(party),
-               'party_additional_features': party.get_random_additional_features()}
-    nonrandom_feature = [item.feature for item in party.nonrandom_features]
-    context['party_additional_features'].extend(nonrandom_feature)
+               'enemies': list(_iter_party_enemies(party)),
+               'party_additional_features': _get_party_features(party)}
     return context
 
 
-def _get_party_enemies(party):
-    enemies = []
-    for ttp in party.template_specs:
-        et = ttp.template
-        amount = ttp.get_amount()
+def iter_party_json(party, seed=None, index=None):
+    """ Yields the generated party as JSON in pieces, one enemy at a time. The same seed always gives the same
+        party. index is the output of roll_party_index for the seed, if already rolled.
+    """
+    features = [{'name': af.name, 'feature': af.feature_list.name} for af in _get_party_features(party, seed)]
+    yield '{"party_name": %s, "additional_features": %s, "enemies": [' % (json.dumps(party.name),
+                                                                          json.dumps(features))
+    for i, enemy in enumerate(_iter_party_enemies(party, seed, index)):
+        yield (', ' if i else '') + json.dumps(enemy_as_json(enemy))
+    yield ']}'
+
+
+def _get_party_features(party, seed=None):
+    features = party.get_random_additional_features(stream(seed, 'features'))
+    features.extend(item.feature for item in party.nonrandom_features)
+    return features
+
+
+def roll_party_index(party, seed=None):
+    """ Rolls the amounts of the enemies of the party.
+        Output is a list of tuples of (EnemyTemplate, amount, rng to generate the enemies with)
+    """
+    index = []
+    for i, ttp in enumerate(party.template_specs.select_related('template__race')):
+        rng = stream(seed, 'enemies', i)
+        index.append((ttp.template, ttp.get_amount(rng), rng))
+    return index
+
+
+def _iter_party_enemies(party, seed=None, index=None):
+    if index is None:
+        index = roll_party_index(party, seed)
+    compiled_templates = template_cache.load(et for et, _, _ in index)
+    for (et, amount, rng), compiled in zip(index, compiled_templates):
         et.increment_used()
-        for i in range(amount):
-            enemies.append(et.generate(i+1, True))
-    return enemies
+        et.increment_generated(amount)
+        for enemy in compiled.iter_generate(amount, rng=rng):
+            yield enemy
 
 
 def _get_generated_amount():
-    return EnemyTemplate.objects.aggregate(Sum('generated'))['generated__sum']
+    persisted = EnemyTemplate.objects.aggregate(Sum('generated'))['generated__sum'] or 0
+    return persisted + counters.pending_generated()
 
 
 def spell_list(spell_type, et):
@@ -283,7 +316,9 @@ def get_statistics():
               'dedicated_cults': cults.filter(cult_rank=2).count(),
               'proven_cults': cults.filter(cult_rank=3).count(),
               'overseer_cults': cults.filter(cult_rank=4).count(),
-              'leader_cults': cults.filter(cult_rank=5).count()}
+              'leader_cults': cults.filter(cult_rank=5).count(),
+              'template_cache': template_cache.cache_info(),
+              'dice_cache': dice.cache_info()}
     return output
 
 
@@ -340,10 +375,15 @@ def generate_pngs(html_path):
 
 def as_json(enemies):
     """ Input: A list of generated enemies. Output: The enemies as a json string """
-    out = []
-    for e in enemies:
-        out.append(enemy_as_json(e))
-    return json.dumps(out)
+    return ''.join(iter_json(enemies))
+
+
+def iter_json(enemies):
+    """ Yields the enemies as a JSON array in pieces, one enemy at a time """
+    yield '['
+    for i, e in enumerate(enemies):
+        yield (', ' if i else '') + json.dumps(enemy_as_json(e))
+    yield ']'
 
 def enemy_as_json(e):
     out = {
@@ -1,7 +1,28 @@
+var pending_edits = [];
+var submitting = false;
+
 async function submit(id, type, input_object, value, parent_id) {
-    //Called when a field is changed
-    const res = await axios.post(`/rest/submit/${id}/`, { value, 'object': type, parent_id });
-    submit_callback(res.data, input_object);
+    //Called when a field is changed. Fields changed while an earlier submit is in progress are submitted together.
+    pending_edits.push({ 'edit': { id, value, 'object': type, parent_id }, input_object });
+    if (submitting) {
+        return;
+    }
+    submitting = true;
+    while (pending_edits.length > 0) {
+        const batch = pending_edits;
+        pending_edits = [];
+        try {
+            const res = await axios.post('/rest/submit_batch/', { 'edits': batch.map(item => item.edit) });
+            if (res.data.results) {
+                res.data.results.forEach((result, i) => submit_callback(result, batch[i].input_object));
+            } else {
+                batch.forEach(item => submit_callback(res.data, item.input_object));
+            }
+        } catch (error) {
+            batch.forEach(item => submit_callback({ 'error': String(error) }, item.input_object));
+        }
+    }
+    submitting = false;
 }
 
 async function add_custom_skill(event) {